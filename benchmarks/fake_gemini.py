@@ -0,0 +1,214 @@
+"""
+A local stand-in for the Gemini API, for benchmarks. Serves models, generateContent and
+streamGenerateContent?alt=sse, producing tokens at a configurable rate, and the cachedContents API.
+
+Run on its own with: python benchmarks/fake_gemini.py --port 8765 --tokens-per-second 200
+then point GeminiModel.base_url at http://127.0.0.1:8765/v1beta
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+words = ("the quick brown fox jumps over a lazy dog while **bold** ideas and `code` "
+         "flow through lists, tables and paragraphs of markdown text").split()
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port : int = 0,
+                 tokens_per_second : float = 0,
+                 first_token_latency : float = 0.0,
+                 response_tokens : int = 200,
+                 tokens_per_chunk : int = 4,
+                 models : tuple[str, ...] = ("gemini-fake",),
+                 min_cache_tokens : int = 0):
+        """
+        :param port: the port to listen on. Defaults to any free port
+        :param tokens_per_second: the rate tokens are produced at. 0 produces them as fast as possible
+        :param first_token_latency: the seconds before the first token, like the time a model spends on the prompt
+        :param response_tokens: the number of tokens in each response
+        :param tokens_per_chunk: the number of tokens in each streamed event
+        :param models: the model names listed by the models endpoint
+        :param min_cache_tokens: the fewest tokens (estimated at 4 bytes each) a cached content may hold
+        """
+        super().__init__(("127.0.0.1", port), FakeGeminiHandler)
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.response_tokens = response_tokens
+        self.tokens_per_chunk = tokens_per_chunk
+        self.models = models
+        self.min_cache_tokens = min_cache_tokens
+        self.requests = 0
+        self.bytes_received = 0 # The request bodies received, to compare the uploads of cached and uncached requests
+        self.cached_contents = {} # Name to {"expire_time": unix time, "tokens": estimated tokens}
+        self._next_cache = 0
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta"
+
+    def start(self) -> "FakeGeminiServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "FakeGeminiServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def chunks(self) -> list[str]:
+        """
+        :return: the text of a response, split into the chunks it is streamed in
+        """
+        tokens = [words[i % len(words)] + " " for i in range(self.response_tokens)]
+        return ["".join(tokens[i:i + self.tokens_per_chunk]) for i in range(0, len(tokens), self.tokens_per_chunk)]
+
+    def wait_for_tokens(self, tokens : int) -> None:
+        if self.tokens_per_second > 0:
+            time.sleep(tokens / self.tokens_per_second)
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    server : FakeGeminiServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data : dict, status : int = 200) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self) -> None:
+        self.send_json({"error": {"code": 404, "message": "Not found"}}, 404)
+
+    def cached_content(self, path : str) -> tuple[str, dict | None]:
+        """
+        :return: the name of the cached content a path is for, and the cached content if it exists and hasn't expired
+        """
+        name = path.split("/v1beta/", 1)[-1]
+        cached = self.server.cached_contents.get(name)
+        if cached is not None and cached["expire_time"] < time.time():
+            del self.server.cached_contents[name]
+            cached = None
+        return name, cached
+
+    def describe_cache(self, name : str, cached : dict) -> dict:
+        return {"name": name, "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(cached["expire_time"])),
+                "usageMetadata": {"totalTokenCount": cached["tokens"]}}
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/models"):
+            self.send_json({"models": [{"name": f"models/{model}"} for model in self.server.models]})
+        elif "/cachedContents/" in path:
+            name, cached = self.cached_content(path)
+            self.send_json(self.describe_cache(name, cached)) if cached is not None else self.send_not_found()
+        else:
+            self.send_not_found()
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        name, cached = self.cached_content(self.path.split("?")[0])
+        if cached is None:
+            return self.send_not_found()
+        cached["expire_time"] = time.time() + float(body["ttl"].rstrip("s"))
+        self.send_json(self.describe_cache(name, cached))
+
+    def do_DELETE(self):
+        name, cached = self.cached_content(self.path.split("?")[0])
+        if cached is None:
+            return self.send_not_found()
+        del self.server.cached_contents[name]
+        self.send_json({})
+
+    def create_cache(self, body : bytes) -> None:
+        request = json.loads(body)
+        tokens = len(body) // 4
+        if tokens < self.server.min_cache_tokens:
+            return self.send_json({"error": {"code": 400, "message": f"Cached content is too small. total_token_count={tokens}, "
+                                                                     f"min_total_token_count={self.server.min_cache_tokens}"}}, 400)
+        self.server._next_cache += 1
+        name = f"cachedContents/fake{self.server._next_cache}"
+        cached = {"expire_time": time.time() + float(request.get("ttl", "3600s").rstrip("s")), "tokens": tokens}
+        self.server.cached_contents[name] = cached
+        self.send_json({"model": request["model"], **self.describe_cache(name, cached)})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests += 1
+        self.server.bytes_received += len(body)
+        path = self.path.split("?")[0]
+        usage = {"promptTokenCount": 10, "candidatesTokenCount": self.server.response_tokens,
+                 "totalTokenCount": 10 + self.server.response_tokens}
+
+        if path.endswith("/cachedContents"):
+            return self.create_cache(body)
+        if b'"cachedContent"' in body: # Only decoded when it might reference a cache, to keep plain requests fast
+            name = json.loads(body).get("cachedContent")
+            if name is not None:
+                _, cached = self.cached_content(name)
+                if cached is None:
+                    return self.send_json({"error": {"code": 403, "message": "CachedContent not found (or permission denied)"}}, 403)
+                usage["cachedContentTokenCount"] = cached["tokens"]
+
+        if path.endswith(":generateContent"):
+            time.sleep(self.server.first_token_latency)
+            self.server.wait_for_tokens(self.server.response_tokens)
+            text = "".join(self.server.chunks())
+            self.send_json({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                            "usageMetadata": usage})
+        elif path.endswith(":streamGenerateContent"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            time.sleep(self.server.first_token_latency)
+            chunks = self.server.chunks()
+            for i, chunk in enumerate(chunks):
+                candidate = {"content": {"role": "model", "parts": [{"text": chunk}]}}
+                event = {"candidates": [candidate]}
+                if i == len(chunks) - 1:
+                    candidate["finishReason"] = "STOP"
+                    event["usageMetadata"] = usage
+                if i > 0:
+                    self.server.wait_for_tokens(self.server.tokens_per_chunk)
+                self.write_chunk(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+            self.write_chunk(b"")
+        else:
+            self.send_not_found()
+
+    def write_chunk(self, data : bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A local stand-in for the Gemini API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="0 for as fast as possible")
+    parser.add_argument("--first-token-latency", type=float, default=0.0)
+    parser.add_argument("--response-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(args.port, args.tokens_per_second, args.first_token_latency, args.response_tokens)
+    print(f"Serving a fake Gemini API at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
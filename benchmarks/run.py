@@ -0,0 +1,388 @@
+"""
+Benchmarks for the parts of the chat that are on the hot path, run against a local fake Gemini server.
+Results are written as JSON so runs can be compared over time.
+
+Usage: python benchmarks/run.py [--scenario NAME ...] [--repeat N] [--output results.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_path = os.path.join(repo_path, "src")
+sys.path.insert(0, src_path)
+
+# Keep every benchmark away from the real config and chats. Must be set before app is imported
+work_path = tempfile.mkdtemp(prefix="chat_benchmarks_")
+bench_env = {**os.environ,
+             "XDG_CONFIG_HOME": os.path.join(work_path, "config"),
+             "XDG_DATA_HOME": os.path.join(work_path, "data"),
+             "XDG_CACHE_HOME": os.path.join(work_path, "cache"),
+             "PYTHONPATH": src_path}
+os.environ.update(bench_env)
+
+from fake_gemini import FakeGeminiServer
+
+scenarios = {}
+
+def scenario(function):
+    """
+    Registers a benchmark scenario. Scenarios return a dictionary of measurement name to seconds,
+    or to megabytes for names ending in _mb
+    """
+    scenarios[function.__name__] = function
+    return function
+
+def timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def make_messages(count : int, length : int = 400) -> list[dict]:
+    text = ("Lorem ipsum dolor sit amet, **consectetur** adipiscing elit, `sed do` eiusmod tempor. " * 20)[:length]
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}: {text}"} for i in range(count)]
+
+def make_markdown(tokens : int) -> str:
+    blocks = [
+        "## A heading for this section\n\n",
+        "Some paragraph text with **bold**, *italic* and `inline code`, that goes on for a little while "
+        "so it wraps across more than one line of the terminal when it is rendered.\n\n",
+        "- a list item\n- another list item with `code`\n  - a nested item\n\n",
+        "```python\ndef example(value):\n    return value * 2\n```\n\n",
+        "| column | other column |\n| --- | --- |\n| a | b |\n| c | d |\n\n",
+        "> a quoted line of text\n\n",
+    ]
+    text = ""
+    while len(text) < tokens * 4: # About 4 characters per token
+        text += blocks[len(text) % len(blocks)]
+    return text[:tokens * 4]
+
+def write_config() -> None:
+    config_dir = os.path.join(work_path, "config", "ai_chat")
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, "config.yaml"), "w") as file:
+        json.dump({"model_sources": {"gemini": {"api_key": "benchmark"}}, "models": [], "default_model": None},
+                  file) # JSON is valid YAML
+
+
+@scenario
+def startup() -> dict[str, float]:
+    """
+    Time to start the CLI in a fresh process, for --help, listing chats and finding the config
+    """
+    write_config()
+    results = {}
+    for name, argv in (("help", ["--help"]), ("list", ["list"]), ("config_find", ["config", "find"])):
+        code = f"import sys; sys.argv = ['chat'] + {argv!r}; from app.launcher import run; run()"
+        results[name] = timed(subprocess.run, [sys.executable, "-c", code], env=bench_env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return results
+
+@scenario
+def long_chat() -> dict[str, float]:
+    """
+    Loading and saving a 5000 message chat, opening it with only its last messages read, and adding a message to it
+    """
+    from ai_core.chat import Chat
+    from ai_core.message import Message
+    from ai_core.storage import get_chat_store
+
+    class Model:
+        model_name = "gemini-fake"
+
+    path = os.path.join(work_path, "long_chat")
+    data = {"model": "gemini-fake", "system_prompt": "You are a benchmark", "messages": make_messages(5000)}
+    results = {}
+    for extension in (".jsonl", ".yaml"):
+        chat_path = path + extension
+        store = get_chat_store(chat_path)
+        results[f"save{extension}"] = timed(store.save, chat_path, data)
+
+        chat = Chat()
+        results[f"load{extension}"] = timed(chat.load, chat_path)
+        results[f"load_tail{extension}"] = timed(Chat().load, chat_path, tail = 100) # How chat start opens chats
+
+        chat.add_message(Message("user", "One more message"))
+        results[f"export_one_message{extension}"] = timed(chat.export, chat_path, Model())
+    return results
+
+@scenario
+def memory() -> dict[str, float]:
+    """
+    The memory a loaded 20000 message chat takes, against the text it holds and the list of message dictionaries
+    (with a nested Gemini content per message) chats used to be kept as
+    """
+    from ai_core.chat import Chat
+    from ai_core.storage import get_chat_store
+
+    chat_path = os.path.join(work_path, "memory_chat.jsonl")
+    messages = make_messages(20000)
+    store = get_chat_store(chat_path)
+    store.save(chat_path, {"model": "gemini-fake", "system_prompt": "You are a benchmark", "messages": messages})
+    results = {"text_mb": sum(len(message["content"].encode("utf-8")) for message in messages) / 1e6}
+    del messages
+
+    def traced(load) -> float:
+        tracemalloc.start()
+        loaded = load()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del loaded
+        return size / 1e6
+
+    def load_dicts():
+        messages = store.load(chat_path)["messages"]
+        contents = [{"role": "model" if message["role"] == "assistant" else message["role"],
+                     "parts": [{"text": message["content"]}]} for message in messages]
+        return messages, contents
+
+    def load_chat():
+        chat = Chat()
+        chat.load(chat_path)
+        return chat
+
+    results["message_dicts_mb"] = traced(load_dicts)
+    results["chat_mb"] = traced(load_chat)
+    return results
+
+@scenario
+def markdown_stream() -> dict[str, float]:
+    """
+    Rendering a 20k token markdown response as it streams in, 4 tokens at a time
+    """
+    from rich.console import Console
+    from ai_core.util import MarkdownStream
+
+    text = make_markdown(20000)
+    chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+    console = Console(file=io.StringIO(), force_terminal=True, width=100)
+
+    def render():
+        with MarkdownStream(console) as stream:
+            for chunk in chunks:
+                stream.feed(chunk)
+    return {"render_20k_tokens": timed(render)}
+
+@scenario
+def payload() -> dict[str, float]:
+    """
+    Building the request body for a 5000 turn chat, from scratch and for each new turn
+    """
+    from ai_core.chat import Chat
+    from ai_core.message import Message
+
+    chat = Chat()
+    chat.set_system_prompt("You are a benchmark")
+    for message in make_messages(5000):
+        chat.add_message(Message(message["role"], message["content"]))
+
+    results = {"first_request": timed(lambda: chat.get_gemini_payload().to_json())}
+
+    turns = 100
+    def next_turns():
+        for i in range(turns):
+            chat.add_message(Message("user", f"Turn {i}"))
+            chat.get_gemini_payload().to_json()
+            chat.add_message(Message("assistant", f"Answer {i}"))
+    results["per_turn"] = timed(next_turns) / turns
+    return results
+
+@scenario
+def context_cache() -> dict[str, float]:
+    """
+    Uploading the next 20 turns of a 1000 turn chat to the fake Gemini server, without and with a context cache.
+    The cached upload includes making the caches
+    """
+    from ai_core.chat import Chat
+    from ai_core.context_cache import ContextCache
+    from ai_core.message import Message
+    from ai_core.model import GeminiModel
+
+    results = {}
+    with FakeGeminiServer(response_tokens=50) as server:
+        for name, cache in (("uncached", False), ("cached", True)):
+            model = GeminiModel("gemini-fake", "benchmark", validate=False)
+            model.base_url = server.base_url
+            model.context_cache = ContextCache(model) if cache else None
+
+            chat = Chat()
+            chat.set_system_prompt("You are a benchmark")
+            for message in make_messages(1000):
+                chat.add_message(Message(message["role"], message["content"]))
+            chat.remove_last_message() # End with a prompt
+
+            uploaded = server.bytes_received
+            start = time.perf_counter()
+            for i in range(20):
+                response = model.invoke_chat(chat.get_gemini_payload(None, model.context_cache))
+                chat.add_message(Message("assistant", response))
+                chat.add_message(Message("user", f"Turn {i}"))
+            results[f"{name}_per_turn"] = (time.perf_counter() - start) / 20
+            results[f"{name}_upload_mb"] = (server.bytes_received - uploaded) / 1e6
+    return results
+
+@scenario
+def chat_list() -> dict[str, float]:
+    """
+    Listing 1000 chats, without and with an up to date chat index
+    """
+    from ai_core.storage import JsonlChatStore
+    from app.chat_manager import ChatManager
+    from app.constants import data_path, chat_index_path
+
+    shutil.rmtree(data_path, ignore_errors=True)
+    os.makedirs(data_path)
+    store = JsonlChatStore()
+    messages = make_messages(20)
+    for i in range(1000):
+        store.save(os.path.join(data_path, f"chat_{i}.jsonl"), {"model": "gemini-fake", "system_prompt": "", "messages": messages})
+
+    def list_chats():
+        with redirect_stdout(io.StringIO()):
+            ChatManager().list_chats()
+
+    results = {"cold_index": timed(list_chats), "warm_index": timed(list_chats)}
+    os.remove(chat_index_path)
+    return results
+
+@scenario
+def archive() -> dict[str, float]:
+    """
+    Archiving 900 of 1000 chats with chat gc, the disk space they took before and after, and listing them afterwards
+    """
+    from ai_core.storage import JsonlChatStore
+    from app.chat_manager import ChatManager
+    from app.constants import data_path, chat_index_path
+
+    def disk_mb() -> float:
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(data_path) for name in names if ".jsonl" in name) / 1e6
+
+    shutil.rmtree(data_path, ignore_errors=True)
+    os.makedirs(data_path)
+    store = JsonlChatStore()
+    messages = make_messages(20)
+    old = time.time() - 60 * 86400
+    for i in range(1000):
+        chat_path = os.path.join(data_path, f"chat_{i}.jsonl")
+        store.save(chat_path, {"model": "gemini-fake", "system_prompt": "", "messages": messages})
+        if i >= 100:
+            os.utime(chat_path, (old, old))
+
+    def list_chats():
+        with redirect_stdout(io.StringIO()):
+            ChatManager().list_chats()
+
+    def collect_garbage():
+        with redirect_stdout(io.StringIO()):
+            ChatManager().collect_garbage(30)
+
+    list_chats()
+    results = {"disk_mb_before": disk_mb(), "gc": timed(collect_garbage), "disk_mb_after": disk_mb(),
+               "warm_index": timed(list_chats)}
+    os.remove(chat_index_path)
+    results["cold_index"] = timed(list_chats)
+    shutil.rmtree(data_path)
+    return results
+
+@scenario
+def template() -> dict[str, float]:
+    """
+    Formatting a template with 20 tokens 10000 times
+    """
+    from ai_core.template import Template
+
+    prompt = " and ".join(f"{{{{token_{i}}}}} some text" for i in range(20))
+    arguments = {f"token_{i}": f"value {i}" for i in range(20)}
+
+    def format_all():
+        for _ in range(10000):
+            Template(prompt).format(arguments)
+    return {"format_10k": timed(format_all)}
+
+@scenario
+def fake_server(tokens_per_second : float = 0, first_token_latency : float = 0.0) -> dict[str, float]:
+    """
+    Streaming and non-streaming calls to the fake Gemini server. With no token rate, this measures the client overhead
+    """
+    from ai_core.model import GeminiModel
+
+    with FakeGeminiServer(tokens_per_second=tokens_per_second, first_token_latency=first_token_latency,
+                          response_tokens=2000) as server:
+        model = GeminiModel("gemini-fake", "benchmark", validate=False)
+        model.base_url = server.base_url
+
+        first_token = None
+        start = time.perf_counter()
+        for _ in model.stream("Hello"):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        stream_total = time.perf_counter() - start
+
+        return {"stream_first_token": first_token,
+                "stream_2k_tokens": stream_total,
+                "invoke_2k_tokens": timed(model.invoke, "Hello")}
+
+
+def run(names : list[str], repeat : int, server_options : dict) -> dict:
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            runs.append(scenarios[name](**server_options) if name == "fake_server" else scenarios[name]())
+
+        results[name] = {}
+        for measurement in runs[0]:
+            values = [measurements[measurement] for measurements in runs]
+            results[name][measurement] = {"median": statistics.median(values), "min": min(values), "max": max(values)}
+            median = results[name][measurement]["median"]
+            print(f"{name}.{measurement}: " + (f"{median:.2f}MB" if measurement.endswith("_mb") else f"{median * 1000:.2f}ms"),
+                  file=sys.stderr)
+    return results
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat benchmarks")
+    parser.add_argument("--scenario", action="append", choices=list(scenarios), help="Only run these scenarios")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of runs of each scenario, the median is reported")
+    parser.add_argument("--output", help="The .json file to write results to. Defaults to stdout")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="The fake server's token rate, 0 for unlimited")
+    parser.add_argument("--first-token-latency", type=float, default=0.0, help="The fake server's delay before the first token")
+    args = parser.parse_args()
+
+    try:
+        report = {
+            "timestamp": time.time(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "results": run(args.scenario or list(scenarios), args.repeat,
+                           {"tokens_per_second": args.tokens_per_second, "first_token_latency": args.first_token_latency})
+        }
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
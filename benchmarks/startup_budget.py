@@ -0,0 +1,82 @@
+"""
+Checks that trivial commands start fast: each is run in a fresh process several times, and fails if
+its median wall time is over the budget or if it imports any of the heavy modules only other commands need.
+Exits with status 1 on failure, so it can gate CI.
+
+Usage: python benchmarks/startup_budget.py [--budget-ms 100] [--repeat 7]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_path = os.path.join(repo_path, "src")
+
+# The commands that should stay cheap, as the arguments after chat
+commands = (["list"], ["config", "find"])
+
+# Modules that only commands talking to a model, or rendering rich output, should import
+heavy_modules = ("typer", "click", "rich", "requests", "urllib3", "httpx", "yaml", "sqlite3")
+
+def command_code(argv : list[str]) -> str:
+    """
+    :return: python code running the chat command, then printing the heavy modules it imported as JSON on the last line
+    """
+    return (f"import sys, json; sys.argv = ['chat'] + {argv!r}; from app.launcher import run; run(); "
+            f"print(json.dumps([m for m in {heavy_modules!r} if m in sys.modules]))")
+
+def check(argv : list[str], repeat : int, env : dict) -> dict:
+    times = []
+    imported = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", command_code(argv)], env=env, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"chat {" ".join(argv)} failed:\n{result.stderr}")
+        imported = json.loads(result.stdout.strip().splitlines()[-1])
+    return {"median_ms": statistics.median(times) * 1000, "min_ms": min(times) * 1000, "heavy_imports": imported}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the start up time of trivial chat commands")
+    parser.add_argument("--budget-ms", type=float, default=100, help="The most milliseconds each command may take")
+    parser.add_argument("--repeat", type=int, default=7, help="The number of runs of each command, the median is checked")
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="chat_startup_")
+    env = {**os.environ,
+           "XDG_CONFIG_HOME": os.path.join(work_path, "config"),
+           "XDG_DATA_HOME": os.path.join(work_path, "data"),
+           "XDG_CACHE_HOME": os.path.join(work_path, "cache"),
+           "PYTHONPATH": src_path}
+
+    failed = False
+    try:
+        # Python's own start up time, for context when comparing machines
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], env=env)
+        print(f"python itself: {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        for argv in commands:
+            result = check(argv, args.repeat, env)
+            over_budget = result["median_ms"] > args.budget_ms
+            failed = failed or over_budget or len(result["heavy_imports"]) > 0
+
+            status = "FAIL" if over_budget or result["heavy_imports"] else "ok"
+            print(f"{status:4} chat {" ".join(argv)}: {result["median_ms"]:.0f}ms median, "
+                  f"{result["min_ms"]:.0f}ms min (budget {args.budget_ms:.0f}ms)")
+            if result["heavy_imports"]:
+                print(f"     imported {", ".join(result["heavy_imports"])}")
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
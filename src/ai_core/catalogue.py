@@ -0,0 +1,72 @@
+import hashlib
+import os
+import time
+
+import yaml
+
+from .files import atomic_write
+
+
+class ModelCatalogue:
+    """
+    Persistent cache of the models available from each model source.
+    Lets a model be validated without a network round-trip while the cached list is still fresh
+    """
+    def __init__(self, path : str, ttl : int = 24 * 60 * 60):
+        """
+        :param path: the path to the .yaml file to store the catalogue in
+        :param ttl: the number of seconds a fetched model list stays valid for. Defaults to a day
+        """
+        self.path = path
+        self.ttl = ttl
+        self._data = None
+
+    @staticmethod
+    def _key(source : str, api_key : str | None) -> str:
+        # API keys are never written to the cache in plain text
+        key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        return f"{source}:{key_hash}"
+
+    def _load(self) -> dict:
+        if self._data is None:
+            try:
+                with open(self.path, "r") as file:
+                    self._data = yaml.safe_load(file) or {}
+            except (FileNotFoundError, yaml.YAMLError):
+                self._data = {}
+        return self._data
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_write(self.path) as file:
+            yaml.dump(self._data, file, default_flow_style=False, sort_keys=False)
+
+    def get(self, source : str, api_key : str | None) -> list[str] | None:
+        """
+        Gets the cached model names for a source
+        :param source: the model source (e.g. gemini)
+        :param api_key: the api key the model list was fetched with
+        :return: the list of model names, or None if nothing is cached or the entry has expired
+        """
+        entry = self._load().get(self._key(source, api_key))
+        if entry is None or time.time() - entry.get("fetched", 0) > self.ttl:
+            return None
+        return entry.get("models")
+
+    def set(self, source : str, api_key : str | None, model_names : list[str]) -> None:
+        """
+        Stores a freshly fetched model list for a source
+        :param source: the model source (e.g. gemini)
+        :param api_key: the api key the model list was fetched with
+        :param model_names: the names of all models available
+        """
+        self._load()[self._key(source, api_key)] = {"fetched": time.time(), "models": list(model_names)}
+        self._save()
+
+    def clear(self) -> None:
+        """
+        Removes every cached model list
+        """
+        self._data = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,7 +1,16 @@
-import yaml
+from typing import TYPE_CHECKING
 
+from .context_cache import CachedContent
+from .files import FileLock, file_state
 from .message import Message
-from .model import Model
+from .message_store import MessageStore, PagedMessages
+from .payload import GeminiPayload, GeminiPayloadBuilder
+from .storage import ChatHistory, ChatStore, get_chat_store
+
+if TYPE_CHECKING: # The model backends pull in the HTTP clients, which chats only need once they talk to a model
+    from .context import ContextWindow
+    from .context_cache import ContextCache
+    from .model import Model
 
 
 class Chat:
@@ -9,56 +18,190 @@ class Chat:
     Stores all messages sent by the user or LLM agents
     """
     def __init__(self):
-        self._messages = []
+        self._messages = MessageStore()
         self.system_prompt = ""
+        self._gemini_payload = GeminiPayloadBuilder(self._messages) # Kept in sync with the messages
+        self._history : ChatHistory | None = None # Older messages left on disk by loading only the tail of a chat
+
+        # Rolling summary of the turns that no longer fit in the context window, and the number of turns it covers
+        self.summary = None
+        self.summarised = 0
+
+        # The context cache holding the start of the chat, and caches replaced since the last request, to be deleted
+        self.cached_content : CachedContent | None = None
+        self._stale_caches = []
+
+        # Changes since the chat was last loaded or exported, appended to log based chat files on export
+        self._journal = []
+        self._synced_path = None
+        self._synced_model = None
+        # The file the journal's changes are relative to, with its state and message count then.
+        # Used to notice and merge changes other processes made to the file in the meantime
+        self._base = None
+
+        self.export_listeners = [] # Called with (chat, chat_source, model) after every export
+        # Called with the path of the chat file, locked, when it was moved away since the chat was loaded (e.g. archived).
+        # Puts the file back, so the chat's changes are merged into it rather than replacing it. Returns the state the
+        # file had when it was moved away ([] if unknown), or None if it couldn't be put back
+        self.restore = None
+
+    @property
+    def messages(self) -> MessageStore | PagedMessages:
+        """
+        :return: the messages in the chat, which read like a list of {"role": ..., "content": ...} dictionaries.
+                 Older messages still on disk are read as they're accessed
+        """
+        return self._messages if self._history is None else PagedMessages(self._history, self._messages)
+
+    def load_history(self, count : int = None) -> None:
+        """
+        Reads older messages left on disk by loading the chat with a tail
+        :param count: the number of older messages to read. Reads them all if None
+        """
+        if self._history is None:
+            return
+        self._messages.prepend(self._history.take_last(count))
+        if len(self._history) == 0:
+            self._history = None
+            self.summarised = min(self.summarised, len(self._gemini_payload.contents))
+        self._gemini_payload.rebuild(self.system_prompt, self._messages) # Older system messages come first
 
     def add_message(self, message : Message):
         if len(message.content.strip()) != 0:
-            self._messages.append(message.to_dict())
+            if message.role == "system":
+                self.drop_cached_content() # System messages are part of the cached system instruction
+            message_dict = message.to_dict()
+            self._messages.append(message.role, message.content)
+            self._gemini_payload.append(message_dict)
+            self._journal.append(message_dict)
 
     def remove_last_message(self):
-        self._messages.pop()
+        if len(self._messages) == 0:
+            self.load_history(1)
+        self._gemini_payload.pop(self._messages.pop()) # After the store, so the builder sees the messages left
+        self._journal.append({"op": "pop"})
+        if self._history is None: # Otherwise the summarised contents are older than the loaded ones
+            self.summarised = min(self.summarised, len(self._gemini_payload.contents))
+        if self.cached_content is not None and self.cached_content.contents > len(self._gemini_payload.contents):
+            self.drop_cached_content() # Removed a cached turn
 
     def clear(self):
-        self._messages = []
+        self._messages.clear()
+        self._history = None
+        self._gemini_payload.clear()
+        self._journal.append({"op": "clear"})
+        self.summary = None
+        self.summarised = 0
+        self.drop_cached_content()
 
-    def get_gemini_payload(self):
+    def drop_cached_content(self) -> None:
         """
+        Stops using the chat's context cache, after the start of the chat changed. It's deleted on the next request
+        """
+        if self.cached_content is not None:
+            self._stale_caches.append(self.cached_content)
+            self.cached_content = None
+            self._journal.append({"op": "header", "cached_content": None})
+
+    def get_gemini_payload(self, context_window : "ContextWindow" = None, context_cache : "ContextCache" = None) -> GeminiPayload | None:
+        """
+        :param context_window: optionally limits the history sent to the model's token budget. Sends everything if None
+        :param context_cache: optionally keeps the start of the chat in the model's context cache, when all of it is sent
         :return: Returns the messages formatted for gemini usage. Does not work for older models due to system instruction TODO
+                 The payload is kept up to date as messages change, so it shouldn't be modified or kept across turns
         """
+        if (context_window is None or context_window.strategy != "sliding"
+                or self._history is not None and self._history.system_count() > 0):
+            # Everything is sent, the kept and summarised turns count from the start of the chat,
+            # or older system messages are part of the system instruction
+            self.load_history()
+        elif len(self._messages) == 0:
+            self.load_history(1)
         if len(self._messages) == 0:
             return None
+        if context_window is None:
+            return self.cache_context(self._gemini_payload.payload(), context_cache)
 
-        content = []
-        system_message_parts = [{"text" : self.system_prompt}]
-        for m in self._messages:
-            if m["role"] != "system":
-                role = "model" if m["role"] == "assistant" else m["role"]
-                content.append({"role": role, "parts": [{"text": m["content"]}]})
-            else:
-                system_message_parts.append({"text" : m["content"]})
+        contents = self._gemini_payload.contents
+        use_summary = context_window.strategy == "summary"
+        system_parts = self._gemini_payload.system_parts
+        if use_summary and self.summary:
+            system_parts = system_parts + [self._gemini_payload.summary_part(self.summary)]
 
-        if len(system_message_parts) != 0:
-            return {"system_instruction" : {"parts" : system_message_parts}, "contents" : content}
-        else:
-            return {"contents" : content}
+        head, start = context_window.select(system_parts, contents, self.summarised)
+        while start == 0 and self._history is not None: # Every loaded turn fits, so older ones might too
+            self.load_history(len(self._messages))
+            head, start = context_window.select(self._gemini_payload.system_parts, contents, self.summarised)
+        if use_summary and start > self.summarised:
+            from .model import ModelError
+            try:
+                self.summary = context_window.summarise(self.summary, contents[self.summarised:start])
+                self.summarised = start
+                self._journal.append({"op": "header", "summary": self.summary, "summarised": self.summarised})
+                self.drop_cached_content() # The summary is part of the system instruction
+            except ModelError:
+                pass # Send the recent turns without the new summary for now, and try again next turn
 
-    def load(self, path: str, display_messages: bool = False, confirm_load=False) ->  None:
+        payload = self._gemini_payload.payload(head, start, self.summary if use_summary and self.summary else None)
+        return self.cache_context(payload, context_cache) if start == 0 else payload # Only a whole chat has a stable start
+
+    def cache_context(self, payload : GeminiPayload, context_cache : "ContextCache | None") -> GeminiPayload:
+        """
+        Points the payload at the chat's context cache, making or replacing the cache as the chat grows
+        :param payload: a payload with all of the chat
+        :param context_cache: the model's context cache, or None to not use one
+        :return: the payload
         """
-        Loads in chat data from a given chat .yaml file
-        :param path: the path to the chat .yaml file
+        if context_cache is None:
+            return payload
+        for stale in self._stale_caches:
+            context_cache.delete(stale)
+        self._stale_caches = []
+
+        system_parts = payload["system_instruction"]["parts"]
+        encode = lambda count: self._gemini_payload.to_json(None, count, len(payload["contents"]), system_parts)
+        previous = self.cached_content
+        expire_time = None if previous is None else previous.expire_time
+        cached = context_cache.update(previous, system_parts, payload["contents"], encode)
+        if cached is not previous or cached is not None and cached.expire_time != expire_time: # Made, dropped or extended
+            self.cached_content = cached
+            self._journal.append({"op": "header", "cached_content": None if cached is None else cached.to_dict()})
+        payload.cached_content = cached
+        return payload
+
+    def load(self, path: str, display_messages: bool = False, confirm_load=False, tail : int = None) ->  None:
+        """
+        Loads in chat data from a given chat file. The format (.jsonl or .yaml) is picked from the extension
+        :param path: the path to the chat file
         :param display_messages: whether to display a list of all messages after loading
         :param confirm_load: whether to print a confirmation message of loading or not
+        :param tail: only read the last tail messages, reading older messages when they're needed.
+                     Opening a long chat then takes no longer than a short one. Reads every message if None
         """
         try:
-            with open(path, "r") as file:
-                data = yaml.safe_load(file)
+            store = get_chat_store(path)
+            with FileLock(path, shared = True): # Not while another process is writing it
+                data, history = (store.load(path), None) if tail is None else store.load_tail(path, tail)
+                state = file_state(path)
 
             if data is None:
+                self._base = (path, state, 0)
                 return
 
-            self._messages = data["messages"]
+            self._messages.clear()
+            self._messages.extend(data["messages"])
+            self._history = history
             self.system_prompt = data["system_prompt"]
+            self._gemini_payload.rebuild(self.system_prompt, self._messages)
+            self.summary = data.get("summary")
+            self.summarised = data.get("summarised", 0)
+            self.cached_content = CachedContent.from_dict(data.get("cached_content"))
+            if history is None:
+                self.summarised = min(self.summarised, len(self._gemini_payload.contents))
+            self._journal = []
+            self._synced_path = path
+            self._synced_model = data.get("model")
+            self._base = (path, state, len(self.messages))
 
             if confirm_load:
                 print(f"Successfully loaded messages from {path}")
@@ -67,29 +210,138 @@ class Chat:
                 self.display_chat_data()
         except FileNotFoundError:
             raise FileNotFoundError(f"Error: {path} not found.")
-        except TypeError:
+        except (TypeError, KeyError, ValueError):
             raise TypeError(f"Error: {path} contains an invalid format.")
 
-    def export(self, chat_source : str, model : Model, confirm_export : bool = False) -> None:
+    def export(self, chat_source : str, model : "Model", confirm_export : bool = False) -> None:
         """
-        Save a Chat class into a .yaml file
-        :param chat_source: the path to the .yaml file to save the chat into
+        Save a Chat class into a chat file. The format (.jsonl or .yaml) is picked from the extension
+        Log based formats only have the changes since the last load/export appended to them.
+        The file is locked while it's written. If another process changed it since it was loaded, the changes are merged
+        and the chat is reloaded with both
+        :param chat_source: the path to the chat file to save the chat into
         :param model: the model that is currently being used for this chat
         :param confirm_export: whether to print a confirmation message of exporting or not
         """
-        data = {
-                "model" : model.model_name,
-                "system_prompt": self.system_prompt,
-                "messages": self._messages
-                }
+        store = get_chat_store(chat_source)
 
-        with open(chat_source, "w") as file:
-            yaml.dump(data, file, default_flow_style=False, sort_keys=False)
+        with FileLock(chat_source):
+            state = file_state(chat_source)
+            synced = self._base is not None and self._base[0] == chat_source
+            moved_from = None
+            if synced and state is None and self._base[1] is not None: # Moved away or deleted by another process
+                moved_from = self.restore(chat_source) if self.restore is not None else None
+                if moved_from is not None:
+                    state = file_state(chat_source)
+                    if tuple(moved_from) == self._base[1]: # Moved unchanged, so the changes apply as they would have
+                        self._base = (chat_source, state, self._base[2])
+                elif self._history is not None: # Nothing to merge with, and the older messages left on disk are gone
+                    print(f"{chat_source} was removed since it was loaded, saving it without its unread older messages")
+                    self._history = None
+                    self.summarised = min(self.summarised, len(self._gemini_payload.contents))
+            changed = synced and state is not None and state != self._base[1] # Written by another process
+
+            can_append = (store.supports_append
+                          and chat_source == self._synced_path
+                          and state is not None
+                          and {"op": "clear"} not in self._journal) # Rewriting after a clear is cheaper and compacts the log
+
+            if changed:
+                self.merge_changes(store, chat_source, model, state)
+            elif can_append:
+                records = self._journal
+                if model.model_name != self._synced_model:
+                    records = [{"op": "header", "model": model.model_name}] + records
+                if len(records) != 0:
+                    store.append(chat_source, records)
+            else:
+                self.load_history()
+                data = {
+                        "model" : model.model_name,
+                        "system_prompt": self.system_prompt,
+                        "messages": list(self._messages)
+                        }
+                if self.summary:
+                    data["summary"] = self.summary
+                    data["summarised"] = self.summarised
+                if self.cached_content is not None:
+                    data["cached_content"] = self.cached_content.to_dict()
+                store.save(chat_source, data)
+            self._base = (chat_source, file_state(chat_source), len(self.messages))
+
+        if changed or moved_from is not None: # Take in the changes, only reading older messages when they're needed
+            self.load(chat_source, tail = len(self._messages))
+        self._journal = []
+        self._synced_path = chat_source
+        self._synced_model = model.model_name
+
+        for listener in self.export_listeners:
+            listener(self, chat_source, model)
 
         if confirm_export:
             print(f"Successfully exported messages to {chat_source}")
 
+    def merge_changes(self, store : ChatStore, chat_source : str, model : "Model", state : tuple[int, int]) -> None:
+        """
+        Writes the chat's changes to a chat file another process changed since the chat was loaded or exported.
+        Messages added by both are kept, the other process's first, and messages either removed are removed.
+        Should be called with the file locked
+        :param store: the store of the chat file
+        :param chat_source: the path of the chat file
+        :param model: the model used for the chat
+        :param state: the current state of the chat file
+        """
+        _, base_state, base_count = self._base
+        cleared = {"op": "clear"} in self._journal
+        popped, added, header = self.replay_changes(self._journal, base_count)
+
+        if store.supports_append and popped == 0 and not cleared and state[1] > 0:
+            # Only added messages or changed the header, which apply the same after the other process's changes
+            store.append(chat_source, self._journal + [{"op": "header", "model": model.model_name}])
+            return
+
+        data = store.load(chat_source) or {"messages": []}
+        messages = data["messages"]
+        if store.supports_append and base_state is not None and state[0] == base_state[0] and state[1] >= base_state[1]:
+            their_popped = self.replay_changes(store.read_records(chat_source, base_state[1]), base_count)[0]
+        else: # Rewritten, so there's no telling which messages it had when this chat was loaded. Keep them all
+            base_count = len(messages)
+            their_popped = 0
+            popped = base_count if cleared else 0
+
+        data["messages"] = (messages[:base_count - max(popped, their_popped)]
+                            + messages[base_count - their_popped:] + added)
+        data.update(header)
+        data.setdefault("system_prompt", self.system_prompt)
+        data["model"] = model.model_name
+        store.save(chat_source, data)
+
+    @staticmethod
+    def replay_changes(records : list[dict], base_count : int) -> tuple[int, list[dict], dict]:
+        """
+        :param records: change records, as in the journal
+        :param base_count: the number of messages the records were made after
+        :return: the number of those messages the records remove, the messages they add, and the header values they set
+        """
+        popped = 0
+        added = []
+        header = {}
+        for record in records:
+            match record.get("op"):
+                case None: added.append(record)
+                case "pop":
+                    if added:
+                        added.pop()
+                    else:
+                        popped = min(popped + 1, base_count)
+                case "clear":
+                    popped = base_count
+                    added = []
+                case "header": header.update((key, value) for key, value in record.items() if key != "op")
+        return popped, added, header
+
     def display_chat_data(self):
+        self.load_history()
         chat = ""
         for i,m in enumerate(self._messages):
             chat += f"{m["role"]}: {m["content"]}\n"
@@ -98,4 +350,7 @@ class Chat:
         print(chat)
 
     def set_system_prompt(self, system_prompt : str):
-        self.system_prompt = system_prompt
\ No newline at end of file
+        self.system_prompt = system_prompt
+        self._gemini_payload.set_system_prompt(system_prompt)
+        self._journal.append({"op": "header", "system_prompt": system_prompt})
+        self.drop_cached_content()
\ No newline at end of file
@@ -0,0 +1,109 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .model import Model
+
+
+def estimate_tokens(text : str) -> int:
+    """
+    A fast estimate of the number of tokens in some text, without running a tokenizer.
+    Counts roughly 4 bytes of UTF-8 per token, which is close for English and errs high for other scripts
+    :param text: the text to estimate
+    :return: the estimated number of tokens
+    """
+    return (len(text.encode("utf-8")) + 3) // 4
+
+def content_tokens(content : dict) -> int:
+    """
+    :param content: a Gemini content entry ({"role": ..., "parts": [{"text": ...}]})
+    :return: the estimated number of tokens the entry takes up, including a small per-message overhead
+    """
+    return 4 + sum(estimate_tokens(part.get("text", "")) for part in content["parts"])
+
+
+class ContextWindow:
+    """
+    Keeps the history sent to a model within a token budget, so requests stay the same size however long the chat gets.
+    Strategies:
+     - sliding: only send the most recent turns that fit
+     - keep_first: always send the first keep_first messages (e.g. the task set up), then the most recent turns that fit
+     - summary: replace turns that no longer fit with a rolling summary, which is saved in the chat file
+    """
+    strategies = ("sliding", "keep_first", "summary")
+
+    def __init__(self, max_tokens : int, strategy : str = "sliding", keep_first : int = 2, summariser : "Model" = None):
+        """
+        :param max_tokens: the token budget for the system prompt and history of each request
+        :param strategy: sliding, keep_first or summary. Defaults to sliding
+        :param keep_first: the number of messages kept from the start of the chat with the keep_first strategy. Defaults to 2
+        :param summariser: the model that writes summaries with the summary strategy
+        :raises ValueError: Raised when the strategy is unknown, or summary is used without a summariser
+        """
+        if strategy not in self.strategies:
+            raise ValueError(f"{strategy} is not a context strategy. Strategies are: {", ".join(self.strategies)}")
+        if strategy == "summary" and summariser is None:
+            raise ValueError("The summary context strategy needs a model to write summaries")
+
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.keep_first = keep_first
+        self.summariser = summariser
+
+    def select(self, system_parts : list[dict], contents : list[dict], summarised : int = 0) -> tuple[int, int]:
+        """
+        Picks the contents to send. Only the kept contents are measured, so this is cheap for long chats
+        :param system_parts: the system instruction parts, including any summary
+        :param contents: the Gemini contents of the whole chat
+        :param summarised: the number of contents already covered by the summary, which are never sent
+        :return: (head, start), to send contents[:head] + contents[start:]
+        """
+        head = min(self.keep_first, len(contents)) if self.strategy == "keep_first" else 0
+        lowest = max(head, summarised if self.strategy == "summary" else 0)
+
+        budget = self.max_tokens - sum(estimate_tokens(part["text"]) for part in system_parts)
+        budget -= sum(content_tokens(content) for content in contents[:head])
+
+        start = self._fit(contents, lowest, budget)
+        if self.strategy == "summary" and start > lowest:
+            # Summarising takes a request, so make room for a few turns instead of summarising every turn
+            start = self._fit(contents, lowest, budget // 2)
+        return head, start
+
+    @staticmethod
+    def _fit(contents : list[dict], lowest : int, budget : int) -> int:
+        """
+        :return: the index of the earliest content (no earlier than lowest) where the rest of the contents fit in budget
+        """
+        start = len(contents)
+        while start > lowest:
+            budget -= content_tokens(contents[start - 1])
+            if budget < 0:
+                break
+            start -= 1
+
+        if start == lowest:
+            return start
+
+        # Always send the latest message, and start on a user turn, as models expect
+        start = min(start, len(contents) - 1)
+        while start < len(contents) - 1 and contents[start]["role"] != "user":
+            start += 1
+        return start
+
+    def summarise(self, summary : str | None, evicted : list[dict]) -> str:
+        """
+        Folds turns dropped from the context into the rolling summary
+        :param summary: the summary so far, if any
+        :param evicted: the Gemini contents being dropped
+        :return: the new summary
+        :raises ModelError: when the summariser fails
+        """
+        transcript = "\n\n".join(f"{content["role"]}: {"".join(part.get("text", "") for part in content["parts"])}"
+                                 for content in evicted)
+        prompt = ("Summarise the following conversation in a few short paragraphs, keeping any facts, decisions, "
+                  "names and instructions that later messages might rely on. Reply with only the summary.\n\n")
+        if summary:
+            prompt += f"Summary of the conversation before this:\n{summary}\n\n"
+        prompt += f"Conversation:\n{transcript}"
+
+        return self.summariser.invoke(prompt = prompt).strip()
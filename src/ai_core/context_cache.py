@@ -0,0 +1,127 @@
+import time
+from typing import TYPE_CHECKING, Callable
+
+from .context import content_tokens, estimate_tokens
+
+if TYPE_CHECKING:
+    from .model import GeminiModel
+
+
+class CachedContent:
+    """
+    A chat's system instruction and first contents, stored with Gemini's cachedContents API.
+    Requests referencing it only send the contents after them. Saved in the chat file, so it outlives the session
+    """
+    def __init__(self, name : str, model : str, contents : int, tokens : int, expire_time : float):
+        """
+        :param name: the name the API gave the cached content (cachedContents/...)
+        :param model: the name of the model the cache was made for, the only model that can use it
+        :param contents: the number of contents cached, after the system instruction
+        :param tokens: the estimated tokens cached
+        :param expire_time: the unix time the cache expires at
+        """
+        self.name = name
+        self.model = model
+        self.contents = contents
+        self.tokens = tokens
+        self.expire_time = expire_time
+        self.valid = True # Set to False when the API rejects the cache, so the chat replaces it
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "model": self.model, "contents": self.contents, "tokens": self.tokens,
+                "expire_time": self.expire_time}
+
+    @classmethod
+    def from_dict(cls, data : dict | None) -> "CachedContent | None":
+        if not data:
+            return None
+        return cls(data["name"], data["model"], data["contents"], data["tokens"], data["expire_time"])
+
+
+class ContextCache:
+    """
+    Keeps the stable start of a chat (its system instruction and history, up to the newest prompt) in Gemini's
+    context cache, so each request references the cache and only uploads the turns after it.
+    A new cache is only made once at least min_tokens haven't been cached, as creating one uploads the whole prefix.
+    Opt in per model, as cached tokens are billed for storage while the cache lives
+    """
+    def __init__(self, model : "GeminiModel", ttl : int = 3600, min_tokens : int = 4096):
+        """
+        :param model: the model to cache the chat for
+        :param ttl: the seconds a cache lives for. Caches still in use are kept alive for another ttl before they expire
+        :param min_tokens: the fewest uncached tokens worth caching. Gemini also rejects caches under a model dependent minimum
+        """
+        self.model = model
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.error = None # Why caching was turned off for the session, after the API refused to create a cache
+
+    def usable(self, cached : CachedContent, content_count : int) -> bool:
+        """
+        :param cached: a chat's cache
+        :param content_count: the number of contents in the chat
+        :return: whether a request for the chat can reference the cache
+        """
+        return (cached.valid and cached.model == self.model.model_name
+                and cached.contents < content_count # Requests need some contents of their own
+                and cached.expire_time > time.time() + 30) # Not expiring before the request gets there
+
+    def update(self, cached : CachedContent | None, system_parts : list[dict], contents,
+               encode : Callable[[int], str]) -> CachedContent | None:
+        """
+        Picks the cache for the next request, making a new one when enough of the chat isn't cached yet
+        :param cached: the chat's current cache, if any
+        :param system_parts: the system instruction parts of the request
+        :param contents: the Gemini contents of the whole chat, ending with the newest prompt
+        :param encode: encodes the system instruction and the first n contents as a request body
+        :return: the cache to reference, or None to send the whole chat. Replaces cached if that was deleted
+        """
+        if cached is not None and not self.usable(cached, len(contents)):
+            self.delete(cached)
+            cached = None
+
+        prefix = len(contents) - 1 # Everything but the newest prompt, which is answered then kept in the next prefix
+        uncached = sum(content_tokens(content) for content in contents[0 if cached is None else cached.contents:prefix])
+        if cached is None:
+            uncached += sum(estimate_tokens(part["text"]) for part in system_parts)
+
+        if uncached < self.min_tokens or self.error is not None:
+            if cached is not None and cached.expire_time - time.time() < self.ttl / 4:
+                self.extend(cached)
+            return cached
+
+        from .model import ModelError
+        try:
+            expire_time = time.time() + self.ttl # Before the request, so it's never later than the API's
+            name = self.model.create_cached_content(encode(prefix), self.ttl)
+        except ModelError as e:
+            self.error = str(e) # e.g. under the model's minimum, so don't pay for another upload every turn
+            return cached
+
+        if cached is not None:
+            self.delete(cached)
+        return CachedContent(name, self.model.model_name, prefix, (0 if cached is None else cached.tokens) + uncached, expire_time)
+
+    def extend(self, cached : CachedContent) -> None:
+        """
+        Keeps a cache that's still in use alive for another ttl
+        """
+        from .model import ModelError
+        try:
+            expire_time = time.time() + self.ttl
+            self.model.update_cached_content(cached.name, self.ttl)
+            cached.expire_time = expire_time
+        except ModelError:
+            pass # It still works until it expires, then a new one is made
+
+    def delete(self, cached : CachedContent) -> None:
+        """
+        Deletes a cache that's no longer used, rather than paying for it until it expires
+        """
+        if cached.model != self.model.model_name or cached.expire_time < time.time():
+            return
+        from .model import ModelError
+        try:
+            self.model.delete_cached_content(cached.name)
+        except ModelError:
+            pass # It expires on its own
@@ -0,0 +1,106 @@
+import os
+import stat
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows, which only has exclusive locks
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def atomic_write(path : str, encoding : str | None = "utf-8"):
+    """
+    Opens a temporary file to write instead of a file, which replaces the file once it's fully written.
+    Readers see either the old or the new file, and a crash or a concurrent writer can't leave it half written.
+    Replaced files keep their permissions, new files are only readable by the user
+    :param path: the path of the file to write
+    :param encoding: the text encoding of the file, or None to write bytes
+    :return: the open temporary file
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    # Named like tempfile.mkstemp, which is slow to import for a command that starts up in milliseconds
+    temp_path = os.path.join(directory, f".{name}.{os.urandom(6).hex()}.tmp")
+    descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        with os.fdopen(descriptor, "w" if encoding is not None else "wb", encoding=encoding) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno()) # Written to disk before the rename makes it the file
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class FileLock:
+    """
+    An advisory lock on a file between processes, held while a with block runs. Processes that don't lock the file
+    aren't stopped from using it. Locks a hidden .lock file next to the file, as atomic writes replace the file itself.
+    The .lock file may only be removed while holding the lock, by a process that no longer needs it
+    """
+    def __init__(self, path : str, shared : bool = False):
+        """
+        :param path: the path of the file to lock
+        :param shared: whether to take a shared lock, which other shared locks can hold at the same time.
+                       Used for reading. Exclusive where shared locks aren't supported
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        self.path = os.path.join(directory, f".{name}.lock")
+        self.shared = shared
+        self._file = None
+
+    def __enter__(self) -> "FileLock":
+        while True:
+            self._file = open(self.path, "a+b")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+                    if not self._current(): # Removed while waiting for it, so it no longer locks anything
+                        self._file.close()
+                        continue
+                else:
+                    self._file.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass # Gives up after 10 seconds, so keep waiting
+            except BaseException:
+                self._file.close()
+                raise
+            return self
+
+    def _current(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if fcntl is None:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close() # Releases the lock
+        self._file = None
+
+
+def file_state(path : str) -> tuple[int, int] | None:
+    """
+    :param path: the path of a file
+    :return: the identity and size of the file, which change when it's replaced or appended to. None if it doesn't exist
+    """
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return info.st_ino, info.st_size
@@ -0,0 +1,175 @@
+from array import array
+from collections.abc import Sequence
+
+
+class MessageStore(Sequence):
+    """
+    Compact storage for the messages of a chat. Instead of a dict and a string object per message, roles are stored
+    as one byte codes and every message's text is kept in a single UTF-8 buffer, with an array of offsets.
+    Reads like a list of {"role": ..., "content": ...} dictionaries, built when they are accessed
+    """
+    def __init__(self, messages = ()):
+        """
+        :param messages: {"role": ..., "content": ...} dictionaries to start with
+        """
+        self._role_names = ["user", "assistant", "system"] # Interned roles, indexed by their code
+        self._role_codes = {role : code for code, role in enumerate(self._role_names)}
+        self._roles = array("B")
+        self._text = bytearray()
+        self._ends = array("Q") # The end of each message's text in _text
+
+        # The indexes of the messages that aren't system messages, which are the Gemini contents.
+        # Empty while there are no system messages, as the indexes are then the same
+        self._content_indexes = array("Q")
+        self._system_count = 0
+
+        self.extend(messages)
+
+    def _role_code(self, role : str) -> int:
+        code = self._role_codes.get(role)
+        if code is None:
+            if len(self._role_names) == 256:
+                raise ValueError(f"Too many different message roles to store {role}")
+            code = len(self._role_names)
+            self._role_names.append(role)
+            self._role_codes[role] = code
+        return code
+
+    def append(self, role : str, content : str) -> None:
+        if role == "system":
+            if self._system_count == 0: # Start tracking which messages are contents
+                self._content_indexes.extend(range(len(self._roles)))
+            self._system_count += 1
+        elif self._system_count > 0:
+            self._content_indexes.append(len(self._roles))
+
+        self._roles.append(self._role_code(role))
+        self._text += content.encode("utf-8")
+        self._ends.append(len(self._text))
+
+    def pop(self) -> dict:
+        """
+        :return: the removed last message
+        """
+        message = self[-1]
+        if message["role"] == "system":
+            self._system_count -= 1
+            if self._system_count == 0:
+                self._content_indexes = array("Q")
+        elif self._system_count > 0:
+            self._content_indexes.pop()
+
+        self._roles.pop()
+        self._ends.pop()
+        del self._text[self._ends[-1] if self._ends else 0:]
+        return message
+
+    def extend(self, messages) -> None:
+        """
+        :param messages: {"role": ..., "content": ...} dictionaries to add
+        """
+        for message in messages:
+            self.append(message["role"], message["content"])
+
+    def prepend(self, messages) -> None:
+        """
+        :param messages: {"role": ..., "content": ...} dictionaries to add before the stored messages
+        """
+        roles = array("B")
+        text = bytearray()
+        ends = array("Q")
+        for message in messages:
+            roles.append(self._role_code(message["role"]))
+            text += message["content"].encode("utf-8")
+            ends.append(len(text))
+
+        shift = len(text)
+        roles.extend(self._roles)
+        text += self._text
+        ends.extend(end + shift for end in self._ends)
+        self._roles, self._text, self._ends = roles, text, ends
+
+        system_code = self._role_codes["system"]
+        self._system_count = roles.count(system_code)
+        self._content_indexes = array("Q", (i for i, code in enumerate(roles) if code != system_code)
+                                      if self._system_count > 0 else ())
+
+    def clear(self) -> None:
+        self._roles = array("B")
+        self._text = bytearray()
+        self._ends = array("Q")
+        self._content_indexes = array("Q")
+        self._system_count = 0
+
+    def role(self, index : int) -> str:
+        return self._role_names[self._roles[index]]
+
+    def content(self, index : int) -> str:
+        if index < 0:
+            index += len(self._roles)
+        start = self._ends[index - 1] if index > 0 else 0
+        return self._text[start:self._ends[index]].decode("utf-8")
+
+    def content_count(self) -> int:
+        """
+        :return: the number of messages that aren't system messages
+        """
+        return len(self._roles) - self._system_count
+
+    def content_index(self, index : int) -> int:
+        """
+        :param index: the index of a message among the messages that aren't system messages
+        :return: the index of the message in the store
+        """
+        return self._content_indexes[index] if self._system_count > 0 else index
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: the bytes used by the buffers of the store
+        """
+        return (len(self._text) + self._roles.itemsize * len(self._roles) + self._ends.itemsize * len(self._ends)
+                + self._content_indexes.itemsize * len(self._content_indexes))
+
+    def __len__(self) -> int:
+        return len(self._roles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if not -len(self._roles) <= index < len(self._roles):
+            raise IndexError("message index out of range")
+        return {"role" : self.role(index), "content" : self.content(index)}
+
+
+class PagedMessages(Sequence):
+    """
+    The messages of a chat whose older messages are still on disk, read like a single list.
+    Older messages are only read when they're accessed
+    """
+    def __init__(self, older : Sequence, recent : MessageStore):
+        """
+        :param older: the older messages, e.g. a ChatHistory
+        :param recent: the messages loaded in memory
+        """
+        self.older = older
+        self.recent = recent
+
+    def __len__(self) -> int:
+        return len(self.older) + len(self.recent)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            older_count = len(self.older)
+            older = self.older[start:min(stop, older_count)] if start < older_count else []
+            return older + self.recent[max(start - older_count, 0):max(stop - older_count, 0)]
+
+        if -len(self.recent) <= index < 0: # The latest messages, without indexing the older ones
+            return self.recent[index]
+        if index < 0:
+            index += len(self)
+        older_count = len(self.older)
+        return self.older[index] if 0 <= index < older_count else self.recent[index - older_count]
@@ -0,0 +1,159 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values : list[float], p : float) -> float | None:
+    """
+    :param values: the values to take the percentile of
+    :param p: the percentile, from 0 to 100
+    :return: the nearest-rank percentile, or None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class CallMetrics:
+    """
+    Timings and sizes of a single model call. Times are in seconds
+    """
+    def __init__(self, model_name : str, source : str, streamed : bool):
+        self.model = model_name
+        self.source = source
+        self.streamed = streamed
+        self.timestamp = time.time()
+        self._start = time.perf_counter()
+        self._last_chunk = None
+
+        self.connect_time = None # DNS, TCP and TLS setup. 0 when a pooled connection was reused
+        self.time_to_first_token = None
+        self.chunk_gaps = [] # The time between each streamed chunk of text
+        self.duration = None
+        self.prompt_tokens = None
+        self.response_tokens = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.cached = False
+        self.finish_reason = None
+        self.error = None
+
+    def text(self) -> None:
+        """
+        Records that a chunk of text arrived
+        """
+        now = time.perf_counter()
+        if self._last_chunk is None:
+            self.time_to_first_token = now - self._start
+        else:
+            self.chunk_gaps.append(now - self._last_chunk)
+        self._last_chunk = now
+
+    def usage(self, usage_metadata : dict) -> None:
+        """
+        :param usage_metadata: the usage the API reported, in Gemini's format
+        """
+        self.prompt_tokens = usage_metadata.get("promptTokenCount", self.prompt_tokens)
+        self.response_tokens = usage_metadata.get("candidatesTokenCount", self.response_tokens)
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "model": self.model,
+            "source": self.source,
+            "streamed": self.streamed,
+            "cached": self.cached,
+            "connect_time": self.connect_time,
+            "time_to_first_token": self.time_to_first_token,
+            "chunk_gap_p50": percentile(self.chunk_gaps, 50),
+            "chunk_gap_max": max(self.chunk_gaps, default=None),
+            "chunks": len(self.chunk_gaps) + (self._last_chunk is not None),
+            "duration": self.duration,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "finish_reason": self.finish_reason,
+            "error": self.error
+        }
+
+
+class JsonlMetricsSink:
+    """
+    A metrics listener that appends every call's metrics to a .jsonl file, one record per line
+    """
+    def __init__(self, path : str):
+        """
+        :param path: the path of the .jsonl file to append to
+        """
+        self.path = path
+        self._lock = threading.Lock() # Batches record calls from many threads
+
+    def __call__(self, metrics : CallMetrics) -> None:
+        line = json.dumps(metrics.to_dict()) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+
+@contextmanager
+def collect_metrics(model):
+    """
+    Collects the metrics of the model calls made inside the block
+    :param model: the model to collect the metrics of
+    :return: the list the metrics are added to
+    """
+    calls = []
+    model.metrics_listeners.append(calls.append)
+    try:
+        yield calls
+    finally:
+        model.metrics_listeners.remove(calls.append)
+
+
+def read_metrics(path : str) -> list[dict]:
+    """
+    :param path: the path of a .jsonl file written by JsonlMetricsSink
+    :return: the metrics records in the file, skipping any cut off line
+    """
+    records = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def summarise_metrics(records : list[dict]) -> dict[str, dict]:
+    """
+    :param records: metrics records, as written by JsonlMetricsSink
+    :return: per model, the number of calls, errors and cache hits, and the p50/p99 time to first token and duration
+    """
+    by_model = {}
+    for record in records:
+        by_model.setdefault(record["model"], []).append(record)
+
+    summaries = {}
+    for model_name, model_records in by_model.items():
+        first_tokens = [r["time_to_first_token"] for r in model_records if r["time_to_first_token"] is not None]
+        durations = [r["duration"] for r in model_records if r["duration"] is not None]
+        summaries[model_name] = {
+            "calls": len(model_records),
+            "errors": sum(r["error"] is not None for r in model_records),
+            "cached": sum(bool(r["cached"]) for r in model_records),
+            "first_token_p50": percentile(first_tokens, 50),
+            "first_token_p99": percentile(first_tokens, 99),
+            "duration_p50": percentile(durations, 50),
+            "duration_p99": percentile(durations, 99),
+            "response_tokens": sum(r["response_tokens"] or 0 for r in model_records)
+        }
+    return summaries
@@ -1,14 +1,32 @@
+import asyncio
 import json
-from typing import Iterator
+from typing import Iterator, AsyncIterator
 
 import requests
 
-from .util import connected_to_internet
+from .catalogue import ModelCatalogue
+from .context_cache import CachedContent, ContextCache
+from .metrics import CallMetrics
+from .payload import GeminiPayload
+from .response_cache import ResponseCache
+from .sse import SSEDecoder, ServerSentEvent
+from .transport import Transport, AsyncTransport
 
 
 class ModelError(Exception):
     """Base exception class for errors related to model output"""
-    pass
+    retryable_status_codes = (408, 429, 500, 502, 503, 504) # Timeouts, rate limits and server errors
+
+    def __init__(self, message : str = "", status_code : int = None, retryable : bool = None):
+        """
+        :param message: the error message
+        :param status_code: the HTTP status code of the failed call, if there was one
+        :param retryable: whether the same call could succeed later or on another model, e.g. when rate limited.
+                          Defaults to whether the status code is a timeout, rate limit or server error
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = status_code in self.retryable_status_codes if retryable is None else retryable
 
 class InvalidModelException(Exception):
     """Exception raised when an invalid model is requested"""
@@ -22,6 +40,24 @@ class InvalidAPIKeyException(InvalidModelException):
     """Exception raised when an invalid api key is given"""
     pass
 
+class StreamEvent:
+    """
+    A structured piece of a streamed response
+     - text: a chunk of the response text
+     - finish: why the model stopped (e.g. STOP, MAX_TOKENS, SAFETY)
+     - usage: the token usage of the request, as reported by the API
+    """
+    text = "text"
+    finish = "finish"
+    usage = "usage"
+
+    def __init__(self, kind : str, value):
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return f"StreamEvent({self.kind!r}, {self.value!r})"
+
 class ModelParameters:
     """
     A class to store and manage parameters
@@ -77,10 +113,47 @@ class GeminiModelParameters(ModelParameters):
             "maxOutputTokens": self.num_predict
         }
 
+class OllamaModelParameters(ModelParameters):
+    """
+    A class to store and manage parameters for Ollama model generation.
+    """
+    def __init__(
+        self,
+        temperature: float = 0.8,
+        top_k: int = 40,
+        top_p: float = 0.9,
+        num_predict: int = 128
+    ):
+        """
+        Initialize the parameters. Default is the ollama defaults
+        :param temperature: Controls randomness. Higher is more creative, lower is more deterministic.  Default: 0.8.
+        :param num_predict: Maximum number of tokens to generate.
+                     Default: 128. Use -1 for infinite, -2 to fill context.
+        :param top_k: Samples from the k most likely next tokens.   Default: 40.
+        :param top_p: Samples from the smallest set of tokens whose cumulative probability exceeds p.   Default: 0.9.
+        """
+        super().__init__(temperature, top_k, top_p, num_predict)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the parameters as a JSON dictionary for the options of an ollama request
+        """
+        return {
+            "temperature": self.temperature,
+            "top_k": self.top_k,
+            "top_p": self.top_p,
+            "num_predict": self.num_predict
+        }
+
 class Model:
     """
     Generic model to host LLM
     """
+    source = None
+    response_cache = None # Models that support response caching set this to a ResponseCache
+    context_window = None # Set to a ContextWindow to limit the chat history sent to the model
+    context_cache : ContextCache = None # Models that support context caching set this to cache the start of chats
+
     def __init__(self, model_name: str, api_key : str, debug: bool = False, parameters: ModelParameters = None):
         """
         :param model_name: The name of the model to use.
@@ -93,6 +166,34 @@ class Model:
         self.api_key = api_key
         self.debug = debug
         self.parameters = parameters
+        self.metrics_listeners = [] # Called with the CallMetrics of every call, see ai_core.metrics
+
+    def start_metrics(self, streamed : bool) -> CallMetrics:
+        """
+        :param streamed: whether the call is streamed
+        :return: the metrics to record a call into
+        """
+        return CallMetrics(self.model_name, self.source, streamed)
+
+    @staticmethod
+    def observe(metrics : CallMetrics, event : StreamEvent) -> StreamEvent:
+        """
+        Records a response event into the metrics of a call
+        :return: the event
+        """
+        match event.kind:
+            case StreamEvent.text: metrics.text()
+            case StreamEvent.finish: metrics.finish_reason = event.value
+            case StreamEvent.usage: metrics.usage(event.value)
+        return event
+
+    def emit_metrics(self, metrics : CallMetrics) -> None:
+        """
+        Finishes the metrics of a call and passes them to every metrics listener
+        """
+        metrics.finish()
+        for listener in self.metrics_listeners:
+            listener(metrics)
 
     def raise_model_exists(self):
         """
@@ -113,98 +214,636 @@ class Model:
         """
         pass
 
+    def stream_events(self, prompt : str = None, payload : dict = None) -> Iterator[StreamEvent]:
+        """
+        Streams the LLM output as structured events. Models that report finish reasons and usage override this
+        :param prompt: The prompt to invoke, optional
+        :param payload: The payload containing any extra data (e.g. chat history)
+        :return: the text, finish and usage events of the response
+        :raises ModelError: when an error occurs
+        """
+        for chunk in self.stream(prompt = prompt, payload = payload):
+            yield StreamEvent(StreamEvent.text, chunk)
+
+    async def ainvoke(self, prompt : str = None, payload : dict = None) -> str:
+        """
+        Async version of invoke. Runs invoke in a worker thread unless a model has a native implementation
+        :raises ModelError: when an error occurs
+        """
+        return await asyncio.to_thread(self.invoke, prompt = prompt, payload = payload)
+
+    async def astream(self, prompt : str = None, payload : dict = None) -> AsyncIterator[str]:
+        """
+        Async version of stream. Runs stream in a worker thread unless a model has a native implementation
+        :raises ModelError: when an error occurs
+        """
+        stream = self.stream(prompt = prompt, payload = payload)
+        finished = object()
+        while (chunk := await asyncio.to_thread(next, stream, finished)) is not finished:
+            yield chunk
+
+    async def ainvoke_chat(self, chat_payload : dict[str, dict[str, list]]) -> str:
+        """
+        Async version of invoke_chat
+        :param chat_payload: the chat data formatted for usage with the gemini API (chat.get_gemini_payload())
+        """
+        return await self.ainvoke(payload = chat_payload)
+
+    def astream_chat(self, chat_payload : dict[str, dict[str, list]]) -> AsyncIterator[str]:
+        """
+        Async version of stream_chat
+        :param chat_payload: the chat data formatted for usage with the gemini API (chat.get_gemini_payload())
+        :return: Async text stream for the LLM
+        """
+        return self.astream(payload = chat_payload)
+
 class LocalModel(Model):
     """Model specifically for local models (mainly, and probably exclusively, ollama)"""
     def __init__(self, model_name: str, debug: bool = False, parameters: ModelParameters = None):
         super().__init__(model_name, None, debug, parameters)
 
+class OllamaModel(LocalModel):
+    """
+    Interface to send prompts to models served by a local Ollama server, over its REST API
+    """
+    source = "ollama"
+    default_host = "http://localhost:11434"
+
+    def __init__(self, model_name: str, debug: bool = False, parameters: ModelParameters = None,
+                 host : str = None, keep_alive : str = "30m", validate : bool = True, transport : Transport = None):
+        """
+        :param model_name: The name of the model to use. Should be an existing ollama model (e.g. llama3 or llama3:8b)
+        :param debug: Display debug messages or not. Defaults to False
+        :param parameters: The model parameters to use. Gemini parameters are mapped to their ollama options
+        :param host: The url of the ollama server. Defaults to http://localhost:11434
+        :param keep_alive: How long ollama keeps the model loaded after a request, so it stays resident between turns.
+                           Defaults to 30 minutes
+        :param validate: Whether to check the model exists on creation. Defaults to True
+        :param transport: The pooled HTTP transport to send requests with. Defaults to the shared transport
+        :raises InvalidModelException: Raised when an error occurs retrieving model
+        """
+        super().__init__(model_name, debug, parameters)
+        self.host = (host or self.default_host).rstrip("/")
+        self.keep_alive = keep_alive
+        self.transport = Transport.shared() if transport is None else transport
+        if validate:
+            self.raise_model_exists()
+
+    def options(self) -> dict:
+        """
+        :return: the ollama options for the model parameters
+        """
+        if self.parameters is None:
+            return {}
+        return OllamaModelParameters(self.parameters.temperature, self.parameters.top_k,
+                                     self.parameters.top_p, self.parameters.num_predict).to_dict()
+
+    @staticmethod
+    def to_messages(chat_payload : dict) -> list[dict]:
+        """
+        Converts a chat payload (chat.get_gemini_payload()) into ollama chat messages
+        :param chat_payload: the chat data formatted for usage with the gemini API
+        :return: a list of {"role": ..., "content": ...} messages
+        """
+        messages = []
+        system_parts = chat_payload.get("system_instruction", {}).get("parts", [])
+        system_prompt = "\n".join(part["text"] for part in system_parts if part.get("text"))
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+
+        for content in chat_payload.get("contents", []):
+            role = "assistant" if content.get("role") == "model" else content.get("role", "user")
+            messages.append({"role": role, "content": "".join(part.get("text", "") for part in content["parts"])})
+        return messages
+
+    def get_response(self, prompt : str = None, payload : dict = None, stream : bool = False, timeout : int = 300,
+                     metrics : CallMetrics = None):
+        """
+        Gets the response from the model. Uses /api/chat when given a chat payload, /api/generate otherwise
+        :param prompt: An optional parameter for the current message being sent
+        :param payload: An optional chat payload (chat.get_gemini_payload()) containing the chat history
+        :param stream: If True, the response body will not be downloaded immediately. Defaults to False.
+        :param timeout: The timeout in seconds for the request. Defaults to 300, as loading a model can be slow
+        :param metrics: optional metrics to record the request size and connection time into
+        :return: The requests.Response object on a successful call.
+        :raises ModelError: Raised for any network-level errors or for non-2xx HTTP status codes.
+        """
+        body = {"model": self.model_name, "stream": stream, "keep_alive": self.keep_alive, "options": self.options()}
+        if payload is not None:
+            url = f"{self.host}/api/chat"
+            body["messages"] = self.to_messages(payload)
+        else:
+            url = f"{self.host}/api/generate"
+            body["prompt"] = "" if prompt is None else prompt
+        data = json.dumps(body).encode("utf-8")
+
+        try:
+            Transport.take_connect_time()
+            response = self.transport.post(url, headers={"Content-Type": "application/json"}, data=data,
+                                           stream=stream, timeout=timeout)
+            if metrics is not None:
+                metrics.bytes_sent = len(data)
+                metrics.connect_time = Transport.take_connect_time()
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            raise ModelError(f"HTTP error: {e.response.status_code} - {e.response.text}", e.response.status_code)
+        except requests.exceptions.RequestException as e:
+            raise ModelError(f"Error calling Ollama at {self.host}: {e}", retryable = True)
+
+        return response
+
+    @staticmethod
+    def response_text(response_json : dict) -> str:
+        """
+        :param response_json: a decoded /api/chat or /api/generate response, or streamed line
+        :return: the text in the response
+        :raises ModelError: when the response is an error
+        """
+        if "error" in response_json:
+            raise ModelError(f"Ollama error: {response_json["error"]}")
+        if "message" in response_json:
+            return response_json["message"].get("content", "")
+        return response_json.get("response", "")
+
+    @staticmethod
+    def response_events(response_json : dict) -> list[StreamEvent]:
+        """
+        :param response_json: a decoded /api/chat or /api/generate response, or streamed line
+        :return: the text, and once done the finish reason and token usage, as events
+        :raises ModelError: when the response is an error
+        """
+        events = []
+        text = OllamaModel.response_text(response_json)
+        if text:
+            events.append(StreamEvent(StreamEvent.text, text))
+        if response_json.get("done"):
+            events.append(StreamEvent(StreamEvent.finish, response_json.get("done_reason", "stop")))
+            prompt_tokens = response_json.get("prompt_eval_count", 0)
+            output_tokens = response_json.get("eval_count", 0)
+            events.append(StreamEvent(StreamEvent.usage, {"promptTokenCount": prompt_tokens,
+                                                          "candidatesTokenCount": output_tokens,
+                                                          "totalTokenCount": prompt_tokens + output_tokens}))
+        return events
+
+    def raise_model_exists(self):
+        """
+        Checks if the model has been pulled on the ollama server. Doesn't need an internet connection
+        :raises InvalidModelException: Raised when the model isn't available or the server can't be reached.
+        """
+        try:
+            response = self.transport.get(f"{self.host}/api/tags", timeout=10)
+            response.raise_for_status()
+            models = response.json().get("models", [])
+        except requests.exceptions.RequestException as e:
+            raise InvalidModelException(f"Could not reach ollama at {self.host}, check ollama is running: {e}")
+
+        available_model_ids = [model["name"] for model in models if "name" in model]
+        if self.model_name not in available_model_ids and f"{self.model_name}:latest" not in available_model_ids:
+            raise InvalidModelException(f"Model {self.model_name} is not a valid model name.\n"
+                                        f"Pull it first with 'ollama pull {self.model_name}'. "
+                                        f"Valid model names are: {", ".join(available_model_ids)}")
+
+    def invoke(self, prompt : str = None, payload : dict = None) -> str:
+        """
+        Invoke the LLM with the given prompt
+        :param prompt: The prompt to invoke
+        :param payload: The payload containing any extra data (e.g. chat history)
+        :return: The output message
+        :raises ModelError: when an error occurs
+        """
+        metrics = self.start_metrics(streamed = False)
+        try:
+            response = self.get_response(prompt = prompt, payload = payload, stream = False, metrics = metrics)
+            metrics.bytes_received = len(response.content)
+            response_json = response.json()
+            for event in self.response_events(response_json):
+                self.observe(metrics, event)
+            return self.response_text(response_json)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self.emit_metrics(metrics)
+
+    def stream(self, prompt : str = None, payload : dict = None) -> Iterator[str]:
+        """
+        Streamed the LLM output with the given prompt
+        :param prompt: The prompt to invoke, optional
+        :param payload: The payload containing any extra data (e.g. chat history)
+        :return: The output message
+        :raises ModelError: when an error occurs
+        """
+        for event in self.stream_events(prompt, payload):
+            if event.kind == StreamEvent.text:
+                yield event.value
+
+    def stream_events(self, prompt : str = None, payload : dict = None) -> Iterator[StreamEvent]:
+        """
+        Streams the LLM output as structured events
+        :param prompt: The prompt to invoke, optional
+        :param payload: The payload containing any extra data (e.g. chat history)
+        :return: the text, finish and usage events of the response
+        :raises ModelError: when an error occurs
+        """
+        metrics = self.start_metrics(streamed = True)
+        response = None
+        try:
+            response = self.get_response(prompt = prompt, payload = payload, stream = True, metrics = metrics)
+            for line in response.iter_lines():
+                metrics.bytes_received += len(line) + 1
+                if line:
+                    for event in self.response_events(json.loads(line)):
+                        yield self.observe(metrics, event)
+        except ValueError as e:
+            metrics.error = f"Invalid response from ollama: {e}"
+            raise ModelError(metrics.error)
+        except requests.exceptions.RequestException as e:
+            metrics.error = f"Error calling Ollama at {self.host}: {e}"
+            raise ModelError(metrics.error, retryable = True)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            if response is not None:
+                response.close()
+            self.emit_metrics(metrics)
+
+    def invoke_chat(self, chat_payload : dict[str, dict[str, list]]):
+        """
+        Get a single LLM output from a given Chat history
+        :param chat_payload: the chat data (chat.get_gemini_payload())
+        :return: the output message
+        """
+        return self.invoke(payload = chat_payload)
+
+    def stream_chat(self, chat_payload : dict[str, dict[str, list]]):
+        """
+        Get a streamed LLM output from a given Chat history
+        :param chat_payload: the chat data (chat.get_gemini_payload())
+        :return: Text stream for the LLM
+        """
+        return self.stream(payload = chat_payload)
+
 class GeminiModel(Model):
     """
     Interface to send prompts to Gemini models with Google API. Uses REST API over python SDK for finer-grained control
     """
-    def __init__(self, model_name: str, api_key : str, debug: bool = False, parameters: GeminiModelParameters = None):
+    source = "gemini"
+    base_url = "https://generativelanguage.googleapis.com/v1beta"
+
+    def __init__(self, model_name: str, api_key : str, debug: bool = False, parameters: GeminiModelParameters = None,
+                 validate : bool = True, catalogue : ModelCatalogue = None, transport : Transport = None,
+                 async_transport : AsyncTransport = None, response_cache : ResponseCache = None):
         """
         :param model_name: The name of the model to use. Should be existing ollama model
         :param api_key: The API key for accessing the model
         :param debug: Display debug messages or not. Defaults to False
         :param parameters: The model parameters to use
+        :param validate: Whether to check the model exists on creation. Defaults to True
+        :param catalogue: An optional cache of available models, used to skip the network check while fresh
+        :param transport: The pooled HTTP transport to send requests with. Defaults to the shared transport
+        :param async_transport: The pooled HTTP transport for the async methods. Defaults to the shared async transport
+        :param response_cache: An optional cache of responses to identical requests. Defaults to no caching
         :raises InvalidModelException: Raised when an error occurs retrieving model
         """
         super().__init__(model_name, api_key, debug, parameters)
-        self.raise_model_exists()
+        self.catalogue = catalogue
+        self.transport = Transport.shared() if transport is None else transport
+        self.async_transport = AsyncTransport.shared() if async_transport is None else async_transport
+        self.response_cache = response_cache
+        if validate:
+            self.raise_model_exists()
 
-    def get_response(self, prompt : str = None, payload : dict = None, stream : bool = False, timeout : int = 60):
+    def build_request(self, prompt : str = None, payload : dict = None, stream : bool = False) -> tuple[str, dict, str]:
         """
-        Gets the response from the model
+        Builds the request for a generation call. Shared by the sync and async methods
         :param prompt: An optional parameter for the current message being sent
         :param payload: A dictionary representing the JSON payload to be sent.
                         Contains data like chat history
-        :param stream: If True, the response body will not be downloaded immediately.
-                       Will not handle streaming-related errors. Defaults to False.
-        :param timeout: The timeout in seconds for the request. Defaults to 60.
-        :return: The requests.Response object on a successful call.
-        :raises ModelError: Raised for any network-level errors (e.g., connection, timeout) or for non-2xx HTTP status codes.
+        :param stream: Whether to request a streamed (server sent events) response
+        :return: the url, headers and JSON body of the request
         """
         if stream: #Pick the URL for streaming or not streaming
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model_name}:streamGenerateContent?alt=sse&key={self.api_key}"
+            url = f"{self.base_url}/models/{self.model_name}:streamGenerateContent?alt=sse&key={self.api_key}"
         else:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model_name}:generateContent?key={self.api_key}"
+            url = f"{self.base_url}/models/{self.model_name}:generateContent?key={self.api_key}"
 
         if payload is None:
             prompt = "" if prompt is None else prompt
             payload = {"contents": [{"parts": [{"text": prompt}]}]}
 
         # Add custom parameters if they exist
-        if self.parameters is not None:
-            payload["generationConfig"] = self.parameters.to_dict()
+        generation_config = None if self.parameters is None else self.parameters.to_dict()
+
+        if isinstance(payload, GeminiPayload): # Reuses the encoded chat history
+            data = payload.to_json(generation_config, self.cached_content_for(payload))
+        else:
+            if generation_config is not None:
+                payload = {**payload, "generationConfig": generation_config}
+            data = json.dumps(payload)
 
-        headers = {"Content-Type": "application/json"}
+        return url, {"Content-Type": "application/json"}, data
 
+    def cached_content_for(self, payload : dict | None) -> CachedContent | None:
+        """
+        :param payload: the payload of a request
+        :return: the context cache the request can reference instead of sending the start of the chat, if any
+        """
+        cached = getattr(payload, "cached_content", None)
+        if cached is None or not cached.valid or cached.model != self.model_name:
+            return None # e.g. a backup model, which can't use another model's cache
+        return cached
+
+    def rejected_cache(self, payload : dict | None, status_code : int, text : str) -> bool:
+        """
+        Checks whether an error response is the API refusing the context cache a request referenced,
+        e.g. because it was deleted or expired early. The cache is then marked invalid, so the chat replaces it
+        :return: whether the request should be sent again without the cache
+        """
+        cached = self.cached_content_for(payload)
+        if cached is None or status_code not in (400, 403, 404) or "cache" not in text.lower():
+            return False
+        cached.valid = False
+        return True
+
+    def cached_content_request(self, method : str, path : str, data : str = None) -> dict:
+        """
+        Sends a request to the cachedContents API
+        :param method: the HTTP method
+        :param path: the path after the base url, e.g. cachedContents or the name of a cached content
+        :param data: the JSON body, if any
+        :return: the decoded response
+        :raises ModelError: when the request fails
+        """
+        url = f"{self.base_url}/{path}?key={self.api_key}"
+        if method == "PATCH":
+            url += "&updateMask=ttl"
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(payload), stream=stream, timeout=timeout)
+            response = getattr(self.transport, method.lower())(url, headers={"Content-Type": "application/json"},
+                                                               data=None if data is None else data.encode("utf-8"), timeout=60)
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
-            raise ModelError(f"HTTP error: {e.response.status_code} - {e.response.text}")
+            raise ModelError(f"HTTP error: {e.response.status_code} - {e.response.text}", e.response.status_code)
         except requests.exceptions.RequestException as e:
-            raise ModelError(f"Error calling Gemini API: {e}")
+            raise ModelError(f"Error calling Gemini API: {e}", retryable = True)
+        return response.json() if response.content else {}
 
-        return response
+    def create_cached_content(self, body : str, ttl : int) -> str:
+        """
+        Stores the start of a chat in the context cache
+        :param body: the JSON system instruction and contents to cache, as encoded for a request
+        :param ttl: the seconds the cache lives for
+        :return: the name of the cached content, for requests to reference
+        :raises ModelError: when the cache can't be made, e.g. it has fewer tokens than the model's minimum
+        """
+        # Adds the model and ttl to the front of the encoded body, rather than decoding and encoding it again
+        data = f'{{"model": "models/{self.model_name}", "ttl": "{ttl}s", ' + body.lstrip()[1:]
+        return self.cached_content_request("POST", "cachedContents", data)["name"]
 
-    def raise_model_exists(self):
+    def update_cached_content(self, name : str, ttl : int) -> None:
         """
-        Checks if model name exists in gemini API
-        :raises InvalidModelException: Raised when an invalid model name is given. Also raised when there is no internet.
-        :raises NoInternetException: Raised when no internet connection is found while attempting to retrieve model
-        :raises InvalidAPIKeyException: Raised when an invalid API key is given.
+        :param name: the name of the cached content
+        :param ttl: the seconds from now the cache should live for
+        :raises ModelError: when the cache can't be updated
+        """
+        self.cached_content_request("PATCH", name, json.dumps({"ttl": f"{ttl}s"}))
+
+    def delete_cached_content(self, name : str) -> None:
+        """
+        :param name: the name of the cached content
+        :raises ModelError: when the cache can't be deleted
+        """
+        self.cached_content_request("DELETE", name)
+
+    def prepare_request(self, prompt : str = None, payload : dict = None, stream : bool = False) -> tuple[tuple[str, dict, str], str | None]:
+        """
+        Builds the request for a generation call and works out its response cache key
+        :return: the request (see build_request), and the cache key, or None if the response shouldn't be cached
+        """
+        request = self.build_request(prompt, payload, stream)
+        if self.response_cache is None:
+            return request, None
+
+        generation_config = None if self.parameters is None else self.parameters.to_dict()
+        if not self.response_cache.is_cacheable(generation_config):
+            return request, None
+
+        # Keyed on the body alone, so streamed and non-streamed calls share responses
+        return request, self.response_cache.key(self.model_name, request[2])
+
+    def cached_response(self, cache_key : str | None) -> list[str] | None:
         """
+        :param cache_key: the cache key from prepare_request
+        :return: the chunks of the cached response, or None if there isn't one
+        """
+        if cache_key is None:
+            return None
+        return self.response_cache.get(cache_key)
 
-        if not connected_to_internet():
-            raise NoInternetException(f"Error fetching model : Not connected to the internet")
+    @staticmethod
+    def response_text(response_json : dict) -> str:
+        """
+        :param response_json: the decoded generateContent response
+        :return: the text of the response
+        :raises ModelError: when the response has no text
+        """
+        events = GeminiModel.response_events(response_json)
+        if not any(event.kind == StreamEvent.text for event in events):
+            finish_reasons = [event.value for event in events if event.kind == StreamEvent.finish]
+            raise ModelError(f"The response has no text (finish reason: {finish_reasons[0] if finish_reasons else "unknown"})")
+        return "".join(event.value for event in events if event.kind == StreamEvent.text)
 
+    @staticmethod
+    def response_events(response_json : dict) -> list[StreamEvent]:
+        """
+        :param response_json: a decoded generateContent response, or a streamed chunk of one
+        :return: the text, finish reason and usage in the response, as events
+        :raises ModelError: when the response is an error
+        """
+        if "error" in response_json:
+            error = response_json["error"]
+            if isinstance(error, dict):
+                raise ModelError(f"Gemini error: {error.get("message", error)}", error.get("code"))
+            raise ModelError(f"Gemini error: {error}")
+
+        events = []
+        candidates = response_json.get("candidates") or [{}]
+        parts = (candidates[0].get("content") or {}).get("parts", [])
+        text = "".join(part["text"] for part in parts if "text" in part and not part.get("thought"))
+        if text:
+            events.append(StreamEvent(StreamEvent.text, text))
+        if "finishReason" in candidates[0]:
+            events.append(StreamEvent(StreamEvent.finish, candidates[0]["finishReason"]))
+        if "usageMetadata" in response_json:
+            events.append(StreamEvent(StreamEvent.usage, response_json["usageMetadata"]))
+        if "promptFeedback" in response_json and "blockReason" in response_json["promptFeedback"]:
+            events.append(StreamEvent(StreamEvent.finish, response_json["promptFeedback"]["blockReason"]))
+        return events
+
+    @staticmethod
+    def sse_events(event : ServerSentEvent) -> list[StreamEvent]:
+        """
+        :param event: a server sent event of a streamed response
+        :return: the text, finish reason and usage in the event
+        :raises ModelError: when the event is an error or isn't valid JSON
+        """
         try:
-            models_url = f"https://generativelanguage.googleapis.com/v1beta/models?key={self.api_key}"
-            response = requests.get(models_url)
+            chunk = json.loads(event.data)
+        except ValueError as e:
+            raise ModelError(f"Invalid event in the response stream: {e}")
+        return GeminiModel.response_events(chunk)
+
+    @staticmethod
+    def feed_decoder(decoder : SSEDecoder, data : bytes = None) -> list[ServerSentEvent]:
+        """
+        :param decoder: the server sent events decoder of a streamed response
+        :param data: the next bytes of the stream, or None at the end of the stream
+        :return: the server sent events the bytes completed
+        :raises ModelError: when an event isn't valid UTF-8
+        """
+        try:
+            return decoder.flush() if data is None else decoder.feed(data)
+        except UnicodeDecodeError as e:
+            raise ModelError(f"Invalid event in the response stream: {e}")
+
+    def decode_events(self, sse_events : list[ServerSentEvent], chunks : list[str], metrics : CallMetrics) -> Iterator[StreamEvent]:
+        """
+        :param sse_events: the server sent events decoded from the stream
+        :param chunks: the text chunks so far, which new text is added to for caching
+        :param metrics: the metrics of the call, which the events are recorded into
+        :return: the structured events of the server sent events
+        """
+        for sse_event in sse_events:
+            for event in self.sse_events(sse_event):
+                if event.kind == StreamEvent.text:
+                    chunks.append(event.value)
+                yield self.observe(metrics, event)
+
+    def get_response(self, prompt : str = None, payload : dict = None, stream : bool = False, timeout : int = 60,
+                     request : tuple[str, dict, str] = None, metrics : CallMetrics = None):
+        """
+        Gets the response from the model
+        :param prompt: An optional parameter for the current message being sent
+        :param payload: A dictionary representing the JSON payload to be sent.
+                        Contains data like chat history
+        :param stream: If True, the response body will not be downloaded immediately.
+                       Will not handle streaming-related errors. Defaults to False.
+        :param timeout: The timeout in seconds for the request. Defaults to 60.
+        :param request: An already built request (see build_request), used instead of the prompt and payload
+        :param metrics: optional metrics to record the request size and connection time into
+        :return: The requests.Response object on a successful call.
+        :raises ModelError: Raised for any network-level errors (e.g., connection, timeout) or for non-2xx HTTP status codes.
+        """
+        url, headers, data = self.build_request(prompt, payload, stream) if request is None else request
+        data = data.encode("utf-8")
+
+        try:
+            Transport.take_connect_time()
+            response = self.transport.post(url, headers=headers, data=data, stream=stream, timeout=timeout)
+            if metrics is not None:
+                metrics.bytes_sent = len(data)
+                metrics.connect_time = Transport.take_connect_time()
             response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            if self.rejected_cache(payload, e.response.status_code, e.response.text): # Send the whole chat instead
+                return self.get_response(payload = payload, stream = stream, timeout = timeout, metrics = metrics)
+            raise ModelError(f"HTTP error: {e.response.status_code} - {e.response.text}", e.response.status_code)
+        except requests.exceptions.RequestException as e:
+            raise ModelError(f"Error calling Gemini API: {e}", retryable = True)
 
-            models_data = response.json()
+        return response
+
+    async def aget_response(self, prompt : str = None, payload : dict = None, stream : bool = False, timeout : int = 60,
+                            request : tuple[str, dict, str] = None, metrics : CallMetrics = None):
+        """
+        Async version of get_response
+        :return: The httpx.Response on a successful call. Streamed responses must be closed by the caller
+        :raises ModelError: Raised for any network-level errors (e.g., connection, timeout) or for non-2xx HTTP status codes.
+        """
+        import httpx
 
-            available_model_ids = []
-            if "models" in models_data:
-                for model in models_data["models"]:
-                    model_id = model.get("name", "").split("/")[-1]
-                    if model_id:
-                        available_model_ids.append(model_id)
+        url, headers, data = self.build_request(prompt, payload, stream) if request is None else request
+        data = data.encode("utf-8")
 
-            if self.model_name not in available_model_ids:
-                raise InvalidModelException(f"Model {self.model_name} is not a valid model name.\n"
-                                            f"Valid model names are: {", ".join(available_model_ids)}")
+        on_connect = None
+        if metrics is not None:
+            metrics.bytes_sent = len(data)
+            metrics.connect_time = 0.0
+            on_connect = lambda seconds: setattr(metrics, "connect_time", metrics.connect_time + seconds)
+
+        try:
+            response = await self.async_transport.post(url, headers=headers, content=data, stream=stream, timeout=timeout,
+                                                       on_connect=on_connect)
+        except httpx.HTTPError as e:
+            raise ModelError(f"Error calling Gemini API: {e}", retryable = True)
 
+        if response.is_error:
+            await response.aread()
+            await response.aclose()
+            if self.rejected_cache(payload, response.status_code, response.text): # Send the whole chat instead
+                return await self.aget_response(payload = payload, stream = stream, timeout = timeout, metrics = metrics)
+            raise ModelError(f"HTTP error: {response.status_code} - {response.text}", response.status_code)
+
+        return response
+
+    def list_models(self) -> list[str]:
+        """
+        Fetches the names of every model available to this API key
+        :return: a list of model names
+        :raises NoInternetException: Raised when no internet connection is found while attempting to retrieve models
+        :raises InvalidAPIKeyException: Raised when the request for models fails, usually due to an invalid API key.
+        """
+        try:
+            models_url = f"{self.base_url}/models?key={self.api_key}"
+            response = self.transport.get(models_url)
+            response.raise_for_status()
+            models_data = response.json()
+        except requests.exceptions.ConnectionError as e:
+            # Only pay for the internet check once we know the request itself failed
+            from .util import connected_to_internet # Imports rich, which nothing else here needs
+            if not connected_to_internet():
+                raise NoInternetException(f"Error fetching model : Not connected to the internet")
+            raise InvalidAPIKeyException(f"Error fetching model: {e}\n"
+                                         f"Check your API key is correct")
         except requests.exceptions.RequestException as e:
             raise InvalidAPIKeyException(f"Error fetching model: {e}\n"
-                                        f"Check your API key is correct")
+                                         f"Check your API key is correct")
+
+        available_model_ids = []
+        for model in models_data.get("models", []):
+            model_id = model.get("name", "").split("/")[-1]
+            if model_id:
+                available_model_ids.append(model_id)
+
+        return available_model_ids
+
+    def raise_model_exists(self):
+        """
+        Checks if model name exists in gemini API
+        Uses the model catalogue if one was given and it is still fresh, only going to the network otherwise
+        :raises InvalidModelException: Raised when an invalid model name is given. Also raised when there is no internet.
+        :raises NoInternetException: Raised when no internet connection is found while attempting to retrieve model
+        :raises InvalidAPIKeyException: Raised when an invalid API key is given.
+        """
+        if self.catalogue is not None:
+            cached_model_ids = self.catalogue.get(self.source, self.api_key)
+            if cached_model_ids is not None and self.model_name in cached_model_ids:
+                return
+
+        try:
+            available_model_ids = self.list_models()
+        except InvalidModelException:
+            raise
         except Exception as e:
             raise InvalidModelException(f"An unexpected error occurred while fetching models: {e}")
 
+        if self.catalogue is not None:
+            self.catalogue.set(self.source, self.api_key, available_model_ids)
+
+        if self.model_name not in available_model_ids:
+            raise InvalidModelException(f"Model {self.model_name} is not a valid model name.\n"
+                                        f"Valid model names are: {", ".join(available_model_ids)}")
+
     def invoke(self, prompt : str = None, payload : dict = None) -> str:
         """
         Invoke the LLM with the given prompt
@@ -213,11 +852,33 @@ class GeminiModel(Model):
         :return: The output message
         :raises ModelError: when an error occurs
         """
-        response = self.get_response(prompt = prompt, payload = payload, stream = False)
+        metrics = self.start_metrics(streamed = False)
         try:
-            return response.json()['candidates'][0]['content']['parts'][0]['text']
-        except (KeyError, IndexError) as e:
-             raise ModelError(f"Error formatting the json response {e}")
+            request, cache_key = self.prepare_request(prompt, payload, stream = False)
+            if (cached := self.cached_response(cache_key)) is not None:
+                metrics.cached = True
+                metrics.text()
+                return "".join(cached)
+
+            response = self.get_response(payload = payload, stream = False, request = request, metrics = metrics)
+            metrics.bytes_received = len(response.content)
+            text = self.response_json_text(response.json(), metrics)
+            if cache_key is not None:
+                self.response_cache.set(cache_key, [text])
+            return text
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self.emit_metrics(metrics)
+
+    def response_json_text(self, response_json : dict, metrics : CallMetrics) -> str:
+        """
+        :return: the text of a generateContent response, recording its finish reason and usage into the metrics
+        """
+        for event in self.response_events(response_json):
+            self.observe(metrics, event)
+        return self.response_text(response_json)
 
     def stream(self, prompt : str = None, payload : dict = None) -> Iterator[str]:
         """
@@ -227,17 +888,122 @@ class GeminiModel(Model):
         :return: The output message
         :raises ModelError: when an error occurs
         """
-        response = self.get_response(prompt = prompt, payload = payload, stream = True)
+        for event in self.stream_events(prompt, payload):
+            if event.kind == StreamEvent.text:
+                yield event.value
+
+    def stream_events(self, prompt : str = None, payload : dict = None) -> Iterator[StreamEvent]:
+        """
+        Streams the LLM output as structured events, decoded straight from the raw bytes of the response
+        :param prompt: The prompt to invoke, optional
+        :param payload: The payload containing any extra data (e.g. chat history)
+        :return: the text, finish and usage events of the response. Cached responses only have text events
+        :raises ModelError: when an error occurs
+        """
+        metrics = self.start_metrics(streamed = True)
+        response = None
+        chunks = []
         try:
-            for chunk in response.iter_lines():
-                if chunk:
-                    decoded_chunk = chunk.decode("utf-8")
-                    if decoded_chunk.startswith('data: '):
-                        parsed_chunk = decoded_chunk[len('data: '):]
-                        json_chunk = json.loads(parsed_chunk)
-                        yield json_chunk['candidates'][0]['content']['parts'][0].get('text', '')
-        except Exception as e:
-            raise ModelError(f"An unexpected error occurred: {e}")
+            request, cache_key = self.prepare_request(prompt, payload, stream = True)
+            if (cached := self.cached_response(cache_key)) is not None:
+                metrics.cached = True
+                for chunk in cached:
+                    yield self.observe(metrics, StreamEvent(StreamEvent.text, chunk))
+                return
+
+            response = self.get_response(payload = payload, stream = True, request = request, metrics = metrics)
+            decoder = SSEDecoder()
+            for data in response.iter_content(chunk_size = None):
+                metrics.bytes_received += len(data)
+                yield from self.decode_events(self.feed_decoder(decoder, data), chunks, metrics)
+            yield from self.decode_events(self.feed_decoder(decoder), chunks, metrics)
+        except requests.exceptions.RequestException as e:
+            metrics.error = f"The connection to the Gemini API was lost mid-response: {e}"
+            raise ModelError(metrics.error, retryable = True)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            if response is not None:
+                response.close() # Hands the connection back to the pool, even if the stream was abandoned early
+            self.emit_metrics(metrics)
+
+        if cache_key is not None: # Only complete responses are cached
+            self.response_cache.set(cache_key, chunks)
+
+    async def ainvoke(self, prompt : str = None, payload : dict = None) -> str:
+        """
+        Async version of invoke, sent on the pooled async transport
+        :raises ModelError: when an error occurs
+        """
+        metrics = self.start_metrics(streamed = False)
+        try:
+            request, cache_key = self.prepare_request(prompt, payload, stream = False)
+            if (cached := self.cached_response(cache_key)) is not None:
+                metrics.cached = True
+                metrics.text()
+                return "".join(cached)
+
+            response = await self.aget_response(payload = payload, stream = False, request = request, metrics = metrics)
+            metrics.bytes_received = len(response.content)
+            text = self.response_json_text(response.json(), metrics)
+            if cache_key is not None:
+                self.response_cache.set(cache_key, [text])
+            return text
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self.emit_metrics(metrics)
+
+    async def astream(self, prompt : str = None, payload : dict = None) -> AsyncIterator[str]:
+        """
+        Async version of stream, sent on the pooled async transport
+        :raises ModelError: when an error occurs
+        """
+        async for event in self.astream_events(prompt, payload):
+            if event.kind == StreamEvent.text:
+                yield event.value
+
+    async def astream_events(self, prompt : str = None, payload : dict = None) -> AsyncIterator[StreamEvent]:
+        """
+        Async version of stream_events, sent on the pooled async transport
+        :raises ModelError: when an error occurs
+        """
+        import httpx
+
+        metrics = self.start_metrics(streamed = True)
+        response = None
+        chunks = []
+        try:
+            request, cache_key = self.prepare_request(prompt, payload, stream = True)
+            if (cached := self.cached_response(cache_key)) is not None:
+                metrics.cached = True
+                for chunk in cached:
+                    yield self.observe(metrics, StreamEvent(StreamEvent.text, chunk))
+                return
+
+            response = await self.aget_response(payload = payload, stream = True, request = request, metrics = metrics)
+            decoder = SSEDecoder()
+            async for data in response.aiter_bytes():
+                metrics.bytes_received += len(data)
+                for event in self.decode_events(self.feed_decoder(decoder, data), chunks, metrics):
+                    yield event
+            for event in self.decode_events(self.feed_decoder(decoder), chunks, metrics):
+                yield event
+        except httpx.HTTPError as e:
+            metrics.error = f"The connection to the Gemini API was lost mid-response: {e or type(e).__name__}"
+            raise ModelError(metrics.error, retryable = True)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            if response is not None:
+                await response.aclose()
+            self.emit_metrics(metrics)
+
+        if cache_key is not None: # Only complete responses are cached
+            self.response_cache.set(cache_key, chunks)
 
     def invoke_chat(self, chat_payload : dict[str, dict[str, list]]):
         """
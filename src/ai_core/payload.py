@@ -0,0 +1,177 @@
+import json
+from array import array
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+from .message_store import MessageStore
+
+if TYPE_CHECKING:
+    from .context_cache import CachedContent
+
+
+class GeminiPayload(dict):
+    """
+    A Gemini request payload ({"system_instruction": ..., "contents": [...]}) that can encode itself to JSON
+    reusing the already encoded history of the builder that made it
+    """
+    def __init__(self, builder : "GeminiPayloadBuilder", *args, window : tuple[int, int] = (0, 0), **kwargs):
+        super().__init__(*args, **kwargs)
+        self._builder = builder
+        self._window = window
+        self._contents = self.get("contents")
+        self.cached_content : "CachedContent | None" = None # The context cache holding the start of the chat, if any
+
+    def to_json(self, generation_config : dict = None, cached_content : "CachedContent" = None) -> str:
+        """
+        Encodes the payload, byte for byte the same as json.dumps() of the payload with generationConfig added
+        :param generation_config: optional generationConfig to add to the request
+        :param cached_content: the cache to reference instead of sending the system instruction and the contents it holds
+        :return: the JSON request body
+        """
+        if cached_content is not None and self._builder is not None and self["contents"] is self._contents:
+            return self._builder.to_json(generation_config, 0, cached_content.contents, cached_content = cached_content.name)
+        if self._builder is None or self["contents"] is not self._contents:
+            data = dict(self)
+            if not isinstance(data["contents"], list):
+                data["contents"] = list(data["contents"]) # json can't encode a GeminiContents view
+            if generation_config is not None:
+                data["generationConfig"] = generation_config
+            return json.dumps(data)
+        head, start = self._window
+        return self._builder.to_json(generation_config, head, start, self["system_instruction"]["parts"])
+
+
+class GeminiContents(Sequence):
+    """
+    The Gemini contents ({"role": ..., "parts": [{"text": ...}]}) of the messages in a MessageStore that aren't
+    system messages. Reads like a list, but the entries are only built when accessed, so they take no memory
+    """
+    def __init__(self, messages : MessageStore):
+        self._messages = messages
+
+    def __len__(self) -> int:
+        return self._messages.content_count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("content index out of range")
+        message_index = self._messages.content_index(index)
+        role = self._messages.role(message_index)
+        return {"role": "model" if role == "assistant" else role, "parts": [{"text": self._messages.content(message_index)}]}
+
+
+class GeminiPayloadBuilder:
+    """
+    Keeps the Gemini payload for a chat's messages up to date as messages are added and removed,
+    instead of rebuilding it every turn. Each content entry is JSON encoded once, and the encoded history
+    is cached so each request only encodes the new turns
+    """
+    def __init__(self, messages : MessageStore, system_prompt : str = ""):
+        """
+        :param messages: the chat's messages. The builder is told about each change to them with append, pop and clear
+        :param system_prompt: the chat's system prompt
+        """
+        self.system_parts = [{"text" : system_prompt}]
+        self.contents = GeminiContents(messages)
+
+        self._encoded_history = "" # The encoded contents, joined, up to _encoded_ends[-1]
+        self._encoded_ends = array("Q") # The end of each encoded content entry in _encoded_history
+
+    def set_system_prompt(self, system_prompt : str) -> None:
+        self.system_parts[0] = {"text" : system_prompt}
+
+    def append(self, message : dict) -> None:
+        """
+        :param message: the {"role": ..., "content": ...} message added to the chat
+        """
+        if message["role"] == "system":
+            self.system_parts.append({"text" : message["content"]})
+
+    def pop(self, message : dict) -> None:
+        """
+        :param message: the message removed from the end of the chat
+        """
+        if message["role"] == "system":
+            self.system_parts.pop()
+            return
+
+        if len(self._encoded_ends) > len(self.contents):
+            del self._encoded_ends[len(self.contents):]
+            self._encoded_history = self._encoded_history[:self._encoded_ends[-1] if self._encoded_ends else 0]
+
+    def clear(self) -> None:
+        del self.system_parts[1:]
+        self._encoded_history = ""
+        self._encoded_ends = array("Q")
+
+    def rebuild(self, system_prompt : str, messages : MessageStore) -> None:
+        """
+        Replaces the whole payload, e.g. after loading a chat
+        :param system_prompt: the chat's system prompt
+        :param messages: the chat's messages, after they were replaced
+        """
+        self.clear()
+        self.set_system_prompt(system_prompt)
+        for i in range(len(messages)):
+            if messages.role(i) == "system":
+                self.system_parts.append({"text" : messages.content(i)})
+
+    def payload(self, head : int = 0, start : int = 0, summary : str = None) -> GeminiPayload:
+        """
+        :param head: with start, only include contents[:head] + contents[start:]. Defaults to the whole history
+        :param start: the index of the first recent content to include
+        :param summary: optional summary of the left out contents, added to the system instruction
+        :return: the payload. Shares its lists with the builder, so should not be modified or kept across turns
+        """
+        system_parts = self.system_parts if summary is None else self.system_parts + [self.summary_part(summary)]
+        contents = self.contents if start == head else self.contents[:head] + self.contents[start:]
+        return GeminiPayload(self, {"system_instruction" : {"parts" : system_parts}, "contents" : contents},
+                             window = (head, start))
+
+    @staticmethod
+    def summary_part(summary : str) -> dict:
+        return {"text" : f"Summary of the earlier conversation:\n{summary}"}
+
+    def to_json(self, generation_config : dict = None, head : int = 0, start : int = 0, system_parts : list[dict] = None,
+                cached_content : str = None) -> str:
+        """
+        Encodes the payload, only encoding the contents added since the last call
+        :param generation_config: optional generationConfig to add to the request
+        :param head: with start, only include contents[:head] + contents[start:]. Defaults to the whole history
+        :param start: the index of the first recent content to include
+        :param system_parts: the system instruction parts to use instead of the builder's
+        :param cached_content: the name of a context cache to reference instead of the system instruction.
+                               It should hold the left out contents
+        :return: the JSON request body
+        """
+        new_contents = self.contents[len(self._encoded_ends):]
+        if new_contents:
+            pieces = [json.dumps(content) for content in new_contents]
+            history = [self._encoded_history] if self._encoded_ends else []
+            self._encoded_history = ", ".join(history + pieces)
+
+            end = self._encoded_ends[-1] if self._encoded_ends else -2 # No separator before the first entry
+            for piece in pieces:
+                end += 2 + len(piece)
+                self._encoded_ends.append(end)
+
+        encoded_contents = self._encoded_history
+        if start != head: # Slice the left out entries out of the encoded history
+            pieces = [self._encoded_history[:self._encoded_ends[head - 1]]] if head > 0 else []
+            if start < len(self.contents):
+                pieces.append(self._encoded_history[self._encoded_ends[start - 1] + 2:])
+            encoded_contents = ", ".join(pieces)
+
+        if cached_content is not None:
+            body = f'{{"cachedContent": {json.dumps(cached_content)}, "contents": [{encoded_contents}]'
+        else:
+            system_parts = self.system_parts if system_parts is None else system_parts
+            body = (f'{{"system_instruction": {json.dumps({"parts" : system_parts})}, '
+                    f'"contents": [{encoded_contents}]')
+        if generation_config is not None:
+            body += f', "generationConfig": {json.dumps(generation_config)}'
+        return body + "}"
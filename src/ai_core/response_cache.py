@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import time
+
+from .files import atomic_write
+
+
+class ResponseCache:
+    """
+    An on-disk cache of model responses, keyed on the model name and the exact request body
+    (the chat payload and generationConfig), so repeating an identical request doesn't call the API.
+    Responses are stored as the chunks they were streamed in, so cached responses can be replayed through stream()
+    """
+    def __init__(self, path : str, max_age : int = 7 * 24 * 60 * 60, max_size : int = 100 * 1024 * 1024,
+                 deterministic_only : bool = True):
+        """
+        :param path: the directory to store cached responses in
+        :param max_age: the number of seconds since its last use before a response is evicted. Defaults to a week
+        :param max_size: the total size in bytes the cache is trimmed to, least recently used first. Defaults to 100MB
+        :param deterministic_only: only cache requests with a temperature of 0. Defaults to True
+        """
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.deterministic_only = deterministic_only
+        self._writes = 0
+
+    def is_cacheable(self, generation_config : dict | None) -> bool:
+        """
+        :param generation_config: the generationConfig of the request
+        :return: whether responses to the request may be cached
+        """
+        if not self.deterministic_only:
+            return True
+        return generation_config is not None and generation_config.get("temperature") == 0
+
+    @staticmethod
+    def key(model_name : str, body : str) -> str:
+        """
+        :param model_name: the name of the model the request is for
+        :param body: the JSON request body
+        :return: the cache key of the request
+        """
+        return hashlib.sha256(f"{model_name}\n{body}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key : str) -> str:
+        return os.path.join(self.path, key + ".json")
+
+    @staticmethod
+    def _remove(entry_path : str) -> None:
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError: # Evicted by another process
+            pass
+
+    def get(self, key : str) -> list[str] | None:
+        """
+        :param key: the cache key of the request
+        :return: the chunks of the cached response, or None if not cached or expired
+        """
+        entry_path = self._entry_path(key)
+        try:
+            if time.time() - os.path.getmtime(entry_path) > self.max_age:
+                self._remove(entry_path)
+                return None
+            with open(entry_path, "r", encoding="utf-8") as file:
+                chunks = json.load(file)["chunks"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        try:
+            os.utime(entry_path) # Mark as recently used
+        except OSError: # Evicted by another process since it was read, which doesn't stop it being used
+            pass
+        return chunks
+
+    def set(self, key : str, chunks : list[str]) -> None:
+        """
+        Stores a complete response
+        :param key: the cache key of the request
+        :param chunks: the response text, as the chunks it was streamed in
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with atomic_write(self._entry_path(key)) as file:
+            json.dump({"chunks": chunks}, file, ensure_ascii=False)
+
+        if self._writes % 50 == 0: # Trimming scans the whole cache, so don't do it on every write
+            self.evict()
+        self._writes += 1
+
+    def evict(self) -> None:
+        """
+        Removes expired responses, then the least recently used responses until the cache fits in max_size
+        """
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(entry_path)
+            total_size -= size
+
+    def clear(self) -> None:
+        """
+        Removes every cached response
+        """
+        if os.path.exists(self.path):
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".json"): # Not the temporary files of responses being written
+                    self._remove(entry.path)
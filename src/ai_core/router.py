@@ -0,0 +1,208 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+
+from .model import Model, ModelError, StreamEvent
+from .transport import Transport, AsyncTransport
+
+
+class CircuitBreaker:
+    """
+    Tracks the failures of one model. After failure_threshold retryable failures in a row the circuit opens,
+    and the model is skipped for cooldown seconds. After that it is tried again: a success closes the circuit,
+    another failure opens it for another cooldown
+    """
+    def __init__(self, failure_threshold : int = 3, cooldown : float = 60):
+        """
+        :param failure_threshold: the failures in a row that open the circuit
+        :param cooldown: the seconds a model is skipped for once its circuit opens
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0.0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.cooldown
+
+
+class RouterModel(Model):
+    """
+    Sends each call to the first of several models whose circuit isn't open, failing over to the next one
+    on rate limits, server errors and lost connections.
+    With hedge_after set, a call that hasn't started answering after that many seconds is also sent to the next model,
+    and whichever answers first is used. The other call is dropped
+    """
+    source = "router"
+
+    def __init__(self, routes : list[Model], hedge_after : float = None, failure_threshold : int = 3, cooldown : float = 60):
+        """
+        :param routes: the models to send calls to, in order of preference. The same model with a different API key
+                       counts as a different route
+        :param hedge_after: the seconds to wait for the first response before also calling the next model.
+                            Defaults to only calling the next model when one fails
+        :param failure_threshold: the failures in a row after which a model is skipped for the cooldown
+        :param cooldown: the seconds a failing model is skipped for
+        """
+        if len(routes) == 0:
+            raise ValueError("A router needs at least one model")
+        super().__init__(routes[0].model_name, None)
+        self.routes = routes
+        for route in routes:
+            # Rate limits and server errors fail over to the next route, rather than being retried with backoff first
+            if getattr(route, "transport", None) is Transport.shared():
+                route.transport = Transport.routed()
+            if getattr(route, "async_transport", None) is AsyncTransport.shared():
+                route.async_transport = AsyncTransport.routed()
+        self.hedge_after = hedge_after
+        self.breakers = [CircuitBreaker(failure_threshold, cooldown) for _ in routes]
+        self.context_window = routes[0].context_window
+        self.context_cache = routes[0].context_cache # Caches are made for the first route. Other routes send the whole chat
+
+    def candidates(self) -> list[int]:
+        """
+        :return: the indexes of the routes to try, in order. Every route if they're all failing, rather than none
+        """
+        available = [i for i in range(len(self.routes)) if self.breakers[i].available()]
+        return available or list(range(len(self.routes)))
+
+    def _attempt(self, index : int, call : Callable[[Model], Iterator[StreamEvent]], events : queue.Queue,
+                 cancelled : threading.Event) -> None:
+        # Runs in its own thread. Puts (index, event) for each event, then (index, None), or (index, exception)
+        try:
+            stream = call(self.routes[index])
+            try:
+                for event in stream:
+                    if cancelled.is_set():
+                        return
+                    events.put((index, event))
+            finally:
+                if hasattr(stream, "close"):
+                    stream.close() # Closes the response of a dropped call
+            events.put((index, None))
+        except Exception as e:
+            events.put((index, e))
+
+    def race(self, call : Callable[[Model], Iterator[StreamEvent]]) -> Iterator[tuple[int, StreamEvent]]:
+        """
+        Makes a call on the routes, failing over and hedging as needed
+        :param call: makes the call on a route, returning its response events
+        :return: the index of the route that answered, with each event of its response
+        :raises ModelError: when every route failed, or a route failed in a way another route wouldn't fix
+        """
+        events = queue.Queue()
+        pending = self.candidates()
+        cancelled = {}
+        running = set()
+        winner = None
+        last_error = None
+
+        def start_next():
+            index = pending.pop(0)
+            cancelled[index] = threading.Event()
+            running.add(index)
+            threading.Thread(target=self._attempt, args=(index, call, events, cancelled[index]), daemon=True).start()
+
+        start_next()
+        hedge_at = None if self.hedge_after is None else time.monotonic() + self.hedge_after
+        try:
+            while True:
+                timeout = None
+                if winner is None and hedge_at is not None and pending:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    index, item = events.get(timeout = timeout)
+                except queue.Empty: # Nothing yet, hedge with the next route
+                    start_next()
+                    hedge_at = time.monotonic() + self.hedge_after
+                    continue
+
+                if winner is not None and index != winner:
+                    continue # A dropped call finishing
+
+                if isinstance(item, Exception):
+                    running.discard(index)
+                    retryable = isinstance(item, ModelError) and item.retryable
+                    if retryable:
+                        self.breakers[index].record_failure()
+                    if winner is not None or not retryable and not running:
+                        raise item
+                    last_error = item
+                    if not running:
+                        if not pending:
+                            raise last_error
+                        start_next() # Fail over
+                        if hedge_at is not None:
+                            hedge_at = time.monotonic() + self.hedge_after
+                    continue
+
+                if winner is None:
+                    winner = index
+                    for other in running - {index}:
+                        cancelled[other].set()
+                if item is None:
+                    self.breakers[index].record_success()
+                    return
+                yield index, item
+        finally:
+            for event in cancelled.values():
+                event.set()
+
+    def invoke(self, prompt : str = None, payload : dict = None) -> str:
+        """
+        Invoke the LLM with the given prompt, on the first route that answers
+        :raises ModelError: when an error occurs
+        """
+        metrics = self.start_metrics(streamed = False)
+        call = lambda route: iter([StreamEvent(StreamEvent.text, route.invoke(prompt = prompt, payload = payload))])
+        try:
+            text = ""
+            for index, event in self.race(call):
+                metrics.model = self.routes[index].model_name
+                text += self.observe(metrics, event).value
+            return text
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self.emit_metrics(metrics)
+
+    def stream(self, prompt : str = None, payload : dict = None) -> Iterator[str]:
+        """
+        Streams the LLM output with the given prompt, from the first route that answers
+        :raises ModelError: when an error occurs
+        """
+        for event in self.stream_events(prompt, payload):
+            if event.kind == StreamEvent.text:
+                yield event.value
+
+    def stream_events(self, prompt : str = None, payload : dict = None) -> Iterator[StreamEvent]:
+        metrics = self.start_metrics(streamed = True)
+        try:
+            for index, event in self.race(lambda route: route.stream_events(prompt = prompt, payload = payload)):
+                metrics.model = self.routes[index].model_name
+                yield self.observe(metrics, event)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self.emit_metrics(metrics)
+
+    def invoke_chat(self, chat_payload : dict[str, dict[str, list]]):
+        return self.invoke(payload = chat_payload)
+
+    def stream_chat(self, chat_payload : dict[str, dict[str, list]]):
+        return self.stream(payload = chat_payload)
@@ -0,0 +1,104 @@
+class ServerSentEvent:
+    """
+    A single dispatched server sent event
+    """
+    def __init__(self, data : str, event : str = "message", event_id : str = None, retry : int = None):
+        """
+        :param data: the event data. Multiple data: lines are joined with newlines
+        :param event: the event type. Defaults to message
+        :param event_id: the last event id seen in the stream, if any
+        :param retry: the reconnection time in milliseconds the server asked for, if any
+        """
+        self.data = data
+        self.event = event
+        self.event_id = event_id
+        self.retry = retry
+
+    def __repr__(self):
+        return f"ServerSentEvent(event={self.event!r}, data={self.data!r})"
+
+
+class SSEDecoder:
+    """
+    An incremental server sent events decoder, fed raw bytes as they arrive off the connection.
+    Follows the event stream format: events end at a blank line, their data: lines are joined,
+    comment lines (keep-alives) are skipped, and lines may end in \\n, \\r\\n or \\r.
+    Data is only decoded from UTF-8 once per event, not once per line
+    """
+    def __init__(self):
+        self._buffer = b""
+        self._pending_cr = False # The last chunk ended in \r, so a \n at the start of the next one is part of it
+        self._data = []
+        self._event = None
+        self.last_event_id = None
+        self.retry = None
+
+    def feed(self, chunk : bytes) -> list[ServerSentEvent]:
+        """
+        :param chunk: the next bytes of the stream, split anywhere
+        :return: the events completed by the chunk
+        :raises UnicodeDecodeError: when an event isn't valid UTF-8
+        """
+        if self._pending_cr and chunk.startswith(b"\n"):
+            chunk = chunk[1:]
+        self._pending_cr = chunk.endswith(b"\r")
+
+        self._buffer += chunk
+        if b"\r" in self._buffer:
+            # Normalise line endings. A trailing \r already ends its line, so it can be turned into \n too
+            self._buffer = self._buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        events = []
+        lines = self._buffer.split(b"\n")
+        self._buffer = lines.pop() # The unfinished line, if any
+        for line in lines:
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> list[ServerSentEvent]:
+        """
+        Ends the stream, dispatching an event left without a final blank line
+        :return: the remaining event, if any
+        :raises UnicodeDecodeError: when the event isn't valid UTF-8
+        """
+        events = []
+        if self._buffer:
+            event = self._process_line(self._buffer)
+            self._buffer = b""
+            if event is not None:
+                events.append(event)
+        event = self._process_line(b"")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line : bytes) -> ServerSentEvent | None:
+        if not line: # A blank line dispatches the event
+            if not self._data:
+                self._event = None
+                return None
+            event = ServerSentEvent(b"\n".join(self._data).decode("utf-8"), (self._event or "message"),
+                                    self.last_event_id, self.retry)
+            self._data = []
+            self._event = None
+            return event
+
+        if line.startswith(b":"): # Comment, usually a keep-alive
+            return None
+
+        field, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+
+        match field:
+            case b"data": self._data.append(value)
+            case b"event": self._event = value.decode("utf-8")
+            case b"id":
+                if b"\0" not in value:
+                    self.last_event_id = value.decode("utf-8")
+            case b"retry":
+                if value.isdigit():
+                    self.retry = int(value)
+        return None
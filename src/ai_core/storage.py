@@ -0,0 +1,437 @@
+import json
+import mmap
+import os
+from array import array
+from collections.abc import Sequence
+
+from .files import atomic_write
+
+
+class ChatStore:
+    """
+    Reads and writes chat files of a single on-disk format.
+    Chat data is a dictionary of header values (model, system_prompt, ...) plus a "messages" list
+    """
+    extension = None
+    supports_append = False
+
+    def load(self, path : str) -> dict | None:
+        """
+        Loads the chat data from a file
+        :param path: the path of the chat file
+        :return: the chat data, or None if the file is empty
+        :raises FileNotFoundError: Raised when no file exists at the path
+        :raises ValueError: Raised when the file isn't a valid chat
+        """
+        raise NotImplementedError
+
+    def load_tail(self, path : str, count : int) -> tuple[dict | None, "ChatHistory | None"]:
+        """
+        Loads the chat header and only the last messages of a file, leaving the older messages on disk
+        Formats that can't be read from the end load every message
+        :param path: the path of the chat file
+        :param count: the number of messages to load
+        :return: the chat data (None if the file is empty), and the older messages still on disk, if any
+        :raises FileNotFoundError: Raised when no file exists at the path
+        :raises ValueError: Raised when the file isn't a valid chat
+        """
+        return self.load(path), None
+
+    def save(self, path : str, data : dict) -> None:
+        """
+        Writes the full chat data to a file, replacing anything already there.
+        The file is replaced in one step, so it's never left half written
+        :param path: the path of the chat file
+        :param data: the chat data
+        """
+        raise NotImplementedError
+
+    def append(self, path : str, records : list[dict]) -> None:
+        """
+        Appends change records to an existing chat file. Only supported by log based formats
+        :param path: the path of the chat file
+        :param records: messages, or operation records ({"op": "header" | "pop" | "clear", ...})
+        """
+        raise NotImplementedError(f"{self.extension} chat files can't be appended to")
+
+
+class YamlChatStore(ChatStore):
+    """
+    The original chat format, one yaml document per chat. Every save rewrites the whole file
+    """
+    extension = ".yaml"
+
+    def load(self, path : str) -> dict | None:
+        import yaml # Only old chats are yaml, so don't pay for importing it on every start up
+
+        with open(path, "r") as file:
+            try:
+                data = yaml.safe_load(file)
+            except yaml.YAMLError as e:
+                raise ValueError(e)
+
+        if data is not None and not isinstance(data, dict):
+            raise ValueError(f"{path} does not contain a chat")
+        return data
+
+    def save(self, path : str, data : dict) -> None:
+        import yaml
+
+        with atomic_write(path) as file:
+            yaml.dump(data, file, default_flow_style=False, sort_keys=False)
+
+
+class JsonlChatStore(ChatStore):
+    """
+    An append-only log of chat changes, one JSON record per line.
+    The first line is a header record, every message added afterwards is a single appended line.
+    Header changes, removed messages and clears are appended as operation records and replayed on load,
+    so no change ever rewrites the file. save() compacts the log back down to a header and the messages.
+    A last record cut short by a crash mid-append is ignored, and removed by the next append
+    """
+    extension = ".jsonl"
+    supports_append = True
+
+    def load(self, path : str) -> dict | None:
+        with open(path, "r", encoding="utf-8") as file:
+            return self._replay(file)
+
+    def _replay(self, lines) -> dict | None:
+        """
+        :param lines: the lines of a chat file
+        :return: the chat data, or None if there are no records
+        """
+        header = {}
+        messages = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if not line.endswith("\n"):
+                    break # Cut short by a crash
+                raise
+
+            match record.pop("op", None):
+                case None: messages.append(record)
+                case "header": header.update(record)
+                case "pop": messages.pop()
+                case "clear": messages = []
+                case op: raise ValueError(f"Unknown chat record operation {op}")
+
+        if len(header) == 0 and len(messages) == 0:
+            return None
+
+        header["messages"] = messages
+        return header
+
+    def save(self, path : str, data : dict) -> None:
+        with atomic_write(path) as file:
+            file.writelines(self._lines(data))
+
+    def _lines(self, data : dict) -> list[str]:
+        header = {key : value for key, value in data.items() if key != "messages"}
+        lines = [self._encode({"op": "header", **header})]
+        lines.extend(self._encode(message) for message in data.get("messages", []))
+        return lines
+
+    def load_tail(self, path : str, count : int) -> tuple[dict | None, "ChatHistory | None"]:
+        # Reads records backwards from the end of the file, so the time taken doesn't grow with the chat.
+        # Pops remove the message before them, so they are counted and skip the next messages found
+        if os.path.getsize(path) == 0:
+            return None, None
+
+        header = {}
+        messages = [] # Newest first
+        pops = 0
+        cleared = False
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = len(data) # The start of the last record read
+            while position > 0 and len(messages) < count:
+                line_start = data.rfind(b"\n", 0, position - 1) + 1
+                line = data[line_start:position].strip()
+                last_line = position == len(data)
+                position = line_start
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if last_line and data[-1:] != b"\n":
+                        continue # Cut short by a crash
+                    raise
+
+                match record.pop("op", None):
+                    case None:
+                        if pops > 0:
+                            pops -= 1
+                        else:
+                            messages.append(record)
+                    case "header":
+                        for key, value in record.items():
+                            header.setdefault(key, value) # Later header records win
+                    case "pop": pops += 1
+                    case "clear":
+                        cleared = True
+                        break
+                    case op: raise ValueError(f"Unknown chat record operation {op}")
+
+            # Header records can be anywhere, but are found without parsing the older messages.
+            # Messages are encoded JSON, so their text can't contain an unescaped {"op": "header"
+            search_end = position
+            while search_end > 0:
+                found = data.rfind(self.header_prefix, 0, search_end)
+                if found == -1:
+                    break
+                if found == 0 or data[found - 1] == ord("\n"):
+                    line_end = data.find(b"\n", found)
+                    record = json.loads(data[found:line_end if line_end != -1 else len(data)])
+                    for key, value in record.items():
+                        if key != "op":
+                            header.setdefault(key, value)
+                search_end = found
+
+        history = ChatHistory(path, position, pops) if position > 0 and not cleared else None
+        if len(header) == 0 and len(messages) == 0 and history is None:
+            return None, None
+
+        header["messages"] = messages[::-1]
+        return header, history
+
+    def append(self, path : str, records : list[dict]) -> None:
+        data = "".join(self._encode(record) for record in records).encode("utf-8")
+        with open(path, "ab+") as file:
+            end = file.seek(0, os.SEEK_END)
+            if end > 0:
+                file.seek(end - 1)
+                if file.read(1) != b"\n":
+                    data = self._end_last_record(file) + data
+            file.write(data) # One write, so readers don't see most of the records without the rest
+
+    @staticmethod
+    def _end_last_record(file) -> bytes:
+        """
+        Deals with a file whose last record has no line end, before appending to it
+        :param file: the chat file, open for appending
+        :return: the line end to add, if the record is complete. A record cut short by a crash is removed
+        """
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = data.rfind(b"\n") + 1
+            try:
+                json.loads(data[start:])
+                return b"\n"
+            except ValueError:
+                pass
+        file.truncate(start)
+        return b""
+
+    def read_records(self, path : str, start : int) -> list[dict]:
+        """
+        Reads the records appended to a chat file after an offset, e.g. by another process
+        :param path: the path of the chat file
+        :param start: the offset of the first record to read, at the start of a line
+        :return: the records, including their "op"
+        """
+        records = []
+        with open(path, "rb") as file:
+            file.seek(start)
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    if not line.endswith(b"\n"):
+                        break # Cut short by a crash
+                    raise
+        return records
+
+    @staticmethod
+    def _encode(record : dict) -> str:
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+    # Records are encoded with "op" as their first key, so operation records can be told apart by their first bytes
+    op_prefix = b'{"op": '
+    header_prefix = b'{"op": "header"'
+
+
+class ArchivedChatStore(JsonlChatStore):
+    """
+    Chats moved to cold storage: a compacted .jsonl chat compressed with gzip.
+    They're restored to .jsonl before they're chatted in, so every save rewrites the whole file
+    """
+    extension = ".jsonl.gz"
+    supports_append = False
+    compress_level = 6 # Most of the size reduction of 9, in a fraction of the time
+
+    def load(self, path : str) -> dict | None:
+        import gzip # Only needed for archived chats, so don't pay for importing it on every start up
+        import zlib
+
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                return self._replay(file)
+        except FileNotFoundError:
+            raise
+        except (OSError, EOFError, zlib.error) as e: # Not gzip, or cut short
+            raise ValueError(f"{path} is not a valid archived chat: {e}")
+
+    def load_tail(self, path : str, count : int) -> tuple[dict | None, "ChatHistory | None"]:
+        return self.load(path), None # Compressed files can't be read from the end
+
+    def save(self, path : str, data : dict) -> None:
+        self.write(path, self.compress(data))
+
+    def compress(self, data : dict) -> bytes:
+        """
+        :param data: the chat data
+        :return: the contents of an archived chat file of the data, e.g. to check it's smaller before writing it
+        """
+        import gzip
+
+        return gzip.compress("".join(self._lines(data)).encode("utf-8"), self.compress_level, mtime = 0)
+
+    def write(self, path : str, compressed : bytes) -> None:
+        """
+        :param path: the path of the archived chat file
+        :param compressed: the contents from compress
+        """
+        with atomic_write(path, encoding = None) as file:
+            file.write(compressed)
+
+    def append(self, path : str, records : list[dict]) -> None:
+        ChatStore.append(self, path, records)
+
+    def read_records(self, path : str, start : int) -> list[dict]:
+        raise NotImplementedError(f"{self.extension} chat files can't be appended to")
+
+
+class ChatHistory(Sequence):
+    """
+    The older messages of a .jsonl chat file opened with load_tail, left on disk until they're needed.
+    The first time they're needed their records are indexed by file offset, without parsing them,
+    so only the messages that are read get parsed
+    """
+    system_prefix = b'{"role": "system"' # Messages are encoded with "role" as their first key
+
+    def __init__(self, path : str, end : int, pops : int = 0):
+        """
+        :param path: the path of the chat file
+        :param end: the offset of the first record that was already loaded. The older messages are before it
+        :param pops: the number of messages before end removed by pop records after it
+        """
+        self.path = path
+        self.end = end
+        self.pops = pops
+        info = os.stat(path)
+        self._inode, self._size = info.st_ino, info.st_size
+        self._offsets = None # The offset of each message left, once indexed
+        self._system = None # Whether each message left is a system message
+
+    def _open(self) -> mmap.mmap:
+        info = os.stat(self.path)
+        if info.st_ino != self._inode or info.st_size < self._size: # Appending is fine, but the older records must still be there
+            raise ValueError(f"{self.path} was rewritten since it was loaded")
+        with open(self.path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def offsets(self) -> array:
+        """
+        :return: the file offset of each older message, indexing them the first time
+        """
+        if self._offsets is None:
+            offsets = array("Q")
+            system = bytearray()
+            with self._open() as data:
+                position = 0
+                while position < self.end:
+                    line_end = data.find(b"\n", position, self.end)
+                    line_end = self.end if line_end == -1 else line_end
+                    prefix = data[position:min(position + len(self.system_prefix), line_end)]
+                    if prefix.startswith(JsonlChatStore.op_prefix):
+                        match json.loads(data[position:line_end]).get("op"):
+                            case "pop":
+                                offsets.pop()
+                                system.pop()
+                            case "clear":
+                                offsets = array("Q")
+                                system = bytearray()
+                    elif prefix.startswith(b"{") or data[position:line_end].strip():
+                        offsets.append(position)
+                        system.append(prefix == self.system_prefix)
+                    position = line_end + 1
+            kept = max(0, len(offsets) - self.pops)
+            del offsets[kept:]
+            del system[kept:]
+            self._offsets = offsets
+            self._system = system
+        return self._offsets
+
+    def system_count(self) -> int:
+        """
+        :return: the number of older messages that are system messages, which are part of every request
+        """
+        self.offsets()
+        return self._system.count(1)
+
+    def _read(self, offsets) -> list[dict]:
+        with self._open() as data:
+            messages = []
+            for offset in offsets:
+                line_end = data.find(b"\n", offset, self.end)
+                messages.append(json.loads(data[offset:line_end if line_end != -1 else self.end]))
+            return messages
+
+    def take_last(self, count : int = None) -> list[dict]:
+        """
+        Reads the newest older messages, removing them from the history
+        :param count: the number of messages to read. Reads them all if None
+        :return: the messages, oldest first
+        """
+        offsets = self.offsets()
+        first = 0 if count is None else max(0, len(offsets) - count)
+        messages = self._read(offsets[first:])
+        del offsets[first:]
+        del self._system[first:]
+        return messages
+
+    def __len__(self) -> int:
+        return len(self.offsets())
+
+    def __getitem__(self, index):
+        offsets = self.offsets()
+        if isinstance(index, slice):
+            return self._read(offsets[index])
+        return self._read([offsets[index]])[0]
+
+
+chat_stores = {store.extension : store for store in (JsonlChatStore(), YamlChatStore(), ArchivedChatStore())}
+
+def chat_extension(path : str) -> str:
+    """
+    :param path: the path of a chat file
+    :return: the chat format extension of the path (e.g. .jsonl or .jsonl.gz), or "" if it isn't a chat file
+    """
+    name = os.path.basename(path)
+    return max((extension for extension in chat_stores if name.endswith(extension)), key=len, default="")
+
+def chat_name(path : str) -> str:
+    """
+    :param path: the path of a chat file
+    :return: the name of the chat, which is its file name without the chat format extension
+    """
+    name = os.path.basename(path)
+    return name[:len(name) - len(chat_extension(name))]
+
+def get_chat_store(path : str) -> ChatStore:
+    """
+    Picks the chat format from the file extension
+    :param path: the path of the chat file
+    :return: the ChatStore for the format
+    :raises ValueError: Raised when the extension isn't a known chat format
+    """
+    extension = chat_extension(path)
+    if extension == "":
+        raise ValueError(f"{path} is not a supported chat file. Supported formats: {", ".join(chat_stores)}")
+    return chat_stores[extension]
@@ -1,4 +1,18 @@
 import re
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def compile_template(prompt : str, prefix : str, suffix : str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """
+    Splits a template prompt into its literal text and token slots. Cached process-wide
+    :param prompt: The prompt containing tokens
+    :param prefix: The string that marks the beginning of a token
+    :param suffix: The string that marks the end of a token
+    :return: (literals, tokens), where the prompt is literals[0] + token[0] + literals[1] + ... + literals[-1]
+    """
+    pieces = re.split(f"{re.escape(prefix)}(.*?){re.escape(suffix)}", prompt)
+    return tuple(pieces[0::2]), tuple(pieces[1::2])
 
 class Template:
     def __init__(self, prompt : str,
@@ -47,24 +61,29 @@ class Template:
             arguments.update(_arguments)
         arguments.update(kwargs)
 
-        tokens_found = re.findall(f"{re.escape(self.prefix)}(.*?){re.escape(self.suffix)}", self.prompt)
-        if not tokens_found:  # No tokens to replace
+        literals, tokens = compile_template(self.prompt, self.prefix, self.suffix)
+        if not tokens:  # No tokens to replace
             return self.prompt
 
-        formatted_prompt = self.prompt
-        for token in set(tokens_found):
-            full_token = f"{self.prefix}{token}{self.suffix}"
+        warned = set()
+        output = [literals[0]]
+        for token, literal in zip(tokens, literals[1:]):
             if token in arguments:
-                formatted_prompt = formatted_prompt.replace(full_token, str(arguments[token]))
+                output.append(str(arguments[token]))
             elif self.default_arguments and token in self.default_arguments:
-                formatted_prompt = formatted_prompt.replace(full_token, str(self.default_arguments[token]))
+                output.append(str(self.default_arguments[token]))
             else:
                 match self.missing_behaviour:
-                    case "empty": formatted_prompt = formatted_prompt.replace(full_token, "")
-                    case "warn" : print(f"WARNING: Token {token} was not be replaced")
-                    case "ignore" : pass
+                    case "empty": pass
+                    case "warn":
+                        if token not in warned:
+                            print(f"WARNING: Token {token} was not be replaced")
+                            warned.add(token)
+                        output.append(f"{self.prefix}{token}{self.suffix}")
+                    case _: output.append(f"{self.prefix}{token}{self.suffix}")
+            output.append(literal)
 
-        return formatted_prompt
+        return "".join(output)
 
     def partial_format(self, _arguments: dict = None, **kwargs) -> "Template":
         """
@@ -73,7 +92,7 @@ class Template:
         :param kwargs: Arbitrary keyword args where each keyword is a token name and its value is the replacement.
         :return: The partially formatted template
         """
-        formatted_string = format(_arguments, **kwargs)
+        formatted_string = self.format(_arguments, **kwargs)
         return Template(formatted_string, self.prefix, self.suffix, self.missing_behaviour, self.default_arguments)
 
     def expected_tokens(self) -> set[str]:
@@ -81,4 +100,4 @@ class Template:
         Gets all tokens present in the template.
         :return: A set of all tokens that may be replaced in the template
         """
-        return set(re.findall(f"{re.escape(self.prefix)}(.*?){re.escape(self.suffix)}", self.prompt))
\ No newline at end of file
+        return set(compile_template(self.prompt, self.prefix, self.suffix)[1])
\ No newline at end of file
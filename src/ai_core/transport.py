@@ -0,0 +1,256 @@
+import asyncio
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+_connect_timer = threading.local() # Seconds spent opening connections on each thread, for metrics
+
+
+class _TimedConnection:
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timer.seconds = getattr(_connect_timer, "seconds", 0.0) + time.perf_counter() - start
+
+class _TimedHTTPConnection(_TimedConnection, HTTPConnection):
+    pass
+
+class _TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    pass
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that times how long new connections take to open (DNS, TCP and TLS)
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+class _CappedRetry(Retry):
+    """
+    A Retry that only retries the statuses in its status_forcelist, and waits at most max_retry_after seconds
+    when a response asks to be retried later
+    """
+    max_retry_after = None
+
+    def is_retry(self, method : str, status_code : int, has_retry_after : bool = False) -> bool:
+        # urllib3 also retries any 413, 429 or 503 with a Retry-After header, even when those statuses weren't asked for
+        return status_code in (self.status_forcelist or ()) and super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None or self.max_retry_after is None:
+            return retry_after
+        return min(retry_after, self.max_retry_after)
+
+    def new(self, **kwargs) -> "_CappedRetry":
+        retry = super().new(**kwargs)
+        retry.max_retry_after = self.max_retry_after
+        return retry
+
+
+class Transport:
+    """
+    A pooled, keep-alive HTTP session used by models to talk to their API.
+    Connections are reused between requests, so only the first request to a host pays for the TCP and TLS handshake
+    """
+    _shared = None
+    _routed = None
+
+    def __init__(self,
+                 pool_size : int = 10,
+                 max_retries : int = 3,
+                 backoff_factor : float = 0.5,
+                 retry_statuses : tuple[int, ...] = (429, 500, 502, 503, 504),
+                 max_retry_after : float = 10):
+        """
+        :param pool_size: The maximum number of connections kept alive per host. Defaults to 10
+        :param max_retries: The number of times a request is retried on a retryable status or connection error. Defaults to 3
+        :param backoff_factor: The base delay in seconds for exponential backoff between retries. Defaults to 0.5
+        :param retry_statuses: The HTTP status codes that are retried. Defaults to rate limits and server errors
+        :param max_retry_after: The most seconds to wait before a retry when a response's Retry-After asks for longer.
+                                Defaults to 10
+        """
+        self.pool_size = pool_size
+        retry = _CappedRetry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=retry_statuses,
+                      allowed_methods=frozenset({"GET", "POST"}), # Generation requests are safe to repeat
+                      respect_retry_after_header=True,
+                      raise_on_status=False) # Let the final response through so callers can report the real error
+        retry.max_retry_after = max_retry_after
+        adapter = _TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def shared(cls) -> "Transport":
+        """
+        :return: The process-wide transport used by models that aren't given their own
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @classmethod
+    def routed(cls) -> "Transport":
+        """
+        :return: The process-wide transport used by models behind a RouterModel. Only connection errors are retried,
+                 so rate limits and server errors reach the router straight away to fail over to the next model
+        """
+        if cls._routed is None:
+            cls._routed = cls(retry_statuses=())
+        return cls._routed
+
+    def get(self, url : str, **kwargs) -> requests.Response:
+        return self.session.get(url, **kwargs)
+
+    def post(self, url : str, **kwargs) -> requests.Response:
+        return self.session.post(url, **kwargs)
+
+    def patch(self, url : str, **kwargs) -> requests.Response:
+        return self.session.patch(url, **kwargs)
+
+    def delete(self, url : str, **kwargs) -> requests.Response:
+        return self.session.delete(url, **kwargs)
+
+    @staticmethod
+    def take_connect_time() -> float:
+        """
+        :return: the seconds this thread spent opening connections since the last call. 0 if connections were reused
+        """
+        seconds = getattr(_connect_timer, "seconds", 0.0)
+        _connect_timer.seconds = 0.0
+        return seconds
+
+    def close(self) -> None:
+        """
+        Closes all pooled connections
+        """
+        self.session.close()
+
+
+class AsyncTransport:
+    """
+    The asyncio counterpart of Transport, a pooled keep-alive httpx client with the same retry/backoff policy.
+    httpx clients are bound to the event loop they were first used on, so a client is made for each loop
+    """
+    _shared = None
+    _routed = None
+
+    def __init__(self,
+                 pool_size : int = 10,
+                 max_retries : int = 3,
+                 backoff_factor : float = 0.5,
+                 retry_statuses : tuple[int, ...] = (429, 500, 502, 503, 504),
+                 max_retry_after : float = 10):
+        """
+        :param pool_size: The maximum number of connections kept alive. Defaults to 10
+        :param max_retries: The number of times a request is retried on a retryable status or connection error. Defaults to 3
+        :param backoff_factor: The base delay in seconds for exponential backoff between retries. Defaults to 0.5
+        :param retry_statuses: The HTTP status codes that are retried. Defaults to rate limits and server errors
+        :param max_retry_after: The most seconds to wait before a retry when a response's Retry-After asks for longer.
+                                Defaults to 10
+        """
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = retry_statuses
+        self.max_retry_after = max_retry_after
+        self._clients = {}
+
+    @classmethod
+    def shared(cls) -> "AsyncTransport":
+        """
+        :return: The process-wide async transport used by models that aren't given their own
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @classmethod
+    def routed(cls) -> "AsyncTransport":
+        """
+        :return: The process-wide async transport used by models behind a RouterModel, see Transport.routed
+        """
+        if cls._routed is None:
+            cls._routed = cls(retry_statuses=())
+        return cls._routed
+
+    def _client(self):
+        import httpx # Only needed by async callers
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            client = httpx.AsyncClient(limits=limits, transport=httpx.AsyncHTTPTransport(retries=self.max_retries))
+            self._clients = {loop : client for loop, client in self._clients.items() if not loop.is_closed()}
+            self._clients[loop] = client
+        return client
+
+    async def request(self, method : str, url : str, stream : bool = False, on_connect = None, **kwargs):
+        """
+        Sends a request, retrying retryable statuses with exponential backoff (honouring Retry-After)
+        :param method: the HTTP method
+        :param url: the url to send the request to
+        :param stream: If True, the body is not read. The caller must close the response
+        :param on_connect: optionally called with the seconds taken to open each new connection (DNS, TCP and TLS)
+        :param kwargs: any other arguments for httpx.AsyncClient.build_request (headers, content, timeout, ...)
+        :return: the final httpx.Response
+        """
+        if on_connect is not None:
+            kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": self._connect_trace(on_connect)}
+
+        client = self._client()
+        for attempt in range(self.max_retries + 1):
+            response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+            if response.status_code not in self.retry_statuses or attempt == self.max_retries:
+                return response
+
+            await response.aclose()
+            retry_after = response.headers.get("Retry-After", "")
+            delay = min(float(retry_after), self.max_retry_after) if retry_after.isdigit() else self.backoff_factor * (2 ** attempt)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _connect_trace(on_connect):
+        started = {}
+        async def trace(event_name : str, info : dict):
+            step, _, stage = event_name.rpartition(".")
+            if step in ("connection.connect_tcp", "connection.start_tls"):
+                if stage == "started":
+                    started[step] = time.perf_counter()
+                elif stage == "complete" and step in started:
+                    on_connect(time.perf_counter() - started.pop(step))
+        return trace
+
+    async def get(self, url : str, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url : str, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        """
+        Closes the pooled connections of the client for the running event loop
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
@@ -1,8 +1,10 @@
+import re
+import time
 import urllib.request
 
-from rich.console import Console
+from rich.console import Console, Group
 from rich.live import Live
-from rich.markdown import Markdown
+from rich.markdown import Markdown, UnknownElement
 
 
 def markdown_print(text, end="\n", do_markdown=True):
@@ -25,6 +27,155 @@ def connected_to_internet() -> bool:
     except urllib.error.URLError:
         return False
 
+class MarkdownStream:
+    """
+    Incrementally renders a markdown document as it is streamed in.
+    Blocks that can no longer change (finished paragraphs, lists, code blocks, etc.) are printed once and frozen,
+    so only the trailing, still open block is re-rendered on each update.
+    The final output is identical to rendering the whole document with a single Markdown
+    """
+    _list_marker = re.compile(r"( {0,3})([-*+]|\d{1,9}([.)]))([ \t]+|$)")
+    _link_definition = re.compile(r" {0,3}\[[^\]]+\]:")
+    _fence_opening = re.compile(r" {0,3}(`{3,}|~{3,})")
+    # The starts of CommonMark html blocks: comments, processing instructions, declarations and CDATA,
+    # block level tags (and script, pre, style and textarea), and any other tag alone on its line
+    _html_block_start = re.compile(
+        r"[ \t]*<(?:!--|\?|![A-Za-z]|!\[CDATA\["
+        r"|/?(?:address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd|details|dialog|dir"
+        r"|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset|h[1-6]|head|header|hr|html|iframe|legend|li"
+        r"|link|main|menu|menuitem|nav|noframes|ol|optgroup|option|p|param|pre|script|search|section|style|summary"
+        r"|table|tbody|td|textarea|tfoot|th|thead|title|tr|track|ul)(?:[ \t/>]|$)"
+        r"|/?[A-Za-z][A-Za-z0-9-]*(?:[ \t][^<>]*)?/?>[ \t]*$)", re.IGNORECASE)
+
+    min_refresh_interval = 1 / 60
+    max_refresh_interval = 1 / 4
+
+    def __init__(self, console : Console):
+        self.console = console
+        self._tail = "" # Text that hasn't been frozen yet
+        self._scan_pos = 0 # Start of the first line in the tail not yet scanned for block boundaries
+        self._fence = None # The opening fence while inside a fenced code block
+        self._previous_blank = False
+        # The marker (bullet, or ordered list delimiter) of the top level list that may still be open,
+        # and the indent of its items' content. "?" when it isn't known, so lists are never split
+        self._list = None
+        self._list_indent = 0
+        self._can_freeze = True
+        self._separate = False # Whether rich owes a blank line before the next block
+
+        self._last_render = 0.0
+        self._refresh_interval = self.min_refresh_interval
+        self._live = None
+
+    def __enter__(self) -> "MarkdownStream":
+        self._live = Live(console=self.console, auto_refresh=False)
+        self._live.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._live.update(self._tail_renderable(), refresh=True)
+        self._live.__exit__(exc_type, exc_val, exc_tb)
+
+    def feed(self, chunk : str) -> None:
+        """
+        Adds a chunk of streamed text, freezing any blocks it completes and refreshing the live block.
+        Refreshes happen as chunks arrive, but no faster than twice the cost of the last render
+        (clamped between 1/60s and 1/4s), so the render rate follows the arrival rate without falling behind it
+        :param chunk: the new text
+        """
+        self._tail += chunk
+        self._freeze_finished_blocks()
+
+        now = time.perf_counter()
+        if now - self._last_render >= self._refresh_interval:
+            self._live.update(self._tail_renderable(), refresh=True)
+            self._last_render = time.perf_counter()
+            render_cost = self._last_render - now
+            self._refresh_interval = min(max(render_cost * 2, self.min_refresh_interval), self.max_refresh_interval)
+
+    def _freeze_finished_blocks(self) -> None:
+        split = None
+        while self._can_freeze:
+            line_end = self._tail.find("\n", self._scan_pos)
+            if line_end == -1:
+                break
+            line_start = self._scan_pos
+            line = self._tail[line_start:line_end]
+            self._scan_pos = line_end + 1
+
+            if self._fence is not None:
+                stripped = line.strip()
+                if stripped.startswith(self._fence) and stripped.strip(self._fence[0]) == "":
+                    self._fence = None
+                continue
+
+            if line.strip() == "":
+                self._previous_blank = True
+                continue
+
+            if self._link_definition.match(line) or self._html_block_start.match(line):
+                # Link definitions affect earlier blocks and html blocks can span blank lines, so stop freezing
+                self._can_freeze = False
+                break
+
+            marker = self._list_marker.match(line)
+            if marker is None:
+                # A blank line followed by an unindented line that can't continue a list closes every open block
+                if self._previous_blank and line[0] not in " \t":
+                    split = line_start
+                    self._list = None
+            elif marker.group(1) == "" and "\t" not in marker.group(4):
+                kind = marker.group(3) or marker.group(2)
+                # An item with a different kind of marker than the open list starts a new one,
+                # and after a blank line nothing earlier can continue past it
+                if self._previous_blank and self._list not in (kind, "?"):
+                    split = line_start
+                self._list = kind
+                spaces = len(marker.group(4))
+                self._list_indent = len(marker.group(2)) + (spaces if 0 < spaces <= 4 else 1) # Where nested lines start
+            elif self._list is None or len(marker.group(1)) < self._list_indent:
+                self._list = "?" # A slightly indented item, which may or may not be in the open list
+
+            fence = self._fence_opening.match(line)
+            if fence:
+                self._fence = fence.group(1)
+            self._previous_blank = False
+
+        if split is not None and split > 0:
+            self._print_frozen(self._tail[:split])
+            self._tail = self._tail[split:]
+            self._scan_pos -= split
+
+    def _print_frozen(self, block : str) -> None:
+        self._live.console.print(_ContinuedMarkdown(block, self._separate))
+
+        # Rich separates elements based on the last element rendered, which for a block is its top level element
+        last_top_level = next((t for t in reversed(Markdown(block).parsed) if t.level == 0), None)
+        if last_top_level is not None:
+            element = Markdown.elements.get(last_top_level.type.replace("_close", "_open"), UnknownElement)
+            self._separate = element.new_line
+
+    def _tail_renderable(self):
+        if self._tail.strip() == "":
+            return Group()
+        return _ContinuedMarkdown(self._tail, self._separate)
+
+class _ContinuedMarkdown:
+    """
+    Renders a markdown block as if it followed earlier blocks of the same document.
+    Rich decides whether to put a blank line before an element from the last element it rendered,
+    so the block is rendered behind a short prefix that leaves the same state, and the prefix's lines are dropped
+    """
+    def __init__(self, text : str, separate : bool):
+        self.prefix = "x\n\n" if separate else "---\n\n"
+        self.text = text
+
+    def __rich_console__(self, console : Console, options):
+        prefix_lines = len(console.render_lines(Markdown(self.prefix), options, pad=False))
+        lines = console.render_lines(Markdown(self.prefix + self.text), options, pad=False, new_lines=True)
+        for line in lines[prefix_lines:]:
+            yield from line
+
 def output_stream(stream, do_markdown=True):
     """
     Reads content from a string stream token by token, updating a live
@@ -33,11 +184,10 @@ def output_stream(stream, do_markdown=True):
     capture = ""
 
     if do_markdown:
-        with Live(console=console, refresh_per_second=64) as live:
+        with MarkdownStream(console) as markdown_stream:
             for raw_chunk in stream:
                 capture += raw_chunk
-                markdown_renderable = Markdown(capture)
-                live.update(markdown_renderable)
+                markdown_stream.feed(raw_chunk)
     else:
         for raw_chunk in stream:
             capture += raw_chunk
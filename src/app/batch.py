@@ -0,0 +1,133 @@
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+from typing import Iterator
+
+from ai_core.chat import Chat
+from ai_core.message import Message
+from ai_core.model import Model, ModelError
+from ai_core.transport import Transport
+
+
+def _parse_line(line : str) -> dict:
+    if not line.lstrip().startswith("{"):
+        return {"prompt": line.rstrip("\n")}
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return {"error": f"The row isn't valid JSON: {e}"}
+
+def read_prompts(input_path : str) -> Iterator[dict]:
+    """
+    Reads batch rows from a file, or stdin when the path is "-"
+    .csv files need a "prompt" column. Other files are read line by line, where each line is either
+    a JSON object with a "prompt" key or the prompt itself. Rows may also have "id" and "system_prompt" values
+    :param input_path: the path to the prompts file
+    :return: the rows, each with an "id" (the row number if not given) and a "prompt".
+             Rows that can't be sent have an "error" instead, saying what's wrong with them
+    """
+    file = sys.stdin if input_path == "-" else open(input_path, "r", encoding="utf-8", newline="")
+    try:
+        if input_path.lower().endswith(".csv"):
+            rows = csv.DictReader(file)
+        else:
+            rows = (_parse_line(line) for line in file if line.strip())
+
+        for row_number, row in enumerate(rows):
+            if "error" in row:
+                pass
+            elif not row.get("prompt"):
+                row["error"] = "The row has no prompt"
+            elif not isinstance(row["prompt"], str):
+                row["error"] = "The prompt isn't text"
+            elif not isinstance(row.get("system_prompt") or "", str):
+                row["error"] = "The system prompt isn't text"
+            row["id"] = str(row.get("id") or row_number)
+            yield row
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def completed_ids(output_path : str) -> set[str]:
+    """
+    Finds the rows already answered in an earlier run, so they can be skipped
+    :param output_path: the path to the results file
+    :return: the ids of every row with a response. Rows that errored are retried
+    """
+    ids = set()
+    if output_path is None or not os.path.exists(output_path):
+        return ids
+
+    with open(output_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue # A line cut off by a crash
+            if "response" in result:
+                ids.add(str(result["id"]))
+    return ids
+
+def answer_row(row : dict, model : Model, system_prompt : str = None) -> dict:
+    """
+    Sends a single row to the model
+    :return: the result record, with either a "response" or an "error"
+    """
+    chat = Chat()
+    chat.set_system_prompt(row.get("system_prompt") or system_prompt or "")
+    chat.add_message(Message("user", row["prompt"]))
+
+    result = {"id": row["id"], "prompt": row["prompt"]}
+    try:
+        result["response"] = model.invoke_chat(chat.get_gemini_payload())
+    except ModelError as e:
+        result["error"] = str(e)
+    return result
+
+def _result(future, row : dict) -> dict:
+    try:
+        return future.result()
+    except Exception as e: # A bug answering one row shouldn't stop the rest
+        return {"id": row["id"], "prompt": row["prompt"], "error": f"{type(e).__name__}: {e}"}
+
+def run_batch(model : Model, input_path : str, output_path : str = None, concurrency : int = 4, system_prompt : str = None):
+    """
+    Answers every prompt in a file with a bounded number of requests in flight, writing results as they complete.
+    Rows already answered in the output file are skipped, so an interrupted batch can be resumed by running it again
+    :param model: the model to send the prompts to
+    :param input_path: the path to the prompts file, or "-" for stdin
+    :param output_path: the path to the .jsonl results file, results are written to stdout if not given
+    :param concurrency: the maximum number of requests in flight
+    :param system_prompt: the system prompt for rows that don't have their own
+    """
+    done = completed_ids(output_path)
+    all_rows = list(read_prompts(input_path))
+    rows = [row for row in all_rows if row["id"] not in done]
+    if len(rows) != len(all_rows):
+        print(f"Skipping {len(all_rows) - len(rows)} already answered prompts", file=sys.stderr)
+
+    if hasattr(model, "transport"): # Keep a warm connection for every worker
+        model.transport = Transport(pool_size=max(concurrency, 1))
+
+    output = sys.stdout if output_path is None else open(output_path, "a", encoding="utf-8")
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+    try:
+        results = [{"id": row["id"], "prompt": row.get("prompt"), "error": row["error"]} for row in rows if "error" in row]
+        futures = {executor.submit(answer_row, row, model, system_prompt): row for row in rows if "error" not in row}
+        for i, result in enumerate(chain(results, (_result(future, futures[future]) for future in as_completed(futures)))):
+            failed += "error" in result
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            print(f"\r{i + 1}/{len(rows)} prompts answered ({failed} failed)", end="", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("\nBatch interrupted, run it again with the same output file to resume", file=sys.stderr)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if output is not sys.stdout:
+            output.close()
+
+    print(file=sys.stderr)
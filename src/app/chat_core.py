@@ -1,6 +1,9 @@
+from contextlib import contextmanager
+
 from ai_core.chat import Chat
 from ai_core.message import Message
-from ai_core.model import Model
+from ai_core.metrics import CallMetrics, collect_metrics
+from ai_core.model import Model, ModelError
 from ai_core.util import output_stream, markdown_print
 
 help_message = """
@@ -12,42 +15,96 @@ type systemprompt/system to display and/or change the system prompt
 type help to display this message
 """
 
-def output_response(chat : Chat, model : Model, do_stream : bool, do_markdown : bool):
-    if do_stream:
-        stream = model.stream_chat(chat.get_gemini_payload())
-        response = output_stream(stream, do_markdown=do_markdown)
-    else:
-        response = model.invoke_chat(chat.get_gemini_payload())
-        if do_markdown:
-            markdown_print(response.strip())
+# The messages read when a chat is started, so long chats open as fast as short ones. Older messages are read when needed
+start_tail_messages = 100
+
+def format_stats(metrics : CallMetrics) -> str:
+    """
+    :return: a one line summary of a model call, e.g. "first token 412ms | 1.83s total | 35 -> 210 tokens | ..."
+    """
+    stats = []
+    if metrics.cached:
+        stats.append("cached")
+    if metrics.connect_time:
+        stats.append(f"connect {metrics.connect_time * 1000:.0f}ms")
+    if metrics.time_to_first_token is not None:
+        stats.append(f"first token {metrics.time_to_first_token * 1000:.0f}ms")
+    if metrics.chunk_gaps:
+        stats.append(f"max gap {max(metrics.chunk_gaps) * 1000:.0f}ms")
+    stats.append(f"{metrics.duration:.2f}s total")
+    if metrics.prompt_tokens is not None or metrics.response_tokens is not None:
+        stats.append(f"{metrics.prompt_tokens or 0} -> {metrics.response_tokens or 0} tokens")
+    stats.append(f"{metrics.bytes_sent / 1024:.1f} KB sent, {metrics.bytes_received / 1024:.1f} KB received")
+    if metrics.finish_reason not in (None, "STOP", "stop"):
+        stats.append(f"finished: {metrics.finish_reason}")
+    return " | ".join(stats)
+
+@contextmanager
+def without_response_cache(model : Model):
+    """
+    Sends the model's requests without its response cache inside the block, e.g. to get a new answer to the same request.
+    Also covers the models a RouterModel routes to
+    :param model: the model to skip the response cache of
+    """
+    models = [model] + list(getattr(model, "routes", []))
+    caches = [each.response_cache for each in models]
+    for each in models:
+        each.response_cache = None
+    try:
+        yield
+    finally:
+        for each, cache in zip(models, caches):
+            each.response_cache = cache
+
+def output_response(chat : Chat, model : Model, do_stream : bool, do_markdown : bool, show_stats : bool = False):
+    with collect_metrics(model) as calls:
+        if do_stream:
+            stream = model.stream_chat(chat.get_gemini_payload(model.context_window, model.context_cache))
+            response = output_stream(stream, do_markdown=do_markdown)
         else:
-            print(response.strip())
+            response = model.invoke_chat(chat.get_gemini_payload(model.context_window, model.context_cache))
+            if do_markdown:
+                markdown_print(response.strip())
+            else:
+                print(response.strip())
+
+    if show_stats:
+        for metrics in calls:
+            print(f"[{format_stats(metrics)}]")
 
     return response
 
-def single_message(message : str, model : Model, chat_source = None, do_stream = True, do_markdown = True):
-    chat = Chat()
+def single_message(message : str, model : Model, chat_source = None, do_stream = True, do_markdown = True, chat : Chat = None,
+                   show_stats = False):
+    chat = Chat() if chat is None else chat
 
     if chat_source is not None: #load cha
         chat.load(chat_source, False)
 
     chat.add_message(Message("user", message))
 
-    response = output_response(chat, model, do_stream, do_markdown)
+    try:
+        response = output_response(chat, model, do_stream, do_markdown, show_stats)
+    except ModelError as e:
+        print(f"Error: {e}")
+        return None
 
     if chat_source is not None:
         chat.add_message(Message("assistant", response))
         chat.export(chat_source, model, False)
+    return response
 
-def start_chat(chat_source : str, model : Model, do_stream = True, do_markdown = True):
-    chat = Chat()
+def start_chat(chat_source : str, model : Model, do_stream = True, do_markdown = True, chat : Chat = None, show_stats = False):
+    chat = Chat() if chat is None else chat
 
-    chat.load(chat_source, False)
+    chat.load(chat_source, False, tail = start_tail_messages)
     while True:
         prompt = input(">> ")
+        retry = False
 
         if len(prompt) != 0:
             match = True
+            new_message = True
             match prompt.lower().strip():
                 case "h" | "help":
                     print(help_message)
@@ -60,8 +117,11 @@ def start_chat(chat_source : str, model : Model, do_stream = True, do_markdown =
                         print("Chat history cleared")
                 case "retry":
                     print("Regenerating a new response...")
-                    chat.remove_last_message()
+                    if len(chat.messages) > 0 and chat.messages[-1]["role"] == "assistant": # Not after a failed response
+                        chat.remove_last_message()
                     match = False
+                    new_message = False # Answer the last message again, rather than sending "retry"
+                    retry = True
                 case "save":
                     chat.export(chat_source, model, confirm_export = True)
                 case "system" | "systemprompt":
@@ -77,8 +137,18 @@ def start_chat(chat_source : str, model : Model, do_stream = True, do_markdown =
             if match:
                 continue
 
-            chat.add_message(Message("user", prompt))
+            if new_message:
+                chat.add_message(Message("user", prompt))
 
-        response = output_response(chat, model, do_stream, do_markdown)
+        try:
+            if retry: # The cached response is the one being replaced
+                with without_response_cache(model):
+                    response = output_response(chat, model, do_stream, do_markdown, show_stats)
+            else:
+                response = output_response(chat, model, do_stream, do_markdown, show_stats)
+        except ModelError as e:
+            print(f"Error: {e}")
+            print("Type retry to try again")
+            continue
 
         chat.add_message(Message("assistant", response))
\ No newline at end of file
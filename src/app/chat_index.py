@@ -0,0 +1,180 @@
+import json
+import os
+
+from typing import TYPE_CHECKING
+
+from ai_core.files import atomic_write
+from ai_core.storage import chat_extension, chat_name, get_chat_store
+
+if TYPE_CHECKING:
+    from ai_core.chat import Chat
+    from ai_core.model import Model
+
+preview_length = 50
+
+
+def make_preview(messages : list[dict]) -> str:
+    """
+    :param messages: the messages of a chat
+    :return: the first line of the first message, shortened to fit in a table
+    """
+    if len(messages) == 0:
+        return ""
+    first_line = messages[0]["content"].strip().split("\n")[0]
+    if len(first_line) > preview_length:
+        return first_line[:preview_length - 3] + "..."
+    return first_line
+
+class ChatIndex:
+    """
+    A persistent catalogue of chat metadata (model, message count, size, last used time and a preview),
+    so chats can be listed and selected without reading every chat file.
+    Entries are updated whenever a chat is written, and revalidated against each file's mtime and size when read.
+    Archived chats are only revalidated when the archive directory changes, so they don't slow down listing chats
+    """
+    def __init__(self, index_path : str, chats_path : str, chat_extensions : tuple[str, ...], archive_path : str = None):
+        """
+        :param index_path: the path of the .json file to store the index in
+        :param chats_path: the directory the chats are stored in
+        :param chat_extensions: the file extensions of chat files
+        :param archive_path: the directory archived chats are stored in, inside chats_path
+        """
+        self.index_path = index_path
+        self.chats_path = chats_path
+        self.chat_extensions = chat_extensions
+        self.archive_path = archive_path
+        self._entries = None
+        self._archive_mtime = None # The mtime of the archive directory when it was last scanned
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as file:
+                    index = json.load(file)
+                self._entries = index.get("chats", {})
+                self._archive_mtime = index.get("archive_mtime")
+            except (FileNotFoundError, ValueError, AttributeError):
+                self._entries = {}
+        return self._entries
+
+    def save(self) -> None:
+        """
+        Writes the index to disk. Only needed after updates made with save=False
+        """
+        # dumps rather than dump, which skips the C encoder and is several times slower for large indexes
+        data = json.dumps({"chats": self._entries, "archive_mtime": self._archive_mtime}, ensure_ascii=False)
+        with atomic_write(self.index_path) as file:
+            file.write(data)
+
+    def _set_entry(self, chat_path : str, model_name : str | None, messages : list[dict]) -> None:
+        stat = os.stat(chat_path)
+        self._load()[chat_name(chat_path)] = {
+            "file": os.path.relpath(chat_path, self.chats_path),
+            "archived": self.is_archived(chat_path),
+            "model": model_name,
+            "messages": len(messages),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "preview": make_preview(messages)
+        }
+
+    def update(self, chat_path : str, data : dict = None, save : bool = True) -> None:
+        """
+        Updates the entry for a chat after it has been written
+        :param chat_path: the path of the chat file
+        :param data: the chat data that was written. Read from the file if not given
+        :param save: whether to write the index now, or leave it to a later save() after updating many chats
+        """
+        if data is None:
+            data = get_chat_store(chat_path).load(chat_path) or {}
+        self._set_entry(chat_path, data.get("model"), data.get("messages", []))
+        if save:
+            self.save()
+
+    def on_export(self, chat : "Chat", chat_source : str, model : "Model") -> None:
+        """
+        Chat export listener, keeps the entry up to date without reading the file back
+        """
+        self._set_entry(chat_source, model.model_name, chat.messages)
+        self.save()
+
+    def _preferred_file(self, file_name : str, other_file_name : str) -> bool:
+        rank = lambda name: self.chat_extensions.index(chat_extension(name))
+        return rank(file_name) <= rank(other_file_name)
+
+    def is_archived(self, chat_path : str) -> bool:
+        """
+        :param chat_path: the path of a chat file
+        :return: whether the chat is in the archive directory
+        """
+        return self.archive_path is not None and os.path.dirname(os.path.abspath(chat_path)) == os.path.abspath(self.archive_path)
+
+    def remove(self, chat_name : str) -> None:
+        """
+        Removes a chat from the index
+        :param chat_name: the name of the chat to remove
+        """
+        if self._load().pop(chat_name, None) is not None:
+            self.save()
+
+    def get_entries(self) -> dict[str, dict]:
+        """
+        Gets the metadata for every chat, only reading chat files that changed since they were indexed
+        :return: a dictionary of chat name to metadata
+        """
+        entries = self._load()
+        seen = set()
+        changed = self._scan(self.chats_path, seen)
+
+        try:
+            archive_mtime = os.stat(self.archive_path).st_mtime_ns if self.archive_path is not None else None
+        except FileNotFoundError:
+            archive_mtime = None
+        if archive_mtime != self._archive_mtime: # Chats were archived, restored or deleted
+            if archive_mtime is not None:
+                self._scan(self.archive_path, seen)
+            self._archive_mtime = archive_mtime
+            changed = True
+        else:
+            seen.update(name for name, entry in entries.items() if entry.get("archived") and name not in seen)
+
+        for name in list(entries):
+            if name not in seen:
+                del entries[name]
+                changed = True
+
+        if changed:
+            self.save()
+        return entries
+
+    def _scan(self, directory : str, seen : set[str]) -> bool:
+        """
+        Revalidates the entries of the chats in a directory
+        :param directory: the directory to scan
+        :param seen: the names of the chats found so far, which the chats found are added to
+        :return: whether any entry changed
+        """
+        entries = self._load()
+        changed = False
+        prefix = os.path.relpath(directory, self.chats_path) # Entries store file paths relative to chats_path
+        for file in os.scandir(directory):
+            name, extension = chat_name(file.name), chat_extension(file.name)
+            if extension not in self.chat_extensions or not file.is_file():
+                continue
+            if name in seen and self._preferred_file(entries[name]["file"], file.name):
+                continue # An unmigrated copy of the chat in an older format, or an archived copy
+            seen.add(name)
+
+            stat = file.stat()
+            entry = entries.get(name)
+            if (entry is not None and entry["file"] == (file.name if prefix == "." else os.path.join(prefix, file.name))
+                    and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size):
+                continue
+
+            try:
+                data = get_chat_store(file.path).load(file.path) or {}
+            except ValueError:
+                data = {}
+            self._set_entry(file.path, data.get("model"), data.get("messages", []))
+            changed = True
+        return changed
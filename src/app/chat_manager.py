@@ -1,19 +1,38 @@
 import datetime
 import os
+import time
+from functools import cached_property
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import yaml
+from ai_core.files import FileLock
+from ai_core.storage import chat_extension, chat_name, get_chat_store, ArchivedChatStore, JsonlChatStore, YamlChatStore
 
-from app.constants import data_path, cli_keyword
+from app.chat_index import ChatIndex
+from app.constants import data_path, cli_keyword, chat_index_path, chat_search_path, chat_archive_path
 from app.util import pretty_terminal_table
 
+if TYPE_CHECKING:
+    from ai_core.chat import Chat
+
 
 class ChatManager:
     """
     Manages finding, loading and saving chat data
     """
+    chat_extensions = (JsonlChatStore.extension, YamlChatStore.extension, ArchivedChatStore.extension) # In order of preference
+    new_chat_extension = JsonlChatStore.extension
+    leftover_age = 60 * 60 # Seconds before chat gc removes temporary and lock files nothing is using
+
     def __init__(self):
         self.validate_chats()
+        self.index = ChatIndex(chat_index_path, data_path, self.chat_extensions, chat_archive_path)
+
+    @cached_property
+    def search_index(self):
+        # Made when first needed, so listing chats doesn't import sqlite
+        from app.chat_search import ChatSearchIndex
+        return ChatSearchIndex(chat_search_path, data_path)
 
     def validate_chats(self) -> None:
         """
@@ -26,9 +45,21 @@ class ChatManager:
 
     def get_chat_paths(self):
         """
-        :return: a list of all chat .yaml files in the data directory
+        :return: a list of all chat files in the data directory
         """
-        return list(Path(data_path).glob("*.yaml"))
+        return [Path(data_path, entry["file"]) for entry in self.index.get_entries().values()]
+
+    def new_chat(self) -> "Chat":
+        """
+        :return: an empty Chat that keeps the chat index and search index up to date when exported
+        """
+        from ai_core.chat import Chat
+
+        chat = Chat()
+        chat.export_listeners.append(self.index.on_export)
+        chat.export_listeners.append(self.search_index.on_export)
+        chat.restore = self.restore_chat
+        return chat
 
     def get_chat_path(self, chat_name: str):
         """
@@ -36,17 +67,183 @@ class ChatManager:
         :param chat_name: the name of the chat get the filepath for
         :return: The path for the chat if it exists, None otherwise
         """
-        chat_path = os.path.join(data_path, chat_name + ".yaml")
-        if not os.path.exists(chat_path):
-            return None
-        return chat_path
+        for extension in self.chat_extensions:
+            chat_path = os.path.join(data_path, chat_name + extension)
+            if os.path.exists(chat_path):
+                return chat_path
+        archived_path = os.path.join(chat_archive_path, chat_name + ArchivedChatStore.extension)
+        return archived_path if os.path.exists(archived_path) else None
+
+    def migrate_chat(self, chat_path : str) -> str:
+        """
+        Converts a chat file to the current chat format, removing the old file. Restores archived chats
+        :param chat_path: the path of the chat file to convert
+        :return: the path of the converted chat file
+        """
+        if chat_extension(chat_path) == self.new_chat_extension:
+            return chat_path
+
+        new_path = os.path.join(data_path, chat_name(chat_path) + self.new_chat_extension)
+        # The chat in data_path is always locked first, as Chat.export restores archived chats with it locked
+        with FileLock(new_path), FileLock(chat_path):
+            if os.path.exists(chat_path): # Otherwise converted by another process while waiting for the lock
+                self._move_chat(chat_path, new_path)
+        return new_path
+
+    def restore_chat(self, chat_path : str) -> list | None:
+        """
+        Restores an archived chat to a chat file, for a Chat exported after the chat was archived.
+        Should be called with the chat file locked
+        :param chat_path: the path the chat was archived from
+        :return: the state of the chat file when it was archived ([] if unknown), or None if the chat isn't archived
+        """
+        archived_path = os.path.join(chat_archive_path, chat_name(chat_path) + ArchivedChatStore.extension)
+        with FileLock(archived_path):
+            if not os.path.exists(archived_path):
+                return None
+            return self._move_chat(archived_path, chat_path) or []
+
+    def _move_chat(self, chat_path : str, new_path : str) -> list | None:
+        """
+        Moves a chat to another file, in the format of its extension. Should be called with both files locked
+        :return: the state of the chat file when it was archived, if the chat was moved out of the archive
+        """
+        data = get_chat_store(chat_path).load(chat_path)
+        archived_from = None
+        if data is not None:
+            archived_from = data.pop("archived_from", None)
+            get_chat_store(new_path).save(new_path, data)
+        else:
+            Path(new_path).touch(exist_ok=True)
+
+        stat = os.stat(chat_path) # Keep the last used time
+        os.utime(new_path, (stat.st_atime, stat.st_mtime))
+        os.remove(chat_path)
+        self.index.update(new_path, data)
+        return archived_from
+
+    def compact_chat(self, chat_name : str) -> None:
+        """
+        Rewrites a chat file with only its current header and messages, dropping replaced records from the log.
+        Also migrates chats in older formats
+        :param chat_name: the name of the chat to compact
+        """
+        chat_path = self.get_chat_path(chat_name)
+        if chat_path is None:
+            print(f"No chat with name {chat_name} found.")
+            return
+
+        old_size = os.path.getsize(chat_path)
+        if not self.index.is_archived(chat_path): # Archived chats are compacted where they are
+            chat_path = self.migrate_chat(chat_path)
+
+        store = get_chat_store(chat_path)
+        with FileLock(chat_path): # Otherwise changes appended while compacting would be lost
+            data = store.load(chat_path)
+            if data is not None:
+                stat = os.stat(chat_path)
+                store.save(chat_path, data)
+                os.utime(chat_path, (stat.st_atime, stat.st_mtime))
+        if data is not None:
+            self.index.update(chat_path, data)
+
+        new_size = os.path.getsize(chat_path)
+        print(f"Compacted chat '{chat_name}' ({old_size} -> {new_size} bytes)")
+
+    def archive_chat(self, chat_path : str, save_index : bool = True, dry_run : bool = False) -> tuple[int, int] | None:
+        """
+        Moves a chat to the archive, compacted and compressed. It's restored when it's next opened
+        :param chat_path: the path of the chat file
+        :param save_index: whether to write the chat index now, rather than after archiving many chats
+        :param dry_run: whether to only work out the sizes, leaving the chat where it is
+        :return: the size of the chat file before and after, or None if it's empty, no longer exists,
+                 or isn't any smaller compressed (which only happens to very short chats), so it's kept as it is
+        """
+        archived_path = os.path.join(chat_archive_path, chat_name(chat_path) + ArchivedChatStore.extension)
+        with FileLock(chat_path): # Restoring also locks the chat path, and a chat being saved is archived after it
+            if not os.path.exists(chat_path): # Archived or deleted by another process while waiting for the lock
+                return None
+            data = get_chat_store(chat_path).load(chat_path)
+            if data is None:
+                return None
+
+            stat = os.stat(chat_path)
+            data["archived_from"] = [stat.st_ino, stat.st_size] # So Chats loaded before it was archived can still append
+            store = ArchivedChatStore()
+            compressed = store.compress(data)
+            if len(compressed) >= stat.st_size:
+                return None
+            if dry_run:
+                return stat.st_size, len(compressed)
+
+            os.makedirs(chat_archive_path, exist_ok=True)
+            store.write(archived_path, compressed)
+            os.utime(archived_path, (stat.st_atime, stat.st_mtime)) # Keep the last used time
+            os.remove(chat_path)
+        self.index.update(archived_path, data, save_index)
+        return stat.st_size, len(compressed)
+
+    def collect_garbage(self, days : float, dry_run : bool = False) -> None:
+        """
+        Archives chats untouched for a number of days, and removes temporary files left by interrupted writes
+        and lock files of chats that no longer exist. Prints the space reclaimed
+        :param days: the days a chat is left untouched before it's archived
+        :param dry_run: whether to only print what would be done
+        """
+        cutoff = time.time() - days * 24 * 60 * 60
+        archived = 0
+        old_size = 0
+        new_size = 0
+        for entry in list(self.index.get_entries().values()):
+            if entry.get("archived") or entry["mtime"] > cutoff or entry["messages"] == 0:
+                continue
+            sizes = self.archive_chat(os.path.join(data_path, entry["file"]), save_index=False, dry_run=dry_run)
+            if sizes is not None:
+                archived += 1
+                old_size += sizes[0]
+                new_size += sizes[1]
+        if archived > 0 and not dry_run:
+            self.index.save()
+
+        leftovers = []
+        for directory in (data_path, chat_archive_path):
+            if not os.path.exists(directory):
+                continue
+            for file in os.scandir(directory):
+                if not file.name.startswith(".") or not file.is_file():
+                    continue
+                stat = file.stat()
+                if time.time() - stat.st_mtime < self.leftover_age: # Might still be in use
+                    continue
+                if (file.name.endswith(".tmp")
+                        or file.name.endswith(".lock") and not os.path.exists(os.path.join(directory, file.name[1:-5]))):
+                    leftovers.append((file.path, stat.st_size))
+        if not dry_run:
+            for path, _ in leftovers:
+                if path.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                target = os.path.join(os.path.dirname(path), os.path.basename(path)[1:-5])
+                with FileLock(target): # Only removed while held, so a process waiting for it locks a new one instead
+                    if not os.path.exists(target):
+                        os.remove(path)
+        leftover_size = sum(size for _, size in leftovers)
+
+        if dry_run:
+            print(f"Would archive {archived} chats untouched for {days:g} days ({old_size / 1024:.1f} KB -> {new_size / 1024:.1f} KB), "
+                  f"and remove {len(leftovers)} leftover files ({leftover_size / 1024:.1f} KB)")
+            return
+        print(f"Archived {archived} chats untouched for {days:g} days ({old_size / 1024:.1f} KB -> {new_size / 1024:.1f} KB)")
+        print(f"Removed {len(leftovers)} leftover files ({leftover_size / 1024:.1f} KB)")
+        print(f"Reclaimed {(old_size - new_size + leftover_size) / 1024:.1f} KB")
 
     def get_most_recent_chat(self):
         """
         :returns The most recent chat path
         :throws ValueError if no chat exists (max([]))
         """
-        return max(self.get_chat_paths(), key=lambda f: f.stat().st_mtime)
+        entry = max(self.index.get_entries().values(), key=lambda e: e["mtime"])
+        return Path(data_path, entry["file"])
 
     def select_chat(self, chat_name : str = None):
         """
@@ -58,17 +255,21 @@ class ChatManager:
         :return: The path of the chat to access
         """
         if chat_name is None: #No name given
-            if len(self.get_chat_paths()) == 0:
+            if len(self.index.get_entries()) == 0:
                 print("No existing chats found, creating a new chat 'chat' ")
-                chat_path = os.path.join(data_path, "chat.yaml")
+                chat_path = os.path.join(data_path, "chat" + self.new_chat_extension)
 
             else:
                 print("Selecting most recent chat")
-                return self.get_most_recent_chat()
+                return self.migrate_chat(str(self.get_most_recent_chat()))
         else: #Name has been given
-            chat_path = os.path.join(data_path, chat_name + ".yaml")
+            chat_path = self.get_chat_path(chat_name)
+            if chat_path is None:
+                chat_path = os.path.join(data_path, chat_name + self.new_chat_extension)
+            else:
+                return self.migrate_chat(chat_path)
 
-        Path(chat_path).touch(exist_ok=True)  # Create an empty yaml chat file
+        Path(chat_path).touch(exist_ok=True)  # Create an empty chat file
 
         return chat_path
 
@@ -85,10 +286,7 @@ class ChatManager:
                   f"\nCreate the chat first with chat start {chat_name}, or type chat list to list available chats")
             return None
 
-        with open(chat_path, "r") as file:
-            data = yaml.safe_load(file)
-
-        return data
+        return get_chat_store(chat_path).load(chat_path)
 
     def set_system_prompt(self, chat_name : str, system_prompt : str):
         """
@@ -102,10 +300,16 @@ class ChatManager:
         if data is None:
             return
 
+        store = get_chat_store(chat_path)
+        with FileLock(chat_path):
+            if store.supports_append:
+                store.append(chat_path, [{"op": "header", "system_prompt": system_prompt}])
+            else:
+                data = store.load(chat_path) or data # Read again, keeping changes made since by other processes
+                data["system_prompt"] = system_prompt
+                store.save(chat_path, data)
         data["system_prompt"] = system_prompt
-
-        with open(chat_path, "w") as file:
-            yaml.dump(data, file, default_flow_style=False, sort_keys=False)
+        self.index.update(chat_path, data)
 
         print(f"Successfully updated chat '{chat_name}' with new system prompt ")
 
@@ -122,6 +326,8 @@ class ChatManager:
         option = input(f"Are you sure you want to delete the chat {chat_name}? "f"\ny/n >> ")
         if option.strip() == "y":
             os.remove(chat_path)
+            self.index.remove(chat_name)
+            self.search_index.remove(chat_name)
             print(f"Successfully removed chat in {chat_path}")
 
 
@@ -129,23 +335,39 @@ class ChatManager:
         """
         Display all chats and some metadata about them
         """
-        chat_paths = self.get_chat_paths()
-        if len(chat_paths) == 0:
+        entries = self.index.get_entries()
+        if len(entries) == 0:
             print(f"No chats found. Start a new chat with '{cli_keyword} start <chat_name>'")
             return
 
         #setup table for pretty print
-        column_names = ["Chat name", "Last used", "Model"]
+        column_names = ["Chat name", "Last used", "Model", "Messages", "Preview"]
         rows = []
-        for chat_path in chat_paths:
-            with open(chat_path, "r") as file:
-                data = yaml.safe_load(file)
+        for chat_name, entry in entries.items():
+            last_used_datetime = datetime.datetime.fromtimestamp(entry["mtime"]).strftime("%d/%m/%Y %H:%M")
+            if entry.get("archived"):
+                last_used_datetime += " (archived)"
+            rows.append([chat_name, last_used_datetime, entry["model"], entry["messages"], entry["preview"]])
 
-            chat_name = chat_path.name.removesuffix(".yaml")
-            last_used = chat_path.stat().st_mtime
-            last_used_datetime = datetime.datetime.fromtimestamp(last_used).strftime("%d/%m/%Y %H:%M")
-            model = data["model"]
+        pretty_terminal_table(rows, column_names, padding = 5)
 
-            rows.append([chat_name, last_used_datetime, model])
+    def search_chats(self, query : str, limit : int = 20):
+        """
+        Display the messages in every chat matching a search, best matches first
+        :param query: the words to search for
+        :param limit: the maximum number of results to display
+        """
+        import sqlite3
+
+        try:
+            self.search_index.sync(self.index.get_entries())
+            results = self.search_index.search(query, limit)
+        except sqlite3.Error as e:
+            print(f"Error searching chats: {e}")
+            return
+
+        if len(results) == 0:
+            print(f"No messages found matching '{query}'")
+            return
 
-        pretty_terminal_table(rows, column_names, padding = 5)
\ No newline at end of file
+        pretty_terminal_table([list(result) for result in results], ["Chat name", "Turn", "Role", "Match"], padding = 3)
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import sqlite3
+
+from typing import TYPE_CHECKING
+
+from ai_core.chat import Chat
+from ai_core.storage import chat_name, get_chat_store
+
+if TYPE_CHECKING:
+    from ai_core.model import Model
+
+snippet_tokens = 12 # The number of words around each match shown in results
+
+
+def message_hash(message : dict) -> str:
+    return hashlib.sha1(f"{message["role"]}\n{message["content"]}".encode("utf-8")).hexdigest()
+
+def match_query(query : str) -> str:
+    """
+    Turns a plain search into an FTS5 query matching messages containing every word, so punctuation can't break it
+    :param query: the words to search for
+    :return: the FTS5 MATCH expression
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class ChatSearchIndex:
+    """
+    A persistent full-text index of every chat message, in an SQLite FTS5 database.
+    Messages are added as chats are exported, and chats changed outside of an export are reindexed
+    when their file's mtime or size no longer matches, so searching never reads unchanged chat files
+    """
+    def __init__(self, db_path : str, chats_path : str):
+        """
+        :param db_path: the path of the SQLite database to store the index in
+        :param chats_path: the directory the chats are stored in. Chat files are stored relative to it, as in ChatIndex
+        """
+        self.db_path = db_path
+        self.chats_path = chats_path
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.db_path)
+            connection.executescript("""
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS chats (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE NOT NULL,
+                    file TEXT,
+                    mtime REAL,
+                    size INTEGER,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    last_hash TEXT
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(role UNINDEXED, content,
+                                                                       tokenize = 'unicode61 remove_diacritics 2');
+            """)
+            self._connection = connection # Only once it's set up, so a failure is retried rather than half done
+        return self._connection
+
+    # Each message's rowid is its chat id in the high bits and its turn in the low bits,
+    # so a chat's messages can be found or removed by rowid range
+    @staticmethod
+    def _rowid(chat_id : int, turn : int) -> int:
+        return (chat_id << 32) | turn
+
+    def _chat_id(self, chat_name : str) -> int:
+        connection = self._connect()
+        connection.execute("INSERT OR IGNORE INTO chats (name) VALUES (?)", (chat_name,))
+        return connection.execute("SELECT id FROM chats WHERE name = ?", (chat_name,)).fetchone()[0]
+
+    def _index_messages(self, chat_name : str, chat_path : str, messages : list[dict]) -> None:
+        """
+        Brings a chat's indexed messages up to date, only adding new messages when the chat was appended to
+        """
+        connection = self._connect()
+        chat_id = self._chat_id(chat_name)
+        indexed, last_hash = connection.execute("SELECT message_count, last_hash FROM chats WHERE id = ?", (chat_id,)).fetchone()
+
+        appended = 0 < indexed <= len(messages) and message_hash(messages[indexed - 1]) == last_hash
+        if not appended:
+            indexed = 0
+            connection.execute("DELETE FROM messages WHERE rowid BETWEEN ? AND ?",
+                               (self._rowid(chat_id, 0), self._rowid(chat_id, 0xFFFFFFFF)))
+
+        connection.executemany("INSERT INTO messages (rowid, role, content) VALUES (?, ?, ?)",
+                               ((self._rowid(chat_id, turn), message["role"], message["content"])
+                                for turn, message in enumerate(messages[indexed:], start = indexed)))
+
+        stat = os.stat(chat_path)
+        connection.execute("UPDATE chats SET file = ?, mtime = ?, size = ?, message_count = ?, last_hash = ? WHERE id = ?",
+                           (os.path.relpath(chat_path, self.chats_path), stat.st_mtime, stat.st_size, len(messages),
+                            message_hash(messages[-1]) if messages else None, chat_id))
+
+    def on_export(self, chat : Chat, chat_source : str, model : "Model") -> None:
+        """
+        Chat export listener, indexes new messages without reading the file back.
+        The chat is already saved, so errors only warn. The next search reindexes the chat, as it's out of date
+        """
+        try:
+            with self._connect():
+                self._index_messages(chat_name(chat_source), chat_source, chat.messages)
+        except sqlite3.Error as e:
+            print(f"Warning - couldn't update the chat search index: {e}")
+
+    def remove(self, chat_name : str) -> None:
+        """
+        Removes a chat from the index
+        :param chat_name: the name of the chat to remove
+        """
+        connection = self._connect()
+        with connection:
+            row = connection.execute("SELECT id FROM chats WHERE name = ?", (chat_name,)).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM messages WHERE rowid BETWEEN ? AND ?",
+                                   (self._rowid(row[0], 0), self._rowid(row[0], 0xFFFFFFFF)))
+                connection.execute("DELETE FROM chats WHERE id = ?", (row[0],))
+
+    def sync(self, entries : dict[str, dict]) -> None:
+        """
+        Reindexes chats whose files changed since they were indexed, and drops chats that no longer exist
+        :param entries: the current chat metadata (from ChatIndex.get_entries()), with each chat's file, mtime and size
+        """
+        connection = self._connect()
+        indexed = {name : (file, mtime, size)
+                   for name, file, mtime, size in connection.execute("SELECT name, file, mtime, size FROM chats")}
+
+        for chat_name in indexed.keys() - entries.keys():
+            self.remove(chat_name)
+
+        for chat_name, entry in entries.items():
+            if indexed.get(chat_name) == (entry["file"], entry["mtime"], entry["size"]):
+                continue
+
+            chat_path = os.path.join(self.chats_path, entry["file"])
+            try:
+                data = get_chat_store(chat_path).load(chat_path) or {}
+            except (OSError, ValueError):
+                continue
+            with connection:
+                self._index_messages(chat_name, chat_path, data.get("messages", []))
+
+    def search(self, query : str, limit : int = 20) -> list[tuple[str, int, str, str]]:
+        """
+        Finds the messages containing every word of a query, best matches first
+        :param query: the words to search for
+        :param limit: the maximum number of results
+        :return: a list of (chat name, turn number starting from 1, role, snippet)
+        """
+        if not query.strip():
+            return []
+
+        rows = self._connect().execute(f"""
+            SELECT chats.name, messages.rowid & 0xFFFFFFFF, messages.role,
+                   snippet(messages, 1, '[', ']', '...', {snippet_tokens})
+            FROM messages JOIN chats ON chats.id = messages.rowid >> 32
+            WHERE messages MATCH ?
+            ORDER BY rank
+            LIMIT ?""", (match_query(query), limit))
+        return [(chat_name, turn + 1, role, " ".join(snippet.split())) for chat_name, turn, role, snippet in rows]
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
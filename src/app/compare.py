@@ -0,0 +1,123 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.markdown import Markdown
+from rich.panel import Panel
+from rich.text import Text
+
+from ai_core.chat import Chat
+from ai_core.message import Message
+from ai_core.metrics import CallMetrics, collect_metrics
+from ai_core.model import Model, ModelError
+
+from app.chat_core import format_stats
+
+
+class ComparedResponse:
+    """
+    One model's response to a compared prompt, filled in by its worker thread as it streams
+    """
+    def __init__(self, model : Model):
+        self.model = model
+        self.text = ""
+        self.error = None
+        self.metrics : CallMetrics | None = None
+        self.done = False
+        self._start = time.perf_counter()
+
+    def panel(self, do_markdown : bool) -> Panel:
+        if self.error is not None:
+            body = Text(self.error, style="red")
+        elif self.text == "":
+            body = Text("Waiting for the first token..." if not self.done else "(empty response)", style="dim")
+        else:
+            body = Markdown(self.text) if do_markdown else Text(self.text)
+
+        if self.metrics is not None:
+            stats = format_stats(self.metrics)
+        else:
+            stats = f"{time.perf_counter() - self._start:.1f}s"
+        return Panel(Group(body, Text(stats, style="dim")), title=self.model.model_name, title_align="left")
+
+
+def stream_response(response : ComparedResponse, payload : dict) -> None:
+    with collect_metrics(response.model) as calls:
+        try:
+            for chunk in response.model.stream_chat(payload):
+                response.text += chunk
+        except ModelError as e:
+            response.error = str(e)
+    response.metrics = calls[-1] if calls else None
+    response.done = True
+
+def compare_models(chat : Chat, models : list[Model], do_markdown : bool = True) -> list[ComparedResponse]:
+    """
+    Sends the chat to every model at once, streaming each response into its own live panel.
+    Takes as long as the slowest model, rather than all of them one after another
+    :param chat: the chat to send, ending with the prompt
+    :param models: the models to compare
+    :param do_markdown: whether to render the responses as markdown
+    :return: the responses, in the order of the models
+    """
+    # Payloads are made here, as the summary strategy may call a model and write to the chat.
+    # Encoding the history once up front means the workers only read the shared encoding
+    chat.get_gemini_payload().to_json()
+    payloads = [chat.get_gemini_payload(model.context_window) for model in models]
+    responses = [ComparedResponse(model) for model in models]
+
+    start = time.perf_counter()
+    console = Console()
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = [executor.submit(stream_response, response, payload) for response, payload in zip(responses, payloads)]
+        render = lambda: Group(*(response.panel(do_markdown) for response in responses))
+        with Live(get_renderable=render, console=console, refresh_per_second=8):
+            for future in futures:
+                future.result()
+    wall_time = time.perf_counter() - start
+    if not console.is_terminal:
+        console.line() # Live doesn't end its last line when output isn't a terminal
+
+    durations = [response.metrics.duration for response in responses if response.metrics is not None]
+    console.print(f"Compared {len(models)} models in {wall_time:.2f}s "
+                  f"(the responses took {sum(durations):.2f}s in total, the slowest {max(durations, default=0):.2f}s)",
+                  highlight=False)
+    return responses
+
+def save_responses(chat : Chat, responses : list[ComparedResponse]) -> int:
+    """
+    Adds each successful response to the chat as an assistant turn, tagged with the model that wrote it
+    :return: the number of responses added
+    """
+    added = 0
+    for response in responses:
+        if response.error is None and response.text.strip() != "":
+            chat.add_message(Message("assistant", f"[{response.model.model_name}]\n{response.text}"))
+            added += 1
+    return added
+
+def compare_prompt(prompt : str, models : list[Model], chat_source : str = None, do_markdown : bool = True,
+                   save : bool = False, chat : Chat = None) -> list[ComparedResponse]:
+    """
+    Sends a prompt to every model at once, after the history of a chat if one is given
+    :param prompt: the prompt to send
+    :param models: the models to compare
+    :param chat_source: the path of the chat to send the prompt after, if any
+    :param do_markdown: whether to render the responses as markdown
+    :param save: whether to add the prompt and the tagged responses to the chat, and export it
+    :param chat: the Chat to load the chat into. Defaults to a new Chat
+    :return: the responses, in the order of the models
+    """
+    chat = Chat() if chat is None else chat
+    if chat_source is not None:
+        chat.load(chat_source, False)
+    chat.add_message(Message("user", prompt))
+
+    responses = compare_models(chat, models, do_markdown)
+
+    if save and chat_source is not None:
+        added = save_responses(chat, responses)
+        chat.export(chat_source, models[0], False)
+        print(f"Added {added} responses to the chat")
+    return responses
@@ -1,6 +1,9 @@
+import copy
 import os
+from contextlib import contextmanager
 
 import yaml
+from ai_core.files import FileLock, atomic_write
 from app.constants import config_path
 
 def generate_default_config():
@@ -9,18 +12,28 @@ def generate_default_config():
 
     return {
         "model_sources": {  # API hosters (gemini, ollama, openai etc)
-            "gemini": {"api_key": None}
+            "gemini": {"api_key": None},
+            "ollama": {"host": "http://localhost:11434"}
         },
         "models": [],  # Specific models (llama3, gemini flash 2.0, etc)
-        "default_model": None  # The model to use by default
+        "default_model": None,  # The model to use by default
+        "router": {  # Models to fall back to when the default model is rate limited or failing
+            "backups": [],  # Saved model names, or {"model": name, "api_key": key} to retry with another key
+            "hedge_after": None,  # Seconds without a response before also asking the next backup, None to only fail over
+            "failure_threshold": 3,  # Failures in a row before a model is skipped for the cooldown
+            "cooldown": 60  # Seconds a failing model is skipped for
+        }
     }
 
 class ConfigManager:
     """
-    Handles the configuration file, safely reading and writing to the config file
+    Handles the configuration file, safely reading and writing to the config file.
+    Writes are locked and only change the variables that were set, so processes setting different variables
+    at the same time don't undo each other's changes
     """
 
     def __init__(self):
+        self._pending = None # Variables set in a batch, written when it ends
         self.validate_config()
 
         # Load data after config is known to be OK
@@ -46,12 +59,13 @@ class ConfigManager:
         """
         Reset config to default values.
         Creates directory if it doesn't exist yet
+        :param do_default_config: unused, the alternative config was never made
         """
         if not os.path.exists(config_path):
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
 
-        with open(config_path, "w") as f:
-            yaml.dump(generate_default_config(do_default_config), f, sort_keys=False)
+        with FileLock(config_path), atomic_write(config_path) as f:
+            yaml.dump(generate_default_config(), f, sort_keys=False)
 
     def get_config_variable(self, variable_name) -> any:
         """
@@ -69,6 +83,58 @@ class ConfigManager:
         :param variable: the name of the variable to set
         :param new_value: the value to set the variable to
         """
-        self.data[variable] = new_value
-        with open(config_path, 'w') as f:
-            yaml.dump(self.data, f, default_flow_style=False, sort_keys=False, allow_unicode=True, Dumper=yaml.Dumper)
\ No newline at end of file
+        self.update_config_variable(variable, lambda _: new_value)
+
+    def update_config_variable(self, variable, update) -> None:
+        """
+        Changes a variable by a function of its value. The function is applied again to the value in the config file
+        when it's written, so changes other processes made to the variable meanwhile, like models they added, are kept
+        :param variable: the name of the variable to change
+        :param update: takes the value of the variable, or None if it isn't set, and returns its new value.
+                       It can change the value in place, and is called once more for the value in the file
+        """
+        self.data[variable] = update(self.data.get(variable))
+        if self._pending is not None:
+            self._pending.append((variable, update))
+        else:
+            self.write_config([(variable, update)])
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups the variables set inside a with block into a single write of the config file, when the block ends
+        """
+        if self._pending is not None: # Already in a batch
+            yield
+            return
+        self._pending = []
+        try:
+            yield
+        finally:
+            changes, self._pending = self._pending, None
+            if changes:
+                self.write_config(changes)
+
+    def write_config(self, changes : list) -> None:
+        """
+        Writes variables to the config file, keeping changes other processes made to the rest of it
+        :param changes: the variables to write, and the functions that update their values, in the order they were made
+        """
+        with FileLock(config_path):
+            try:
+                with open(config_path, "r") as file:
+                    current = yaml.safe_load(file) or {}
+            except (FileNotFoundError, yaml.YAMLError):
+                current = None # Written again from the config in memory
+
+            if current is None:
+                data = self.data # Already has the changes
+            else:
+                data = copy.deepcopy(current) # Updated in place, so keep current to compare with
+                for variable, update in changes:
+                    data[variable] = update(data.get(variable))
+
+            if data != current:
+                with atomic_write(config_path) as f:
+                    yaml.dump(data, f, default_flow_style=False, sort_keys=False, allow_unicode=True, Dumper=yaml.Dumper)
+        self.data = data
@@ -1,16 +1,26 @@
 import os
 
-from ai_core.model import GeminiModel  # , OllamaModel
-from platformdirs import user_config_dir, user_data_dir
+from platformdirs import user_config_dir, user_data_dir, user_cache_dir
 
 cli_keyword = "chat" #The command alias the program uses
 program_name = "ai_chat" #The directory name for the program
 
 config_path = os.path.join(user_config_dir(program_name), "config.yaml")
+model_cache_path = os.path.join(user_config_dir(program_name), "model_cache.yaml")
 data_path = user_data_dir(program_name)
+chat_index_path = os.path.join(data_path, "index.json")
+chat_archive_path = os.path.join(data_path, "archive")
+chat_search_path = os.path.join(data_path, "search.db")
+response_cache_path = os.path.join(user_cache_dir(program_name), "responses")
+daemon_socket_path = os.path.join(user_cache_dir(program_name), "daemon.sock")
+daemon_log_path = os.path.join(user_cache_dir(program_name), "daemon.log")
+
+model_cache_ttl = 24 * 60 * 60 #Seconds a cached list of available models stays valid, overridable with model_cache_ttl in config
+archive_after_days = 30 #Days a chat is left untouched before chat gc archives it, overridable with archive_after_days in config
 
 # TODO add more sources
+# The names of the Model classes in ai_core.model, so importing the constants doesn't import every model backend
 MODEL_SOURCES = {
-    "gemini" : GeminiModel,
-    #"ollama": OllamaModel}
+    "gemini" : "GeminiModel",
+    "ollama" : "OllamaModel"
 }
@@ -0,0 +1,328 @@
+import copy
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+from typing import Iterator
+
+from ai_core.context import ContextWindow
+from ai_core.model import Model, ModelError, StreamEvent
+
+from app.constants import config_path, cli_keyword
+
+# The daemon speaks newline delimited JSON over a Unix socket, one connection per call.
+# A client sends a request line ({"op": ...}) and, for calls, a line with the chat payload (or null).
+# The daemon answers with one line, or for calls with a {"kind": ..., "value": ...} line per response event,
+# then {"done": true, "metrics": {...}} or {"error": "..."}
+
+remote_metrics = ("connect_time", "prompt_tokens", "response_tokens", "bytes_sent", "bytes_received", "cached", "finish_reason")
+
+
+def daemon_supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+class ChatDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves model calls over a Unix socket, keeping the config, validated models and their pooled connections
+    in memory between calls. The config is reloaded when the config file changes
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path : str):
+        """
+        :param socket_path: the path of the Unix socket to listen on
+        """
+        self.socket_path = socket_path
+        self.models = {} # Model name to the Model, created and validated on its first call
+        self._lock = threading.Lock()
+        self._config_mtime = None
+        self.load_config()
+
+        super().__init__(socket_path, DaemonHandler)
+        os.chmod(socket_path, 0o600) # Only the user can send calls with their API keys
+
+    def load_config(self) -> None:
+        from app.config_manager import ConfigManager
+        from app.model_manager import ModelManager
+
+        self._config_mtime = os.stat(config_path).st_mtime_ns if os.path.exists(config_path) else None
+        self.config_manager = ConfigManager()
+        self.model_manager = ModelManager(self.config_manager)
+        self.models = {}
+
+    def get_model(self, model_name : str = None) -> Model:
+        """
+        :param model_name: the name of a saved model. Defaults to the default model
+        :return: the model, shared by every call to it
+        :raises ModelError: when there is no such model, or it couldn't be loaded
+        """
+        with self._lock:
+            config_mtime = os.stat(config_path).st_mtime_ns if os.path.exists(config_path) else None
+            if config_mtime != self._config_mtime:
+                self.load_config()
+
+            model_name = model_name or self.config_manager.get_config_variable("default_model")
+            if model_name is None:
+                raise ModelError(f"No default model is set. Select one with {cli_keyword} model select <model_name>")
+
+            if model_name not in self.models:
+                model = self.model_manager.get_model_from_config(model_name)
+                if model is None:
+                    raise ModelError(f"The daemon could not load model {model_name}, see its output for details")
+                self.models[model_name] = model
+            return self.models[model_name]
+
+    def serve(self) -> None:
+        """
+        Serves calls until interrupted or stopped, then removes the socket
+        """
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    server : ChatDaemon
+
+    def send(self, message : dict) -> None:
+        self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            match request.get("op"):
+                case "ping":
+                    self.send({"pid": os.getpid()})
+                case "model":
+                    self.describe_model(request)
+                case "invoke" | "stream":
+                    self.call(request, json.loads(self.rfile.readline()))
+                case "stop":
+                    self.send({"stopping": True})
+                    threading.Thread(target=self.server.shutdown).start() # shutdown() waits for this handler
+                case op:
+                    self.send({"error": f"Unknown request {op}"})
+        except ModelError as e:
+            self.send({"error": str(e), "status_code": e.status_code, "retryable": e.retryable})
+        except ValueError as e:
+            self.send({"error": f"Invalid request: {e}"})
+        except OSError:
+            pass # The client went away mid-response
+
+    def describe_model(self, request : dict) -> None:
+        model = self.server.get_model(request.get("model"))
+        window = model.context_window
+        self.send({"model": model.model_name,
+                   "source": model.source,
+                   "context_window": None if window is None else
+                       {"max_tokens": window.max_tokens, "strategy": window.strategy, "keep_first": window.keep_first}})
+
+    def call(self, request : dict, payload : dict | None) -> None:
+        # A shallow copy shares the model's connection pool, but gets its own metrics listener and cache setting
+        shared = self.server.get_model(request.get("model"))
+        calls = []
+        model = copy.copy(shared)
+        model.metrics_listeners = shared.metrics_listeners + [calls.append]
+        if not request.get("cache", True):
+            model.response_cache = None
+
+        if request["op"] == "stream":
+            for event in model.stream_events(prompt = request.get("prompt"), payload = payload):
+                self.send({"kind": event.kind, "value": event.value})
+        else:
+            text = model.invoke(prompt = request.get("prompt"), payload = payload)
+            self.send({"kind": StreamEvent.text, "value": text})
+        self.send({"done": True, "metrics": calls[-1].to_dict() if calls else None})
+
+
+class DaemonModel(Model):
+    """
+    A model whose calls are made by the chat daemon, which keeps the model and its connections warm between processes.
+    Takes the name, source and context window of the daemon's model
+    """
+    def __init__(self, socket_path : str, model_name : str = None, use_cache : bool = True, timeout : float = 300):
+        """
+        :param socket_path: the path of the daemon's Unix socket
+        :param model_name: the name of a saved model. Defaults to the daemon's default model
+        :param use_cache: whether the daemon may answer from its response cache
+        :param timeout: the most seconds to wait for the daemon between messages
+        :raises OSError: when the daemon isn't running
+        :raises ModelError: when the daemon can't load the model
+        """
+        self.socket_path = socket_path
+        self.use_cache = use_cache
+        self.timeout = timeout
+
+        description = next(self.request({"op": "model", "model": model_name}))
+        if "error" in description:
+            raise ModelError(description["error"])
+
+        super().__init__(description["model"], None)
+        self.source = description["source"]
+        window = description["context_window"]
+        if window is not None:
+            self.context_window = ContextWindow(window["max_tokens"], window["strategy"], window["keep_first"], summariser = self)
+
+    def request(self, request : dict, payload : str = None) -> Iterator[dict]:
+        """
+        Sends a request to the daemon
+        :param request: the request line
+        :param payload: the encoded payload line, for calls
+        :return: the messages the daemon answers with
+        :raises OSError: when the daemon can't be reached
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            data = json.dumps(request).encode("utf-8") + b"\n"
+            if payload is not None:
+                data += payload.encode("utf-8") + b"\n"
+            connection.sendall(data)
+
+            with connection.makefile("rb") as lines:
+                for line in lines:
+                    yield json.loads(line)
+
+    def call(self, op : str, prompt : str = None, payload : dict = None, streamed : bool = True) -> Iterator[StreamEvent]:
+        metrics = self.start_metrics(streamed)
+        # Chat payloads reuse their encoded history. The daemon's model adds its own generation config
+        encoded = "null" if payload is None else payload.to_json() if hasattr(payload, "to_json") else json.dumps(payload)
+        messages = self.request({"op": op, "model": self.model_name, "prompt": prompt, "cache": self.use_cache}, encoded)
+        try:
+            for message in messages:
+                if "error" in message:
+                    raise ModelError(message["error"], message.get("status_code"), message.get("retryable"))
+                if message.get("done"):
+                    # The daemon's side of the call: the upstream connection, tokens, sizes and cache hits
+                    for name in remote_metrics if message["metrics"] is not None else ():
+                        setattr(metrics, name, message["metrics"][name])
+                    return
+                yield self.observe(metrics, StreamEvent(message["kind"], message["value"]))
+            raise ModelError("The chat daemon stopped mid-response")
+        except (OSError, ValueError) as e:
+            metrics.error = f"Lost the connection to the chat daemon: {e}"
+            raise ModelError(metrics.error, retryable = True)
+        except ModelError as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            messages.close()
+            self.emit_metrics(metrics)
+
+    def invoke(self, prompt : str = None, payload : dict = None) -> str:
+        """
+        Invoke the LLM with the given prompt, through the daemon
+        :raises ModelError: when an error occurs
+        """
+        return "".join(event.value for event in self.call("invoke", prompt, payload, streamed = False)
+                       if event.kind == StreamEvent.text)
+
+    def stream(self, prompt : str = None, payload : dict = None) -> Iterator[str]:
+        """
+        Streams the LLM output with the given prompt, through the daemon
+        :raises ModelError: when an error occurs
+        """
+        for event in self.stream_events(prompt, payload):
+            if event.kind == StreamEvent.text:
+                yield event.value
+
+    def stream_events(self, prompt : str = None, payload : dict = None) -> Iterator[StreamEvent]:
+        return self.call("stream", prompt, payload)
+
+    def invoke_chat(self, chat_payload : dict[str, dict[str, list]]):
+        return self.invoke(payload = chat_payload)
+
+    def stream_chat(self, chat_payload : dict[str, dict[str, list]]):
+        return self.stream(payload = chat_payload)
+
+
+def connect_daemon(socket_path : str, model_name : str = None, use_cache : bool = True) -> DaemonModel | None:
+    """
+    :param socket_path: the path of the daemon's Unix socket
+    :param model_name: the name of a saved model. Defaults to the daemon's default model
+    :param use_cache: whether the daemon may answer from its response cache
+    :return: the model served by the daemon, or None if the daemon isn't running or can't serve it
+    """
+    if not daemon_supported() or not os.path.exists(socket_path):
+        return None
+    try:
+        return DaemonModel(socket_path, model_name, use_cache)
+    except (OSError, ValueError, ModelError):
+        return None # Let the call be made in process, which reports any problem with the model itself
+
+def ping_daemon(socket_path : str) -> int | None:
+    """
+    :return: the process id of the running daemon, or None if it isn't running
+    """
+    if not daemon_supported() or not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(5)
+            connection.connect(socket_path)
+            connection.sendall(b'{"op": "ping"}\n')
+            with connection.makefile("rb") as lines:
+                return json.loads(lines.readline())["pid"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def stop_daemon(socket_path : str) -> bool:
+    """
+    :return: whether a running daemon was asked to stop
+    """
+    if ping_daemon(socket_path) is None:
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(b'{"op": "stop"}\n')
+        connection.recv(1024)
+    return True
+
+def run_daemon(socket_path : str, detach : bool = False, log_path : str = None) -> None:
+    """
+    Runs the chat daemon until interrupted or stopped
+    :param socket_path: the path of the Unix socket to listen on
+    :param detach: whether to run it in a new background process instead
+    :param log_path: the file a detached daemon writes its output to
+    """
+    if not daemon_supported():
+        print("The chat daemon needs Unix sockets, which aren't available on this platform")
+        return
+
+    pid = ping_daemon(socket_path)
+    if pid is not None:
+        print(f"The chat daemon is already running (pid {pid})")
+        return
+    if os.path.exists(socket_path):
+        os.remove(socket_path) # Left behind by a daemon that didn't exit cleanly
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    if detach:
+        with open(log_path or os.devnull, "a") as log:
+            process = subprocess.Popen([sys.executable, "-m", "app.launcher", "daemon"], stdin=subprocess.DEVNULL,
+                                       stdout=log, stderr=log, start_new_session=True)
+        print(f"Started the chat daemon in the background (pid {process.pid})" +
+              (f", logging to {log_path}" if log_path else ""))
+        return
+
+    try:
+        daemon = ChatDaemon(socket_path)
+    except OSError as e:
+        print(f"Could not listen on {socket_path}: {e}")
+        return
+    print(f"Chat daemon listening on {socket_path} (pid {os.getpid()}). "
+          f"{cli_keyword} once and {cli_keyword} batch will use it until it's stopped with Ctrl+C or {cli_keyword} daemon --stop",
+          flush=True)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    print("Chat daemon stopped")
@@ -0,0 +1,34 @@
+"""
+The chat command's entry point. Commands that only read local files are run straight away,
+without importing typer, rich or the model backends, so they start as fast as Python itself.
+Everything else (including --help and bad arguments) goes through the full typer app in app.main
+"""
+import sys
+
+
+def list_chats():
+    from app.chat_manager import ChatManager
+    ChatManager().list_chats()
+
+def config_find():
+    from app.constants import config_path, data_path
+    print(f"Config is in {config_path}")
+    print(f"Chat data is in {data_path}")
+
+# Exact argument lists that are run without the typer app. They take no options, so there is nothing to parse
+fast_commands = {
+    ("list",): list_chats,
+    ("config", "find"): config_find,
+}
+
+def run():
+    command = fast_commands.get(tuple(sys.argv[1:]))
+    if command is not None:
+        command()
+        return
+
+    from app.main import run as run_app
+    run_app()
+
+if __name__ == "__main__":
+    run()
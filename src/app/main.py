@@ -1,22 +1,20 @@
+import os
+from functools import cached_property
 from typing import Optional
 
 import typer
 
-from app import chat_core
+from ai_core.context import ContextWindow
+from ai_core.metrics import read_metrics, summarise_metrics
+from ai_core.storage import chat_name as name_of_chat
+
+from app import launcher
 from app.constants import *
 from app.util import pretty_terminal_table
 
-from app.config_manager import ConfigManager
-from app.model_manager import ModelManager
-from app.chat_manager import ChatManager
-
 
 class App:
     def __init__(self):
-        self.config_manager = ConfigManager()
-        self.model_manager = ModelManager(self.config_manager)
-        self.chat_manager = ChatManager()
-
         self.app = typer.Typer(context_settings={"help_option_names": ["-h", "--help"]},
                           no_args_is_help=True,
                           add_completion=False)
@@ -31,12 +29,35 @@ class App:
 
         self._register_commands()
 
+    # The managers are made the first time a command uses them, so each command only loads what it needs
+    @cached_property
+    def config_manager(self):
+        from app.config_manager import ConfigManager
+        return ConfigManager()
+
+    @cached_property
+    def model_manager(self):
+        from app.model_manager import ModelManager
+        return ModelManager(self.config_manager)
+
+    @cached_property
+    def chat_manager(self):
+        from app.chat_manager import ChatManager
+        return ChatManager()
+
     def _register_commands(self):
         # main
         self.app.command(name="start")(self.start)
         self.app.command(name="once")(self.once)
+        self.app.command(name="batch")(self.batch)
+        self.app.command(name="compare")(self.compare)
         self.app.command(name="list")(self.list_chats)
         self.app.command(name="delete")(self.delete_chat)
+        self.app.command(name="compact")(self.compact_chats)
+        self.app.command(name="gc")(self.collect_garbage)
+        self.app.command(name="search")(self.search_chats)
+        self.app.command(name="stats")(self.show_stats)
+        self.app.command(name="daemon")(self.daemon)
 
         # config
         self.config_app.command(name="find")(self.config_find_command)
@@ -53,30 +74,59 @@ class App:
         self.model_app.command(name="remove")(self.remove_model)
         self.model_app.command(name="setapi")(self.set_api_key)
         self.model_app.command(name="list")(self.list_models)
+        self.model_app.command(name="context")(self.set_context_tokens)
+        self.model_app.command(name="cache")(self.set_context_cache)
+
+    def get_default_model(self, no_cache : bool = False, use_daemon : bool = True):
+        """
+        :param no_cache: whether to skip the response cache
+        :param use_daemon: whether to make calls through the chat daemon when it's running
+        :return: the default model, or None if it couldn't be loaded
+        """
+        if use_daemon:
+            from app.daemon import connect_daemon
+            model = connect_daemon(daemon_socket_path, use_cache = not no_cache)
+            if model is not None:
+                return model
+
+        model = self.model_manager.get_default_model(self.config_manager)
+        if model is not None and no_cache:
+            model.response_cache = None
+        return model
 
     # -------------- main commands -------------- #
 
     def start(self,
               chat_name: Optional[str] = typer.Argument(None, help="Optional name of the chat history to start."),
               no_stream: bool = typer.Option(False, "--nostream", is_flag=True, help = "Disable streaming"),
-              no_markdown: bool = typer.Option(False, "--nomarkdown", is_flag=True, help = "Disable markdown printing")):
+              no_markdown: bool = typer.Option(False, "--nomarkdown", is_flag=True, help = "Disable markdown printing"),
+              no_cache: bool = typer.Option(False, "--no-cache", is_flag=True, help="Don't use cached responses"),
+              stats: bool = typer.Option(False, "--stats", is_flag=True, help="Show the latency and token usage of each response")):
         """
         Starts the chat, optionally giving the name of the chat history to start.
         """
         model = self.model_manager.get_default_model(self.config_manager)
         if model is not None:
+            if no_cache:
+                model.response_cache = None
+
+            from app import chat_core
+
             chat_path = self.chat_manager.select_chat(chat_name)
-            chat_core.start_chat(chat_path, model, not no_stream, not no_markdown)
+            chat_core.start_chat(chat_path, model, not no_stream, not no_markdown, self.chat_manager.new_chat(), stats)
 
     def once(self,
              message: Optional[list[str]] = typer.Argument(None, help = "The message to send to the LLM"),
              chat_name: Optional[str] = typer.Option(None, "--chat", help="Specify the chat history name to export"),
              no_stream: bool = typer.Option(False, "--nostream", is_flag=True, help="Disable streaming"),
-             no_markdown: bool = typer.Option(False, "--nomarkdown", is_flag=True, help="Disable markdown printing")):
+             no_markdown: bool = typer.Option(False, "--nomarkdown", is_flag=True, help="Disable markdown printing"),
+             no_cache: bool = typer.Option(False, "--no-cache", is_flag=True, help="Don't use cached responses"),
+             stats: bool = typer.Option(False, "--stats", is_flag=True, help="Show the latency and token usage of the response"),
+             no_daemon: bool = typer.Option(False, "--no-daemon", is_flag=True, help="Don't send the message through a running chat daemon")):
         """
         Send a single chat message.
         """
-        model = self.model_manager.get_default_model(self.config_manager)
+        model = self.get_default_model(no_cache, not no_daemon)
         if model is None:
             return
 
@@ -89,7 +139,78 @@ class App:
         if chat_name is not None:
             chat_source = self.chat_manager.select_chat(chat_name)
 
-        chat_core.single_message(full_message, model, chat_source, not no_stream, not no_markdown)
+        from app import chat_core
+
+        response = chat_core.single_message(full_message, model, chat_source, not no_stream, not no_markdown,
+                                            self.chat_manager.new_chat(), stats)
+        if response is None:
+            raise typer.Exit(code=1)
+
+    def batch(self,
+              input_path: str = typer.Argument(help="A .jsonl/.csv/text file of prompts, or - to read from stdin"),
+              output_path: Optional[str] = typer.Option(None, "--output", "-o", help="The .jsonl file to write results to. Defaults to <input>.results.jsonl, or stdout for stdin"),
+              concurrency: int = typer.Option(4, "--concurrency", "-c", help="The maximum number of requests in flight"),
+              system_prompt: Optional[str] = typer.Option(None, "--system", help="The system prompt for prompts that don't set their own"),
+              no_cache: bool = typer.Option(False, "--no-cache", is_flag=True, help="Don't use cached responses"),
+              no_daemon: bool = typer.Option(False, "--no-daemon", is_flag=True, help="Don't send the prompts through a running chat daemon")):
+        """
+        Answer a file of prompts, skipping prompts already answered in the output file.
+        """
+        model = self.get_default_model(no_cache, not no_daemon)
+        if model is None:
+            return
+
+        if output_path is None and input_path != "-":
+            output_path = os.path.splitext(input_path)[0] + ".results.jsonl"
+
+        from app import batch
+
+        batch.run_batch(model, input_path, output_path, concurrency, system_prompt)
+
+    def compare(self,
+                prompt: Optional[list[str]] = typer.Argument(None, help="The prompt to send to every model"),
+                models: Optional[str] = typer.Option(None, "--models", "-m", help="Comma separated names of the models to compare. Defaults to every saved model"),
+                chat_name: Optional[str] = typer.Option(None, "--chat", help="Specify the chat history to send the prompt after"),
+                save: bool = typer.Option(False, "--save", is_flag=True, help="Add the prompt and every response to the --chat history, tagged with their model"),
+                no_markdown: bool = typer.Option(False, "--nomarkdown", is_flag=True, help="Disable markdown printing"),
+                no_cache: bool = typer.Option(False, "--no-cache", is_flag=True, help="Don't use cached responses")):
+        """
+        Send the same prompt to several models at once, to compare their responses.
+        """
+        if save and chat_name is None:
+            print(f"Error: --save needs the --chat option, to specify which chat history to save to.")
+            raise typer.Exit(code=1)
+
+        if models is None:
+            model_names = [model["name"] for model in self.model_manager.saved_models]
+        else:
+            model_names = list(dict.fromkeys(name.strip() for name in models.split(",") if name.strip() != ""))
+        if len(model_names) == 0:
+            print(f"No models to compare. Add models with {cli_keyword} model add <model_name> <model_source>")
+            return
+
+        loaded_models = []
+        for model_name in model_names:
+            if not self.model_manager.is_model_in_config(model_name):
+                print(f"{model_name} is not a valid model name")
+                print(f"Check models with {cli_keyword} model list")
+                return
+            model = self.model_manager.get_model_from_config(model_name)
+            if model is None:
+                return
+            if no_cache:
+                model.response_cache = None
+            loaded_models.append(model)
+
+        full_prompt = input("Enter a prompt >> ") if prompt is None else " ".join(prompt)
+
+        chat_source = None
+        if chat_name is not None:
+            chat_source = self.chat_manager.select_chat(chat_name)
+
+        from app import compare
+
+        compare.compare_prompt(full_prompt, loaded_models, chat_source, not no_markdown, save, self.chat_manager.new_chat())
 
     def list_chats(self):
         """
@@ -103,6 +224,78 @@ class App:
         """
         self.chat_manager.delete_chat(chat_name)
 
+    def compact_chats(self, chat_name: Optional[str] = typer.Argument(None, help="The name of the chat to compact. Compacts every chat if not given")):
+        """
+        Compacts chat files, dropping replaced history and converting old .yaml chats
+        """
+        if chat_name is not None:
+            self.chat_manager.compact_chat(chat_name)
+            return
+
+        for chat_path in self.chat_manager.get_chat_paths():
+            self.chat_manager.compact_chat(name_of_chat(chat_path))
+
+    def collect_garbage(self,
+                        days: Optional[float] = typer.Option(None, "--days", help=f"Archive chats untouched for this many days. Defaults to archive_after_days in the config, or {archive_after_days}"),
+                        dry_run: bool = typer.Option(False, "--dry-run", help="Only show what would be archived and removed")):
+        """
+        Compresses chats that haven't been used for a while into the archive, and removes leftover files.
+        Archived chats are still listed, and are restored when they're opened
+        """
+        if days is None:
+            days = self.config_manager.get_config_variable("archive_after_days") or archive_after_days
+        self.chat_manager.collect_garbage(days, dry_run)
+
+    def search_chats(self,
+                     query: list[str] = typer.Argument(help="The words to search for"),
+                     limit: int = typer.Option(20, "--limit", "-n", help="The maximum number of results to show")):
+        """
+        Searches the messages of every chat
+        """
+        self.chat_manager.search_chats(" ".join(query), limit)
+
+    def show_stats(self, metrics_path: Optional[str] = typer.Argument(None, help="The metrics .jsonl file to summarise. Defaults to metrics_log in the config")):
+        """
+        Summarises the latency of logged model calls (set metrics_log in the config to log every call)
+        """
+        metrics_path = metrics_path or self.config_manager.get_config_variable("metrics_log")
+        if metrics_path is None:
+            print(f"No metrics file given. Set metrics_log in the config (find it with {cli_keyword} config find) "
+                  f"to log the metrics of every model call")
+            return
+
+        try:
+            summaries = summarise_metrics(read_metrics(os.path.expanduser(metrics_path)))
+        except FileNotFoundError:
+            print(f"No metrics have been logged to {metrics_path} yet")
+            return
+
+        milliseconds = lambda seconds: "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+        rows = [[model_name, summary["calls"], summary["errors"], summary["cached"],
+                 milliseconds(summary["first_token_p50"]), milliseconds(summary["first_token_p99"]),
+                 milliseconds(summary["duration_p50"]), milliseconds(summary["duration_p99"]), summary["response_tokens"]]
+                for model_name, summary in summaries.items()]
+        pretty_terminal_table(rows, ["Model", "Calls", "Errors", "Cached", "First token p50", "p99",
+                                     "Total p50", "p99", "Tokens out"])
+
+    def daemon(self,
+               detach: bool = typer.Option(False, "--detach", "-d", is_flag=True, help="Run the daemon in the background"),
+               stop: bool = typer.Option(False, "--stop", is_flag=True, help="Stop the running daemon"),
+               status: bool = typer.Option(False, "--status", is_flag=True, help="Show whether the daemon is running")):
+        """
+        Runs a daemon that keeps models and connections warm, used by once and batch while it's running
+        """
+        from app import daemon
+
+        if stop:
+            print("Chat daemon stopped" if daemon.stop_daemon(daemon_socket_path) else "The chat daemon isn't running")
+        elif status:
+            pid = daemon.ping_daemon(daemon_socket_path)
+            print(f"The chat daemon is running (pid {pid}) on {daemon_socket_path}" if pid is not None
+                  else "The chat daemon isn't running")
+        else:
+            daemon.run_daemon(daemon_socket_path, detach, daemon_log_path)
+
     # -------------- system prompt commands -------------- #
 
     def set_system_prompt(self,
@@ -154,8 +347,7 @@ class App:
         """
         Displays the location of the config file and the chat data
         """
-        print(f"Config is in {config_path}")
-        print(f"Chat data is in {data_path}")
+        launcher.config_find()
 
     def config_reset_command(self, preset_config: bool = typer.Option(False, "--default", "-d", is_flag=True,
                              help = "Use an alternative config that attempts to find a .env file in the __main__.py location for api keys. Really only exists for debugging, feel free to ignore.")):
@@ -190,8 +382,12 @@ class App:
             models = self.config_manager.get_config_variable("models")
             model = {"name" : model_name, "source" : model_source}
             if model not in models:
-                models.append(model)
-                self.config_manager.set_config_variable("models", models)
+                def add(models):
+                    models = models or []
+                    if model not in models: # Unless another process just added it
+                        models.append(model)
+                    return models
+                self.config_manager.update_config_variable("models", add)
                 print(f"Successfully created new model {model_name}")
             else:
                 print(f"Model {model_name} from {model_source} already exists")
@@ -206,13 +402,8 @@ class App:
                 print(f"Failed to delete. {model_name} is the selected model.")
                 print(f"Select a different model with {cli_keyword} model select <model_name> before deleting model {model_name}")
             else:
-                models = self.config_manager.get_config_variable("models")
-                new_models = []
-                for model in models:
-                    if model["name"] != model_name:
-                        new_models.append(model)
-                        break
-                self.config_manager.set_config_variable("models", new_models)
+                self.config_manager.update_config_variable(
+                    "models", lambda models: [model for model in models or [] if model["name"] != model_name])
                 print(f"Removed model {model_name}")
         else:
             print(f"{model_name} is not a valid model name")
@@ -231,11 +422,83 @@ class App:
             print(f"Type '{cli_keyword} model' to find a list of supported model sources")
             return
 
-        sources[model_source]["api_key"] = api_key
-        self.config_manager.set_config_variable("model_sources", sources)
+        def set_key(sources):
+            sources = sources or {}
+            if not sources.get(model_source):
+                sources[model_source] = {}
+            sources[model_source]["api_key"] = api_key
+            return sources
+        self.config_manager.update_config_variable("model_sources", set_key)
 
         print(f"Successfully set new api key for source {model_source}")
 
+    def set_context_tokens(self,
+                  model_name: str = typer.Argument(help="The name of the model to set the context size of"),
+                  max_tokens: int = typer.Argument(help="The most tokens of chat history to send each message. 0 sends everything"),
+                  strategy: Optional[str] = typer.Option(None, "--strategy",
+                                                         help="How to fit chats into the context, for every model: sliding, keep_first or summary")):
+        """
+        Limit how much of a chat is sent to a model, so long chats stay fast and cheap
+        """
+        if not self.model_manager.is_model_in_config(model_name):
+            print(f"{model_name} is not a valid model name")
+            print(f"Check models with {cli_keyword} model list, "
+                  f"or add a model with {cli_keyword} model add <model_name> <model_source>")
+            return
+
+        if strategy is not None and strategy not in ContextWindow.strategies:
+            print(f"{strategy} is not a context strategy. Strategies are: {", ".join(ContextWindow.strategies)}")
+            return
+
+        with self.config_manager.batch():
+            if strategy is not None:
+                self.config_manager.set_config_variable("context_strategy", strategy)
+
+            def set_tokens(models):
+                for model in models or []:
+                    if model["name"] == model_name:
+                        if max_tokens > 0:
+                            model["context_tokens"] = max_tokens
+                        else:
+                            model.pop("context_tokens", None)
+                return models
+            self.config_manager.update_config_variable("models", set_tokens)
+
+        if max_tokens > 0:
+            print(f"Chats sent to {model_name} are now limited to about {max_tokens} tokens")
+        else:
+            print(f"Chats sent to {model_name} are no longer limited")
+
+    def set_context_cache(self,
+                  model_name: str = typer.Argument(help="The name of the model to cache chats for"),
+                  off: bool = typer.Option(False, "--off", help="Stop caching chats for the model"),
+                  ttl: int = typer.Option(3600, "--ttl", help="The seconds a cache lives for after its last use"),
+                  min_tokens: int = typer.Option(4096, "--min-tokens", help="The fewest uncached tokens worth making a new cache for")):
+        """
+        Keep the start of long chats in the model's context cache, so each message only uploads the newest turns.
+        Cached tokens are billed for storage while the cache lives
+        """
+        if not self.model_manager.is_model_in_config(model_name):
+            print(f"{model_name} is not a valid model name")
+            print(f"Check models with {cli_keyword} model list, "
+                  f"or add a model with {cli_keyword} model add <model_name> <model_source>")
+            return
+
+        def set_cache(models):
+            for model in models or []:
+                if model["name"] == model_name:
+                    if off:
+                        model.pop("context_cache", None)
+                    else:
+                        model["context_cache"] = {"ttl": ttl, "min_tokens": min_tokens}
+            return models
+        self.config_manager.update_config_variable("models", set_cache)
+
+        if off:
+            print(f"Chats sent to {model_name} are no longer cached")
+        else:
+            print(f"Chats sent to {model_name} are now cached once they grow by {min_tokens} tokens, for {ttl}s after their last use")
+
     def list_models(self):
         """
         List all current created model data, and model sources
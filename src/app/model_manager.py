@@ -1,8 +1,16 @@
+import os
 from typing import Type
 
+from ai_core.catalogue import ModelCatalogue
+from ai_core.context import ContextWindow
+from ai_core.context_cache import ContextCache
+from ai_core.metrics import JsonlMetricsSink
+from ai_core import model as model_classes
 from ai_core.model import Model, LocalModel, InvalidModelException, InvalidAPIKeyException
+from ai_core.response_cache import ResponseCache
+from ai_core.router import RouterModel
 
-from app.constants import MODEL_SOURCES, cli_keyword
+from app.constants import MODEL_SOURCES, cli_keyword, model_cache_path, model_cache_ttl, response_cache_path
 
 
 class ModelManager:
@@ -11,19 +19,34 @@ class ModelManager:
         self.saved_models = config_manager.get_config_variable("models")
         self.default_model_name = config_manager.get_config_variable("default_model")
 
-        if self.model_source_data is None or len(self.model_source_data) == 0:
-            print("Warning - No model sources found in config. Ensure config file is valid.")
-            return
+        # Saved models are only validated when they are actually used, and then against the cached catalogue first
+        ttl = config_manager.get_config_variable("model_cache_ttl")
+        self.catalogue = ModelCatalogue(model_cache_path, model_cache_ttl if ttl is None else ttl)
+
+        # Opt-in cache of responses to identical deterministic (temperature 0) requests.
+        # response_cache_all also caches sampled requests, which then always get the same answer
+        self.response_cache = None
+        if config_manager.get_config_variable("response_cache"):
+            max_age = config_manager.get_config_variable("response_cache_max_age")
+            max_size_mb = config_manager.get_config_variable("response_cache_max_mb")
+            self.response_cache = ResponseCache(response_cache_path,
+                                                max_age = 7 * 24 * 60 * 60 if max_age is None else max_age,
+                                                max_size = (100 if max_size_mb is None else max_size_mb) * 1024 * 1024,
+                                                deterministic_only = not config_manager.get_config_variable("response_cache_all"))
+
+        # How chats are cut down to fit the context_tokens set on a model
+        self.context_strategy = config_manager.get_config_variable("context_strategy") or "sliding"
+        self.context_keep_first = config_manager.get_config_variable("context_keep_first")
 
+        # Backup models the default model falls back to, see RouterModel
+        self.router_config = config_manager.get_config_variable("router") or {}
 
-        # Validate all existing saved models
-        models = config_manager.get_config_variable("models")
-        for model in models:
-            result = self.validate_model(model["name"], model["source"], display_errors = False)
-            if not result:
-                print(f"Warning - an error occurred validating a saved model. ({model})\n"
-                      f"Check the config files are up to date and valid, and ensure API keys are valid")
-                break
+        # Optional .jsonl file every model call's latency and token metrics are appended to
+        metrics_log = config_manager.get_config_variable("metrics_log")
+        self.metrics_sink = None if metrics_log is None else JsonlMetricsSink(os.path.expanduser(metrics_log))
+
+        if self.model_source_data is None or len(self.model_source_data) == 0:
+            print("Warning - No model sources found in config. Ensure config file is valid.")
 
     def validate_model(self, model_name : str, model_source : str, display_errors = True) -> bool:
         """
@@ -34,10 +57,10 @@ class ModelManager:
         :return: True if the model exists, False otherwise
         """
         model_source = model_source.strip() #Validate model source
-        if model_source not in self.model_source_data:
+        if model_source not in MODEL_SOURCES:
             if display_errors:
                 print(f"{model_source} is not a currently supported model source. Supported sources:")
-                for source in self.model_source_data:
+                for source in MODEL_SOURCES:
                     print(f" - {source}")
             return False
 
@@ -49,7 +72,7 @@ class ModelManager:
     def is_model_in_config(self, model_name):
         return any(model["name"] == model_name for model in self.saved_models)
 
-    def get_model(self, model_name : str, model_source : str, display_errors = True) -> None | Model | LocalModel:
+    def get_model(self, model_name : str, model_source : str, display_errors = True, api_key : str = None) -> None | Model | LocalModel:
         """
         Returns a Model class, given name and model source.
         Used for checking if a given model from a source actually can exist
@@ -57,17 +80,30 @@ class ModelManager:
         :param model_name: the name of the model.
         :param model_source: the api source of the model (e.g. gemini, ollama, etc)
         :param display_errors: whether to display error messages or not
+        :param api_key: the API key to use instead of the model source's
         :return: The Model class corresponding to the saved model name/source, or None on error
         """
 
-        model: Type[Model] = MODEL_SOURCES[model_source]
+        model: Type[Model] = getattr(model_classes, MODEL_SOURCES[model_source])
 
         try:
             if issubclass(model, LocalModel):
-                return model(model_name)
+                # Local sources don't need any config, but can set where their server is
+                source_data = (self.model_source_data or {}).get(model_source) or {}
+                model_instance = model(model_name, host = source_data.get("host"))
             else:
-                api_key = self.model_source_data[model_source]["api_key"]
-                return model(model_name, api_key)
+                source_data = (self.model_source_data or {}).get(model_source) or {}
+                api_key = api_key or source_data.get("api_key")
+                if not api_key:
+                    if display_errors:
+                        print(f"No API key is set for source {model_source}.")
+                        print(f"Set an API key for {model_source} with {cli_keyword} model setapi <model_source> <api_key>")
+                    return None
+                model_instance = model(model_name, api_key, catalogue = self.catalogue)
+            model_instance.response_cache = self.response_cache
+            if self.metrics_sink is not None:
+                model_instance.metrics_listeners.append(self.metrics_sink)
+            return model_instance
         except InvalidAPIKeyException:
             if display_errors:
                 print(f"The API key for source {model_source} is invalid.")
@@ -78,22 +114,44 @@ class ModelManager:
                 print(f"An error occurred validating this model: {e}")
             return None
 
-    def get_model_from_config(self, model_name : str) -> Model | None:
+    def get_model_from_config(self, model_name : str, api_key : str = None) -> Model | None:
         """
         Returns a Model class, given only the name, from the saved model data
         :param model_name: the name of the model.
+        :param api_key: the API key to use instead of the model source's
         :return: The Model class corresponding to the saved model name/source.
         """
         model_source = None
+        context_tokens = None
+        context_cache = None
         for saved_model in self.saved_models:
             if saved_model["name"] == model_name:
                 model_source = saved_model["source"]
+                context_tokens = saved_model.get("context_tokens")
+                context_cache = saved_model.get("context_cache")
 
         if model_source not in MODEL_SOURCES:
             print(f"Model {model_name} has an invalid source ({model_source}). Ensure config is valid")
             return None
 
-        return self.get_model(model_name, model_source)
+        model = self.get_model(model_name, model_source, api_key = api_key)
+        if model is not None and context_tokens is not None:
+            try:
+                model.context_window = ContextWindow(context_tokens, self.context_strategy,
+                                                     2 if self.context_keep_first is None else self.context_keep_first,
+                                                     summariser = model)
+            except ValueError as e:
+                print(f"Warning - {e}. Sending the full chat history. Ensure config is valid")
+
+        # Opt-in context caching: true, or {"ttl": seconds, "min_tokens": tokens}
+        if model is not None and context_cache:
+            if not hasattr(model, "create_cached_content"):
+                print(f"Warning - {model.source} models don't support context caching. Ensure config is valid")
+            else:
+                options = context_cache if isinstance(context_cache, dict) else {}
+                model.context_cache = ContextCache(model, ttl = options.get("ttl") or 3600,
+                                                   min_tokens = 4096 if options.get("min_tokens") is None else options["min_tokens"])
+        return model
 
     def select_new_default_model(self, config_manager):
         """
@@ -116,5 +174,34 @@ class ModelManager:
             print(f"Error! No models exist yet! Create a new model with {cli_keyword} model add <model_name> <model_source>")
             return None
 
-        return self.get_model_from_config(self.default_model_name)
+        model = self.get_model_from_config(self.default_model_name)
+        return None if model is None else self.get_router(model)
+
+    def get_router(self, model : Model) -> Model:
+        """
+        :param model: the model to send calls to first
+        :return: a RouterModel that falls back from the model to the configured backup models, or the model if there are none
+        """
+        routes = [model]
+        for backup in self.router_config.get("backups") or []:
+            if isinstance(backup, dict):
+                backup_name, api_key = backup.get("model"), backup.get("api_key")
+            else:
+                backup_name, api_key = backup, None
+
+            if not self.is_model_in_config(backup_name):
+                print(f"Warning - backup model {backup_name} is not a saved model. Ensure config is valid")
+                continue
+            route = self.get_model_from_config(backup_name, api_key)
+            if route is None:
+                print(f"Warning - backup model {backup_name} could not be loaded, continuing without it")
+                continue
+            routes.append(route)
+
+        if len(routes) == 1:
+            return model
+        return RouterModel(routes,
+                           hedge_after = self.router_config.get("hedge_after"),
+                           failure_threshold = self.router_config.get("failure_threshold") or 3,
+                           cooldown = 60 if self.router_config.get("cooldown") is None else self.router_config["cooldown"])
 
@@ -0,0 +1,22 @@
+import pytest
+
+from ai_core.model import GeminiModel
+from ai_core.transport import AsyncTransport, Transport
+from fake_gemini import FakeGeminiServer
+
+
+@pytest.fixture
+def gemini_server():
+    with FakeGeminiServer(response_tokens=20) as server:
+        yield server
+
+@pytest.fixture
+def gemini_model(gemini_server):
+    """
+    Makes Gemini models that send their requests to the fake server, on their own transports
+    """
+    def make(model_name : str = "gemini-fake") -> GeminiModel:
+        model = GeminiModel(model_name, "test-key", validate=False, transport=Transport(), async_transport=AsyncTransport())
+        model.base_url = gemini_server.base_url
+        return model
+    return make
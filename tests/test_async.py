@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from ai_core.chat import Chat
+from ai_core.message import Message
+from ai_core.metrics import collect_metrics
+from ai_core.model import ModelError
+from ai_core.transport import AsyncTransport
+
+
+def run(model, coroutine):
+    """
+    Runs a coroutine in a new event loop, closing the model's async connections before the loop ends
+    """
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await model.async_transport.aclose()
+    return asyncio.run(main())
+
+async def collect(stream) -> list:
+    return [item async for item in stream]
+
+
+def test_ainvoke(gemini_server, gemini_model):
+    model = gemini_model()
+    with collect_metrics(model) as calls:
+        text = run(model, model.ainvoke("Hello"))
+
+    assert text == "".join(gemini_server.chunks())
+    assert calls[0].finish_reason == "STOP"
+    assert calls[0].response_tokens == gemini_server.response_tokens
+    assert calls[0].bytes_sent > 0 and calls[0].error is None
+
+def test_astream(gemini_server, gemini_model):
+    model = gemini_model()
+    with collect_metrics(model) as calls:
+        chunks = run(model, collect(model.astream("Hello")))
+
+    assert chunks == gemini_server.chunks()
+    assert calls[0].streamed and calls[0].finish_reason == "STOP"
+    assert calls[0].bytes_received > 0
+
+def test_chat_payload(gemini_server, gemini_model):
+    model = gemini_model()
+    chat = Chat()
+    chat.set_system_prompt("Be brief.")
+    chat.add_message(Message("user", "Hello"))
+
+    assert run(model, model.ainvoke_chat(chat.get_gemini_payload())) == "".join(gemini_server.chunks())
+    assert run(model, collect(model.astream_chat(chat.get_gemini_payload()))) == gemini_server.chunks()
+
+def test_concurrent_calls(gemini_server, gemini_model):
+    model = gemini_model()
+    async def many():
+        return await asyncio.gather(*(model.ainvoke(f"Prompt {i}") for i in range(20)))
+
+    assert run(model, many()) == ["".join(gemini_server.chunks())] * 20
+    assert gemini_server.requests == 20
+
+def test_http_error(gemini_model):
+    model = gemini_model()
+    payload = {"cachedContent": "cachedContents/missing", "contents": [{"role": "user", "parts": [{"text": "Hello"}]}]}
+    with collect_metrics(model) as calls, pytest.raises(ModelError) as error:
+        run(model, model.ainvoke(payload=payload))
+
+    assert error.value.status_code == 403 and not error.value.retryable
+    assert calls[0].error is not None
+
+def test_stream_http_error(gemini_model):
+    model = gemini_model()
+    payload = {"cachedContent": "cachedContents/missing", "contents": [{"role": "user", "parts": [{"text": "Hello"}]}]}
+    with pytest.raises(ModelError) as error:
+        run(model, collect(model.astream(payload=payload)))
+    assert error.value.status_code == 403
+
+def test_connection_error(gemini_model):
+    model = gemini_model()
+    model.base_url = "http://127.0.0.1:1/v1beta" # Nothing listens there
+    model.async_transport = AsyncTransport(max_retries=0)
+    with pytest.raises(ModelError) as error:
+        run(model, model.ainvoke("Hello"))
+    assert error.value.retryable
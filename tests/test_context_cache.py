@@ -0,0 +1,120 @@
+import json
+import os
+
+import pytest
+
+from ai_core.chat import Chat
+from ai_core.context_cache import ContextCache
+from ai_core.message import Message
+from ai_core.metrics import collect_metrics
+
+long_prompt = "Lorem ipsum dolor sit amet " * 100 # About 700 tokens
+
+
+@pytest.fixture
+def model(gemini_model):
+    model = gemini_model()
+    model.context_cache = ContextCache(model, ttl=600, min_tokens=1000)
+    return model
+
+def turn(chat : Chat, model, prompt : str):
+    """
+    Sends a prompt in the chat and adds the response
+    :return: the metrics of the call
+    """
+    chat.add_message(Message("user", prompt))
+    with collect_metrics(model) as calls:
+        response = "".join(model.stream_chat(chat.get_gemini_payload(model.context_window, model.context_cache)))
+    chat.add_message(Message("assistant", response))
+    return calls[-1]
+
+def request_body(chat : Chat, model) -> dict:
+    payload = chat.get_gemini_payload(model.context_window, model.context_cache)
+    return json.loads(model.build_request(payload=payload)[2])
+
+
+def test_not_cached_until_min_tokens(gemini_server, model):
+    chat = Chat()
+    turn(chat, model, "Hello")
+    turn(chat, model, long_prompt)
+    assert chat.cached_content is None and gemini_server.cached_contents == {}
+
+def test_create_and_reuse(gemini_server, model):
+    chat = Chat()
+    chat.set_system_prompt("Be brief.")
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+
+    cached = chat.cached_content
+    assert cached is not None and list(gemini_server.cached_contents) == [cached.name]
+    assert cached.model == model.model_name
+
+    # Small turns reference the same cache, only uploading the turns after it
+    whole_chat = len(model.build_request(payload=chat.get_gemini_payload())[2])
+    small = turn(chat, model, "Thanks")
+    assert chat.cached_content is cached and len(gemini_server.cached_contents) == 1
+    assert small.bytes_sent < whole_chat / 2
+
+    chat.add_message(Message("user", "One more"))
+    body = request_body(chat, model)
+    assert body["cachedContent"] == cached.name and "system_instruction" not in body
+    assert len(body["contents"]) == len(chat.messages) - cached.contents
+
+def test_replaced_once_chat_grows(gemini_server, model):
+    chat = Chat()
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+    first = chat.cached_content
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+
+    assert chat.cached_content.name != first.name and chat.cached_content.contents > first.contents
+    assert list(gemini_server.cached_contents) == [chat.cached_content.name] # The old cache was deleted
+
+def test_reused_after_reload(gemini_server, model, tmp_path):
+    chat = Chat()
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+    path = os.path.join(tmp_path, "chat.jsonl")
+    chat.export(path, model)
+
+    loaded = Chat()
+    loaded.load(path, tail=2)
+    assert loaded.cached_content.name == chat.cached_content.name
+    loaded.add_message(Message("user", "Thanks"))
+    assert request_body(loaded, model)["cachedContent"] == chat.cached_content.name
+
+def test_system_prompt_change_drops_cache(gemini_server, model):
+    chat = Chat()
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+    name = chat.cached_content.name
+
+    chat.set_system_prompt("Be verbose.")
+    assert chat.cached_content is None
+    turn(chat, model, "Hello")
+    assert name not in gemini_server.cached_contents
+
+def test_falls_back_when_cache_is_gone(gemini_server, model):
+    chat = Chat()
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+    gemini_server.cached_contents.clear() # Expired or deleted on the server
+
+    metrics = turn(chat, model, "Thanks")
+    assert metrics.error is None and chat.messages[-1]["content"] == "".join(gemini_server.chunks()).strip()
+    assert not chat.cached_content.valid
+
+    turn(chat, model, "Thanks again") # Replaced with a new cache
+    assert chat.cached_content.valid and list(gemini_server.cached_contents) == [chat.cached_content.name]
+
+def test_stops_after_cache_refused(gemini_server, model):
+    gemini_server.min_cache_tokens = 10 ** 6
+    chat = Chat()
+    for _ in range(3):
+        turn(chat, model, long_prompt)
+    assert chat.cached_content is None and model.context_cache.error is not None
+
+    requests = gemini_server.requests
+    turn(chat, model, long_prompt)
+    assert gemini_server.requests == requests + 1 # Doesn't upload the chat to try again
@@ -0,0 +1,165 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ai_core.chat import Chat
+from ai_core.message import Message
+from ai_core.metrics import collect_metrics
+from ai_core.model import GeminiModelParameters, InvalidModelException, ModelError, OllamaModel, StreamEvent
+from ai_core.transport import Transport
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Ollama REST API, serving /api/tags, /api/generate and /api/chat
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeOllamaHandler)
+        self.models = ["llama3:latest", "qwen:7b"]
+        self.words = ["Hel", "lo", " there"]
+        self.error = None # (status, message) to answer generation requests with instead
+        self.stream_lines = None # Raw lines to stream instead of the words
+        self.bodies = [] # The decoded generation requests received
+
+    @property
+    def host(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server : FakeOllamaServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status : int, body : bytes, content_type : str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send(200, json.dumps({"models": [{"name": name} for name in self.server.models]}).encode())
+        else:
+            self.send(404, b"404 page not found", "text/plain")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.bodies.append(body)
+        if self.server.error is not None:
+            status, message = self.server.error
+            return self.send(status, json.dumps({"error": message}).encode())
+
+        def line(text : str, done : bool) -> dict:
+            if self.path == "/api/chat":
+                return {"message": {"role": "assistant", "content": text}, "done": done}
+            return {"response": text, "done": done}
+        final = {**line("", True), "done_reason": "stop", "prompt_eval_count": 7, "eval_count": len(self.server.words)}
+
+        if not body["stream"]:
+            self.send(200, json.dumps({**final, **line("".join(self.server.words), True)}).encode())
+        else:
+            lines = self.server.stream_lines
+            if lines is None:
+                lines = [json.dumps(line(word, False)) for word in self.server.words] + [json.dumps(final)]
+            self.send(200, "".join(line + "\n" for line in lines).encode(), "application/x-ndjson")
+
+
+@pytest.fixture
+def server():
+    server = FakeOllamaServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def model(server):
+    return OllamaModel("llama3", host=server.host, transport=Transport(max_retries=0))
+
+
+def test_model_exists(server):
+    OllamaModel("llama3", host=server.host) # Matches llama3:latest
+    OllamaModel("qwen:7b", host=server.host)
+    with pytest.raises(InvalidModelException):
+        OllamaModel("mistral", host=server.host)
+
+def test_server_down():
+    with pytest.raises(InvalidModelException):
+        OllamaModel("llama3", host="http://127.0.0.1:1", transport=Transport(max_retries=0))
+
+def test_invoke(server, model):
+    model.parameters = GeminiModelParameters(temperature=0.5)
+    with collect_metrics(model) as calls:
+        assert model.invoke("Hi") == "Hello there"
+
+    body = server.bodies[0]
+    assert body["prompt"] == "Hi" and not body["stream"]
+    assert body["options"]["temperature"] == 0.5 and body["keep_alive"] == model.keep_alive
+    assert calls[0].finish_reason == "stop" and calls[0].prompt_tokens == 7
+
+def test_chat(server, model):
+    chat = Chat()
+    chat.set_system_prompt("Be brief.")
+    chat.add_message(Message("user", "Hi"))
+    chat.add_message(Message("assistant", "Hello"))
+    chat.add_message(Message("user", "How are you?"))
+
+    assert model.invoke_chat(chat.get_gemini_payload()) == "Hello there"
+    assert server.bodies[0]["messages"] == [{"role": "system", "content": "Be brief."},
+                                            {"role": "user", "content": "Hi"},
+                                            {"role": "assistant", "content": "Hello"},
+                                            {"role": "user", "content": "How are you?"}]
+
+def test_stream(server, model):
+    assert list(model.stream("Hi")) == server.words
+
+    chat = Chat()
+    chat.add_message(Message("user", "Hi"))
+    with collect_metrics(model) as calls:
+        events = list(model.stream_events(payload=chat.get_gemini_payload()))
+
+    assert [event.value for event in events if event.kind == StreamEvent.text] == server.words
+    assert [event.kind for event in events[-2:]] == [StreamEvent.finish, StreamEvent.usage]
+    assert events[-1].value["candidatesTokenCount"] == len(server.words)
+    assert calls[0].streamed and calls[0].bytes_received > 0
+
+def test_http_error(server, model):
+    server.error = (404, "model 'llama3' not found, try pulling it first")
+    with collect_metrics(model) as calls, pytest.raises(ModelError) as error:
+        model.invoke("Hi")
+    assert error.value.status_code == 404 and "not found" in str(error.value)
+    assert calls[0].error is not None
+
+    with pytest.raises(ModelError) as error:
+        list(model.stream("Hi"))
+    assert error.value.status_code == 404
+
+def test_error_mid_stream(server, model):
+    server.stream_lines = [json.dumps({"response": "Hel", "done": False}), json.dumps({"error": "out of memory"})]
+    chunks = []
+    with pytest.raises(ModelError, match="out of memory"):
+        for chunk in model.stream("Hi"):
+            chunks.append(chunk)
+    assert chunks == ["Hel"]
+
+def test_invalid_stream(server, model):
+    server.stream_lines = [json.dumps({"response": "Hel", "done": False}), "not json"]
+    with collect_metrics(model) as calls, pytest.raises(ModelError, match="Invalid response"):
+        list(model.stream("Hi"))
+    assert calls[0].error is not None
+
+def test_connection_error(model):
+    model.host = "http://127.0.0.1:1"
+    with pytest.raises(ModelError) as error:
+        model.invoke("Hi")
+    assert error.value.retryable
+    with pytest.raises(ModelError):
+        list(model.stream("Hi"))